@@ -0,0 +1,302 @@
+import os
+import io
+import sys
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+import run_metrics
+import s3_nii_to_meshes
+import s4_calc_BLDs
+import s5_calc_SDs
+import s6_calc_dist_metrics
+
+# Benchmarks steps 3-6 of the pipeline on synthetic contours, so that changes to (i.e.) bidir_distances or compute_summary_at_points can be timed without DICOM data.
+# Run from the command line (python benchmark_pipeline.py --help), results are appended to a JSON lines file (see run_metrics.RunLog) and compared with the previous run.
+
+# field of view of the synthetic images in mm (x, y, z), and the "STAPLE" ellipsoid radii and centre in mm
+FIELD_OF_VIEW = (320.0, 320.0, 200.0)
+STAPLE_RADII = (70.0, 60.0, 45.0)
+STAPLE_CENTRE = (110.0, 160.0, 100.0)
+
+# voxel spacings (x, y, z) in mm of the default benchmark resolutions
+RESOLUTIONS = {"coarse": (2.0, 2.0, 5.0),
+               "clinical": (1.0, 1.0, 2.5)}
+
+def perturbed_ellipsoid_mask(spacing, radii = STAPLE_RADII, centre = STAPLE_CENTRE, field_of_view = FIELD_OF_VIEW, n_modes = 4, amplitude = 0.0, rng = None):
+    """
+    perturbed_ellipsoid_mask : Creates a binary mask of an ellipsoid whose radius is perturbed by a few random low-frequency modes, as a stand-in for an organ contour.
+
+
+    Parameters
+    ----------
+    spacing : tuple of float
+        Voxel spacing (x, y, z) in mm
+    radii : tuple of float
+        Ellipsoid radii (x, y, z) in mm
+    centre : tuple of float
+        Ellipsoid centre (x, y, z) in mm
+    field_of_view : tuple of float
+        Image size (x, y, z) in mm
+    n_modes : int
+        Number of random modes added to the radius
+    amplitude : float
+        Largest relative change of the radius from each mode (0 for a plain ellipsoid)
+    rng : np.random.Generator, optional
+        Random generator for the modes
+
+    Returns
+    -------
+    image : SimpleITK.Image
+        uint8 mask with the given spacing
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    size = [int(round(fov / sp)) for fov, sp in zip(field_of_view, spacing)]
+    # voxel centre coordinates relative to the ellipsoid centre, scaled by the radii (numpy order is z, y, x)
+    z = ((np.arange(size[2]) + 0.5) * spacing[2] - centre[2]) / radii[2]
+    y = ((np.arange(size[1]) + 0.5) * spacing[1] - centre[1]) / radii[1]
+    x = ((np.arange(size[0]) + 0.5) * spacing[0] - centre[0]) / radii[0]
+    z, y, x = z[:, None, None], y[None, :, None], x[None, None, :]
+    r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    boundary = np.ones_like(r)
+    if amplitude > 0:
+        polar = np.arccos(np.clip(z / np.maximum(r, 1e-12), -1, 1))
+        azimuth = np.arctan2(y, x)
+        for _ in range(n_modes):
+            l, m = rng.integers(1, 4, size=2)
+            boundary += rng.uniform(-amplitude, amplitude) * np.cos(m * azimuth + rng.uniform(0, 2 * np.pi)) * np.sin(l * polar + rng.uniform(0, np.pi))
+    image = sitk.GetImageFromArray((r < boundary).astype(np.uint8))
+    image.SetSpacing(spacing)
+    return image
+
+def write_synthetic_patient(nifti_dir, spacing, n_observers, side = "left", contour = "manual", organ_name = "breast", amplitude = 0.05, shift_mm = 3.0, seed = 0):
+    """
+    write_synthetic_patient : Writes a synthetic "STAPLE" mask and n_observers perturbed, shifted observer masks, named as steps 1 and 2 name them.
+
+
+    Parameters
+    ----------
+    nifti_dir : filepath
+        The patient's nifti directory
+    spacing : tuple of float
+        Voxel spacing (x, y, z) in mm
+    n_observers : int
+        Number of observer masks
+    side, contour, organ_name : str
+        Used in the file names
+    amplitude : float
+        Largest relative change of the observers' radii from each random mode
+    shift_mm : float
+        Standard deviation of the random shift of each observer's centre in mm
+    seed : int
+        Seed of the random generator, so runs with the same settings use the same contours
+
+    Returns
+    -------
+    paths : dict
+        "staple" : the STAPLE mask, "observers" : list of the observer masks
+    """
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(nifti_dir):
+        os.makedirs(nifti_dir)
+    paths = {'staple': os.path.join(nifti_dir, f"{side}_{organ_name}_{contour}_staple.nii"), 'observers': []}
+    sitk.WriteImage(perturbed_ellipsoid_mask(spacing, rng = rng), paths['staple'])
+    for n in range(0, n_observers):
+        centre = tuple(np.array(STAPLE_CENTRE) + rng.normal(0, shift_mm, 3))
+        path = os.path.join(nifti_dir, f"{side}_{organ_name}_{n+1}_{contour}.nii")
+        sitk.WriteImage(perturbed_ellipsoid_mask(spacing, centre = centre, amplitude = amplitude, rng = rng), path)
+        paths['observers'].append(path)
+    return paths
+
+def _timed(function, repeats):
+    # fastest of repeats for the time, then one more run to trace the peak memory allocated by numpy/python (tracing slows the run down, so it is not timed)
+    best = None
+    for repeat in range(0, repeats):
+        timer = run_metrics.JobTimer()
+        with contextlib.redirect_stdout(io.StringIO()):
+            output = function()
+        metrics = timer.metrics()
+        if best is None or metrics['wall_time_s'] < best['wall_time_s']:
+            best = metrics
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    best['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    return output, best
+
+def benchmark_resolution(work_dir, label, spacing, n_observers = 10, repeats = 3, output_format = "pickle", seed = 0):
+    """
+    benchmark_resolution : Times steps 3-6 on one synthetic patient at one resolution: load_n_mesh on every mask, bidir_distances on every (STAPLE, observer) pair, compute_summary_at_points and s6_main.
+
+
+    Parameters
+    ----------
+    work_dir : filepath
+        Empty directory for the synthetic patient and the outputs
+    label : str
+        Name of the resolution (i.e. "clinical")
+    spacing : tuple of float
+        Voxel spacing (x, y, z) in mm
+    n_observers : int
+        Number of observer contours
+    repeats : int
+        Each stage is run this many times and the fastest time is kept
+    output_format : str
+        Format of the BLD files, one of bld_store.BLD_FORMATS
+    seed : int
+        Seed of the synthetic contours
+
+    Returns
+    -------
+    records : list of dict
+        one entry per step: wall and CPU time, throughput, peak memory traced in the stage and peak resident memory of the process
+    """
+    side, contour, patient = "left", "manual", "1"
+    nifti_dir = os.path.join(work_dir, "nifti_masks", patient)
+    bld_dir = os.path.join(work_dir, "BLD_dataframes", patient)
+    summary_dir = os.path.join(work_dir, "summary_at_points", patient)
+    for directory in [bld_dir, summary_dir]:
+        os.makedirs(directory)
+    paths = write_synthetic_patient(nifti_dir, spacing, n_observers, side, contour, seed = seed)
+    n_voxels = int(np.prod(sitk.ReadImage(paths['staple']).GetSize()))
+    common = {'resolution': label, 'spacing': list(spacing), 'n_voxels': n_voxels, 'n_observers': n_observers, 'output_format': output_format}
+    records = []
+
+    # step 3: nifti to mesh
+    all_paths = [paths['staple']] + paths['observers']
+    meshes, metrics = _timed(lambda: [s3_nii_to_meshes.load_n_mesh(path)[0] for path in all_paths], repeats)
+    n_vertices = sum(len(mesh.vertices) for mesh in meshes)
+    records.append(dict(common, step = "s3_load_n_mesh", n_items = len(all_paths), n_vertices = n_vertices,
+                        vertices_per_s = n_vertices / metrics['wall_time_s'], items_per_s = len(all_paths) / metrics['wall_time_s'], **metrics))
+
+    # step 4: BLDs of every (STAPLE, observer) pair, sharing the reference lookup tree as s4_main does
+    reference = s4_calc_BLDs.Contour(meshes[0], f"{side}_{contour}_staple")
+    comparisons = [s4_calc_BLDs.Contour(mesh, f"{side}_{contour}_{n+1}") for n, mesh in enumerate(meshes[1:])]
+    def run_blds():
+        ref_index = s4_calc_BLDs.ReferenceIndex(reference)
+        for comparison in comparisons:
+            s4_calc_BLDs.bidir_distances(bld_dir, reference, comparison, reference_index = ref_index, output_format = output_format)
+    _, metrics = _timed(run_blds, repeats)
+    n_pair_vertices = sum(len(reference.mesh.vertices) + len(comparison.mesh.vertices) for comparison in comparisons)
+    records.append(dict(common, step = "s4_bidir_distances", n_items = len(comparisons), n_vertices = n_pair_vertices,
+                        vertices_per_s = n_pair_vertices / metrics['wall_time_s'], items_per_s = len(comparisons) / metrics['wall_time_s'], **metrics))
+
+    # step 5: summary at each point of the reference
+    observers = [f"_breast_{n+1}_" for n in range(0, n_observers)]
+    just_blds = os.path.join(bld_dir, "just_BLD_DFs")
+    _, metrics = _timed(lambda: s5_calc_SDs.compute_summary_at_points(contour, just_blds, summary_dir, side, observers, output_format), repeats)
+    n_ref = len(reference.mesh.vertices)
+    records.append(dict(common, step = "s5_summary_at_points", n_items = 1, n_vertices = n_ref * n_observers,
+                        vertices_per_s = n_ref * n_observers / metrics['wall_time_s'], items_per_s = 1 / metrics['wall_time_s'], **metrics))
+
+    # step 6: distance metrics of every pair
+    _, metrics = _timed(lambda: s6_calc_dist_metrics.s6_main(work_dir, os.path.dirname(bld_dir), [patient], output_format), repeats)
+    records.append(dict(common, step = "s6_dist_metrics", n_items = len(comparisons), n_vertices = n_ref * n_observers,
+                        vertices_per_s = n_ref * n_observers / metrics['wall_time_s'], items_per_s = len(comparisons) / metrics['wall_time_s'], **metrics))
+    return records
+
+def run_benchmarks(results_path, resolutions = None, n_observers = 10, repeats = 3, output_format = "pickle", seed = 0, run_id = None):
+    """
+    run_benchmarks : Runs benchmark_resolution at every resolution in a temporary directory and appends the results to results_path.
+
+
+    Parameters
+    ----------
+    results_path : filepath
+        JSON lines file the results are appended to (see run_metrics.RunLog)
+    resolutions : dict, optional
+        Voxel spacings (x, y, z) in mm keyed by resolution name (RESOLUTIONS if None)
+    n_observers : int
+        Number of observer contours
+    repeats : int
+        Each stage is run this many times and the fastest time is kept
+    output_format : str
+        Format of the BLD files, one of bld_store.BLD_FORMATS
+    seed : int
+        Seed of the synthetic contours
+    run_id : str, optional
+        Name of this run (the start time if None)
+
+    Returns
+    -------
+    df : pd.DataFrame
+        one row per (resolution, step)
+    """
+    resolutions = RESOLUTIONS if resolutions is None else resolutions
+    log = run_metrics.RunLog(results_path, run_id)
+    records = []
+    for label, spacing in resolutions.items():
+        print(f"Benchmarking the {label} resolution {spacing} mm")
+        with tempfile.TemporaryDirectory() as work_dir:
+            for record in benchmark_resolution(work_dir, label, spacing, n_observers, repeats, output_format, seed):
+                log.record("benchmark", f"{record['step']}@{label}", **record)
+                records.append(dict(record, run_id = log.run_id))
+    return pd.DataFrame(records)
+
+def compare_benchmarks(results_path, run_id = None, baseline_run_id = None, threshold = 0.1):
+    """
+    compare_benchmarks : Compares the stage times of one benchmark run with a baseline run.
+
+
+    Parameters
+    ----------
+    results_path : filepath
+        JSON lines file written by run_benchmarks
+    run_id : str, optional
+        The run to compare (the latest run if None)
+    baseline_run_id : str, optional
+        The run to compare against (the run before run_id if None)
+    threshold : float
+        Relative slow down flagged as a regression (0.1 for 10% slower)
+
+    Returns
+    -------
+    comparison : pd.DataFrame or None
+        wall time of both runs, their ratio and a regression flag per (resolution, stage), or None if there is no baseline run
+    """
+    df = run_metrics.read_run_log(results_path)
+    df = df[df['stage'] == "benchmark"]
+    run_ids = list(dict.fromkeys(df['run_id']))
+    run_id = run_ids[-1] if run_id is None else run_id
+    if baseline_run_id is None:
+        earlier = run_ids[:run_ids.index(run_id)]
+        if len(earlier) == 0:
+            return None
+        baseline_run_id = earlier[-1]
+    columns = ['job', 'wall_time_s', 'vertices_per_s', 'peak_traced_mb']
+    comparison = pd.merge(df.loc[df['run_id'] == baseline_run_id, columns], df.loc[df['run_id'] == run_id, columns], on = 'job', suffixes = ("_baseline", "_new"))
+    comparison['time_ratio'] = comparison['wall_time_s_new'] / comparison['wall_time_s_baseline']
+    comparison['regression'] = comparison['time_ratio'] > 1 + threshold
+    comparison.attrs['run_id'] = run_id
+    comparison.attrs['baseline_run_id'] = baseline_run_id
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark steps 3-6 on synthetic contours")
+    parser.add_argument("--results", default = "benchmark_results.jsonl", help = "JSON lines file the results are appended to")
+    parser.add_argument("--resolutions", nargs = "+", default = list(RESOLUTIONS), help = f"resolutions to run, from {list(RESOLUTIONS)}, or spacings as x,y,z in mm")
+    parser.add_argument("--observers", type = int, default = 10)
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--format", default = "pickle", help = "BLD file format (see bld_store.BLD_FORMATS)")
+    parser.add_argument("--run-id", default = None)
+    parser.add_argument("--baseline", default = None, help = "run id to compare against (the previous run by default)")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "relative slow down reported as a regression")
+    args = parser.parse_args()
+
+    resolutions = {}
+    for resolution in args.resolutions:
+        resolutions[resolution] = RESOLUTIONS[resolution] if resolution in RESOLUTIONS else tuple(float(v) for v in resolution.split(","))
+    df = run_benchmarks(args.results, resolutions, args.observers, args.repeats, args.format, run_id = args.run_id)
+    pd.set_option('display.width', 200)
+    print(df[['resolution', 'step', 'n_items', 'n_vertices', 'wall_time_s', 'cpu_time_s', 'vertices_per_s', 'items_per_s', 'peak_traced_mb', 'peak_rss_mb']].to_string(index = False))
+
+    comparison = compare_benchmarks(args.results, df['run_id'].iloc[0], args.baseline, args.threshold)
+    if comparison is not None:
+        print(f"\nCompared with run {comparison.attrs['baseline_run_id']}:")
+        print(comparison[['job', 'wall_time_s_baseline', 'wall_time_s_new', 'time_ratio', 'regression']].to_string(index = False))
+        if comparison['regression'].any():
+            sys.exit(1)
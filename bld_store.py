@@ -0,0 +1,400 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# formats the bilateral distance tables of steps 4-6 can be stored in
+#   "pickle"  : one .pkl file per pair (the original output of step 4)
+#   "csv"     : one .csv file per pair, stored in the just_BLD_DFs_CSVs sub-folder
+#   "npy"     : one folder per pair, with one .npy file per column and a small manifest.json (columns can be read memory-mapped)
+#   "parquet" : one .parquet file per pair (needs pyarrow or fastparquet to be installed)
+BLD_FORMATS = ["pickle", "csv", "npy", "parquet"]
+
+MANIFEST_NAME = "manifest.json"
+# index of the tables in a directory (what each table compares), written by step 4 and read by step 6
+INDEX_NAME = "bld_index.json"
+# the reference (STAPLE) meshes the tables are aligned to, stored once per reference in this sub-folder of the tables directory (see write_reference). 
+# The tables only hold the distances at each reference vertex, in vertex order
+REFERENCE_DIR = "reference_meshes"
+# reference vertex coordinates, stored in the tables themselves before the references were stored once (still read from older tables)
+COORDINATE_COLUMNS = ["reference_X", "reference_Y", "reference_Z"]
+
+def check_format(bld_format):
+    if bld_format not in BLD_FORMATS:
+        raise ValueError(f"unknown BLD format '{bld_format}', expected one of {BLD_FORMATS}")
+
+def bld_path(directory, name, bld_format):
+    """
+    bld_path : Returns the path of a stored bilateral distance table.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the table is stored in (i.e. the patient's just_BLD_DFs directory)
+    name : str
+        The name of the table (i.e. left_manual_staple_to_left_manual_1)
+    bld_format : str
+        One of BLD_FORMATS
+
+    Returns
+    -------
+    path : filepath
+        path to the file (or, for "npy", the folder) which stores the table
+    """
+    check_format(bld_format)
+    if bld_format == "pickle":
+        return os.path.join(directory, f"{name}.pkl")
+    elif bld_format == "csv":
+        return os.path.join(directory, "just_BLD_DFs_CSVs", f"{name}.csv")
+    elif bld_format == "parquet":
+        return os.path.join(directory, f"{name}.parquet")
+    else:
+        return os.path.join(directory, name)
+
+def write_bld_table(directory, name, df, bld_format, metadata = None):
+    """
+    write_bld_table : Writes a bilateral distance table in the given format.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory to store the table in
+    name : str
+        The name of the table
+    df : pd.DataFrame
+        The table to store
+    bld_format : str
+        One of BLD_FORMATS
+    metadata : dict, optional
+        Extra information stored in the manifest (only used by the "npy" format)
+
+    Returns
+    -------
+    path : filepath
+        path to the file (or folder) written
+    """
+    path = bld_path(directory, name, bld_format)
+    parent = os.path.dirname(path) if bld_format != "npy" else path
+    # exist_ok, as pool workers may create the folder at the same time
+    os.makedirs(parent, exist_ok=True)
+
+    if bld_format == "pickle":
+        df.to_pickle(path)
+    elif bld_format == "csv":
+        df.to_csv(path)
+    elif bld_format == "parquet":
+        df.to_parquet(path)
+    else:
+        # one array per column, so later steps can memory-map just the columns they need
+        columns = {}
+        for column in df.columns:
+            values = df[column].to_numpy()
+            fname = f"{column}.npy"
+            np.save(os.path.join(path, fname), values)
+            columns[column] = {'file': fname, 'dtype': values.dtype.str}
+        manifest = {'name': name, 'n_rows': len(df), 'columns': columns, 'metadata': metadata or {}}
+        with open(os.path.join(path, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=1)
+    return path
+
+def read_manifest(directory, name):
+    with open(os.path.join(bld_path(directory, name, "npy"), MANIFEST_NAME)) as f:
+        return json.load(f)
+
+def read_bld_column(directory, name, column, bld_format, mmap = True):
+    """
+    read_bld_column : Reads a single column of a stored bilateral distance table. For the "npy" format only that column's file is opened (memory-mapped if mmap is True), and for "parquet" only that column is read.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the table is stored in
+    name : str
+        The name of the table
+    column : str
+        The column to read (i.e. bidir_distance_on_reference)
+    bld_format : str
+        One of BLD_FORMATS
+    mmap : bool
+        Memory-map the column for the "npy" format
+
+    Returns
+    -------
+    values : np.array
+    """
+    path = bld_path(directory, name, bld_format)
+    if bld_format == "npy":
+        manifest = read_manifest(directory, name)
+        return np.load(os.path.join(path, manifest['columns'][column]['file']), mmap_mode = "r" if mmap else None)
+    elif bld_format == "parquet":
+        return pd.read_parquet(path, columns=[column])[column].to_numpy()
+    else:
+        return read_bld_table(directory, name, bld_format)[column].to_numpy()
+
+def read_bld_table(directory, name, bld_format, columns = None, mmap = True):
+    """
+    read_bld_table : Reads a stored bilateral distance table into a DataFrame.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the table is stored in
+    name : str
+        The name of the table
+    bld_format : str
+        One of BLD_FORMATS
+    columns : array of str, optional
+        The columns to read (all columns if None)
+    mmap : bool
+        Memory-map the columns for the "npy" format
+
+    Returns
+    -------
+    df : pd.DataFrame
+    """
+    path = bld_path(directory, name, bld_format)
+    if bld_format == "pickle":
+        df = pd.read_pickle(path)
+    elif bld_format == "csv":
+        df = pd.read_csv(path, index_col=0)
+    elif bld_format == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    else:
+        manifest = read_manifest(directory, name)
+        if columns is None:
+            columns = list(manifest['columns'])
+        return pd.DataFrame({column: read_bld_column(directory, name, column, bld_format, mmap) for column in columns})
+    if columns is not None:
+        df = df[columns]
+    return df
+
+def list_bld_tables(directory, bld_format):
+    """
+    list_bld_tables : Returns the names of all bilateral distance tables stored in a directory in the given format.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the tables are stored in
+    bld_format : str
+        One of BLD_FORMATS
+
+    Returns
+    -------
+    names : array of str
+        sorted table names
+    """
+    check_format(bld_format)
+    if bld_format == "npy":
+        return sorted(entry for entry in os.listdir(directory) if os.path.isfile(os.path.join(directory, entry, MANIFEST_NAME)))
+    if bld_format == "csv":
+        directory = os.path.join(directory, "just_BLD_DFs_CSVs")
+        if not os.path.isdir(directory):
+            return []
+    extension = {"pickle": ".pkl", "csv": ".csv", "parquet": ".parquet"}[bld_format]
+    return sorted(entry[:-len(extension)] for entry in os.listdir(directory) if entry.endswith(extension))
+
+def read_bld_index(directory, bld_format = None):
+    """
+    read_bld_index : Reads the index of the bilateral distance tables stored in a directory, which records what each table compares, so later steps do not need to parse table names.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the tables are stored in
+    bld_format : str, optional
+        If given, only the entries of tables stored in this format are returned
+
+    Returns
+    -------
+    entries : list of dict
+        one entry per table, with its name, format, patient, side, contour (set), observer, reference and comparison names (empty if there is no index)
+    """
+    path = os.path.join(directory, INDEX_NAME)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        entries = json.load(f)
+    if bld_format is not None:
+        entries = [entry for entry in entries if entry['format'] == bld_format]
+    return entries
+
+def update_bld_index(directory, entries):
+    """
+    update_bld_index : Adds entries to the index of the bilateral distance tables stored in a directory, updating any entry for the same table name and format.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the tables are stored in
+    entries : list of dict
+        one entry per table, with at least 'name' and 'format' (see read_bld_index)
+
+    Returns
+    -------
+    None
+    """
+    index = {(entry['name'], entry['format']): entry for entry in read_bld_index(directory)}
+    for entry in entries:
+        # merged into the existing entry, so fields not given (i.e. the reference hash of a cached job) are kept
+        index[(entry['name'], entry['format'])] = dict(index.get((entry['name'], entry['format']), {}), **entry)
+    os.makedirs(directory, exist_ok=True)
+    # write to a temporary file first, so an interrupted write does not leave a broken index
+    path = os.path.join(directory, INDEX_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump([index[key] for key in sorted(index)], f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def reference_hash(vertices):
+    """
+    reference_hash : Returns a short hash of a vertex array (of its float64 values, in order), which identifies the reference mesh a table's rows are aligned to.
+
+
+    Parameters
+    ----------
+    vertices : np.array (n, 3)
+        The vertex coordinates
+
+    Returns
+    -------
+    hash : str
+        16 hexadecimal characters
+    """
+    vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+    digest = hashlib.sha1(str(vertices.shape).encode())
+    digest.update(vertices.tobytes())
+    return digest.hexdigest()[:16]
+
+def reference_path(directory, ref_name):
+    return os.path.join(directory, REFERENCE_DIR, f"{ref_name}.npz")
+
+def write_reference(directory, ref_name, vertices, vertex_hash = None):
+    """
+    write_reference : Stores the canonical vertex array of a reference mesh once (the triangles stay in the mesh file), for the tables aligned to it. 
+    If the same reference (same hash) is already stored it is not rewritten; the file is written under a temporary name and renamed, so pool workers can store the same reference at the same time.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the tables are stored in (i.e. the patient's just_BLD_DFs directory)
+    ref_name : str
+        The name of the reference contour (i.e. left_manual_staple)
+    vertices : np.array (n, 3)
+        The vertex coordinates, in the order of the table rows (stored as float32 if they are float32, otherwise as float64)
+    vertex_hash : str, optional
+        reference_hash(vertices), if already calculated
+
+    Returns
+    -------
+    hash : str
+        reference_hash(vertices)
+    """
+    vertex_hash = vertex_hash if vertex_hash is not None else reference_hash(vertices)
+    path = reference_path(directory, ref_name)
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            if str(stored['hash']) == vertex_hash:
+                return vertex_hash
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    vertices = np.asarray(vertices)
+    state = {'vertices': vertices if vertices.dtype == np.float32 else vertices.astype(np.float64), 'hash': np.array(vertex_hash)}
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **state)
+    os.replace(temp_path, path)
+    return vertex_hash
+
+def read_reference(directory, ref_name):
+    """
+    read_reference : Reads a reference mesh stored with write_reference.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the tables are stored in
+    ref_name : str
+        The name of the reference contour
+
+    Returns
+    -------
+    reference : dict
+        name, vertices (np.array (n, 3)) and hash
+    """
+    with np.load(reference_path(directory, ref_name)) as stored:
+        return {'name': ref_name, 'vertices': stored['vertices'], 'hash': str(stored['hash'])}
+
+def read_table_reference(directory, name, bld_format):
+    """
+    read_table_reference : Returns the reference vertices a table's rows are aligned to, and their hash. 
+    The reference is the one recorded in the index (or, for tables not in the index, the one in the table name). Tables written before the references were stored once hold the reference coordinates themselves, which are used instead.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the table is stored in
+    name : str
+        The name of the table (i.e. left_manual_staple_to_left_manual_1)
+    bld_format : str
+        One of BLD_FORMATS
+
+    Returns
+    -------
+    vertices : np.array (n, 3)
+        the reference vertex coordinates, one per table row
+    hash : str
+        reference_hash(vertices)
+    """
+    entry = table_index_entry(directory, name, bld_format)
+    ref_name = entry['reference'] if entry is not None else name.split("_to_")[0]
+    if os.path.exists(reference_path(directory, ref_name)):
+        reference = read_reference(directory, ref_name)
+        check_table_reference(directory, name, bld_format, reference['hash'], entry)
+        return reference['vertices'], reference['hash']
+    vertices = read_bld_table(directory, name, bld_format, columns = COORDINATE_COLUMNS).to_numpy(dtype=np.float64)
+    return vertices, reference_hash(vertices)
+
+def table_index_entry(directory, name, bld_format):
+    # index entry of one table, or None if it is not in the index
+    for entry in read_bld_index(directory, bld_format):
+        if entry['name'] == name:
+            return entry
+    return None
+
+def check_table_reference(directory, name, bld_format, vertex_hash, entry = None):
+    """
+    check_table_reference : Checks that a table was written on the reference with the given hash, as recorded in the index (tables without a recorded hash are not checked). 
+    Raises a ValueError otherwise, i.e. if a table is left over from an earlier reference mesh, so its rows would be matched to the wrong vertices.
+
+
+    Parameters
+    ----------
+    directory : filepath
+        The directory the table is stored in
+    name : str
+        The name of the table
+    bld_format : str
+        One of BLD_FORMATS
+    vertex_hash : str
+        The hash of the reference vertices the table should be aligned to
+    entry : dict, optional
+        The table's index entry, if already read
+
+    Returns
+    -------
+    None
+    """
+    entry = entry if entry is not None else table_index_entry(directory, name, bld_format)
+    recorded = entry.get('reference_hash') if entry is not None else None
+    if recorded is not None and recorded != vertex_hash:
+        raise ValueError(f"{name} was written on a different {entry['reference']} mesh (hash {recorded}) than the one stored (hash {vertex_hash}), run step 4 again")
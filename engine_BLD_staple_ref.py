@@ -8,6 +8,8 @@ import s5_calc_SDs
 import s6_calc_dist_metrics
 import ActorCreationCode
 import s7_visualisations
+import pipeline_cache
+import run_metrics
 
 dicom_base_dir = "C:// ....."
 
@@ -35,12 +37,28 @@ cntset = ["manual", "atlas_edited"]
 organ_name = "breast"
 observers = [f"_{organ_name}_1_",f"_{organ_name}_2_",f"_{organ_name}_3_",f"_{organ_name}_4_",f"_{organ_name}_5_",f"_{organ_name}_6_",f"_{organ_name}_7_",f"_{organ_name}_8_",f"_{organ_name}_9_",f"_{organ_name}_10_"]
 
-s1_dcm_to_nii.s1_main(dicom_base_dir, nifti_base_dir, patient_numbers, organ_name), 
-s2_get_staple_contours.s2_main(nifti_base_dir, patient_numbers, sides, cntset, observers) 
-s3_nii_to_meshes.s3_main(nifti_base_dir, mesh_base_dir, patient_numbers)
-s4_calc_BLDs.s4_main(mesh_base_dir, bld_dfs_dir, patient_numbers)
-s5_calc_SDs.s5_main(bld_dfs_dir, summary_at_pts_dir, patient_numbers)
-s6_calc_dist_metrics.s6_main(output_base_dir, bld_dfs_dir, patient_numbers)
-ActorCreationCode.actor_main(output_base_dir)
-s7_visualisations.s7_main(output_base_dir, summary_at_pts_dir, mesh_base_dir, patient_numbers)
+# tracks the content of each stage's inputs, so that re-running the engine only rebuilds outputs which are out of date
+# set max_intermediate_bytes to bound the disk used by the meshes and BLD files (least recently used are deleted first)
+cache = pipeline_cache.PipelineCache(os.path.join(output_base_dir, "pipeline_cache"), max_intermediate_bytes = None)
+# one JSON line per job and per stage (wall/CPU time, peak memory, counts, STAPLE sensitivity and specificity), appended over runs
+# read with run_metrics.read_run_log to find the slowest patients and stages, or to compare runs
+run_log = run_metrics.RunLog(os.path.join(output_base_dir, "run_metrics.jsonl"))
 
+# to run steps 2 to 6 on masks and meshes held in memory (i.e. from a long-running worker which keeps recent studies warm), use study_session.StudySession instead of the s<n>_main functions
+s1_dcm_to_nii.s1_main(dicom_base_dir, nifti_base_dir, patient_numbers, organ_name, cache = cache, run_log = run_log)
+s2_get_staple_contours.s2_main(nifti_base_dir, patient_numbers, sides, cntset, observers, organ_name, cache = cache, run_log = run_log) 
+# steps 3 and 4 can instead be run in one pass, without reading the .ply meshes back from disk:
+# s4_calc_BLDs.s4_fused_main(nifti_base_dir, bld_dfs_dir, patient_numbers, observers, sides, cntset, organ_name, mesh_base_dir = mesh_base_dir, cache = cache, run_log = run_log)
+# (add backend = "voxel" to screen with distance transforms of the masks instead, without meshing the observer contours)
+# pass simplify = s3_nii_to_meshes.SimplifySettings(...) to decimate the marching cubes meshes (check the change in the BLDs first with simplification_report.simplification_report)
+s3_nii_to_meshes.s3_main(nifti_base_dir, mesh_base_dir, patient_numbers, observers, sides, cntset, organ_name, cache = cache, run_log = run_log)
+# pass distance_mode = "surface" to measure distances to the closest point on the other mesh's triangles instead of its nearest vertex (less dependent on the mesh resolution)
+# pass precision = "float32" to steps 4 and 5 to halve the memory of the meshes, distances and summaries (check the deviation from "float64" first with precision_report.precision_report)
+s4_calc_BLDs.s4_main(mesh_base_dir, bld_dfs_dir, patient_numbers, observers, sides, cntset, organ_name, cache = cache, run_log = run_log)
+s5_calc_SDs.s5_main(bld_dfs_dir, summary_at_pts_dir, patient_numbers, observers, sides, cntset, cache = cache, run_log = run_log)
+s6_calc_dist_metrics.s6_main(output_base_dir, bld_dfs_dir, patient_numbers, cache = cache, run_log = run_log)
+ActorCreationCode.actor_main(output_base_dir)
+# pass workers = n to render the patients on n offscreen renderers, and view_names to choose the camera views (i.e. all ten views, see s7_main)
+# add orbit = s7_visualisations.OrbitSettings() to also write a turntable GIF of each heat map (fewer frames or a smaller window_size render faster)
+s7_visualisations.s7_main(output_base_dir, summary_at_pts_dir, mesh_base_dir, patient_numbers, cache = cache, run_log = run_log)
+cache.evict()
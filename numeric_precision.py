@@ -0,0 +1,50 @@
+import numpy as np
+
+# numeric precision of the in-memory meshes, distances and per-point summaries of steps 3 to 5: "float64" (the arrays are kept as calculated, double precision coordinates and distances) or "float32" (compact: float32 coordinates and distances, int32 indices).
+# Compact arrays take half the memory and I/O; use precision_report.precision_report to check the change in the results first
+PRECISIONS = ["float64", "float32"]
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, not {precision!r}")
+    return precision
+
+def compact_floats(array, precision):
+    """
+    compact_floats : Returns coordinates or distances as float32 for the "float32" precision, and unchanged for "float64" (no copy is made if the array already has the dtype).
+
+
+    Parameters
+    ----------
+    array : np.array
+        The coordinates or distances
+    precision : str
+        One of PRECISIONS
+
+    Returns
+    -------
+    array : np.array
+    """
+    if check_precision(precision) == "float32":
+        return np.asarray(array, dtype=np.float32)
+    return np.asarray(array)
+
+def compact_indices(array, precision):
+    """
+    compact_indices : Returns vertex or triangle indices as int32 for the "float32" precision, and unchanged for "float64" (no copy is made if the array already has the dtype).
+
+
+    Parameters
+    ----------
+    array : np.array
+        The indices
+    precision : str
+        One of PRECISIONS
+
+    Returns
+    -------
+    array : np.array
+    """
+    if check_precision(precision) == "float32":
+        return np.asarray(array, dtype=np.int32)
+    return np.asarray(array)
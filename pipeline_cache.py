@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+MANIFEST_NAME = "pipeline_cache_manifest.json"
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class PipelineCache:
+    """
+    A class to track which outputs of the pipeline stages are up to date, so that each stage only rebuilds the artifacts whose inputs or parameters changed.
+    A job (i.e. one patient in step 1, or one reference/observer pair in step 4) is up to date if the content hashes of its inputs and its parameters match the ones recorded when its outputs were written, and all of its outputs still exist.
+    File content hashes are remembered together with the file size and modification time, so unchanged files are not re-read.
+    Outputs recorded as intermediate (i.e. meshes and BLD tables) may be deleted by evict (called at the end of a run) to keep them under max_intermediate_bytes; the stage that made them rebuilds them when they are next needed.
+    ...
+
+    Attributes
+    ----------
+    manifest_path : filepath
+        the JSON manifest storing the recorded jobs and file hashes
+    max_intermediate_bytes : int or None
+        size budget for intermediate outputs (no eviction if None)
+    jobs : dict
+        recorded jobs, keyed by "<stage>/<job name>"
+    file_hashes : dict
+        remembered content hashes, keyed by absolute path: [size, mtime_ns, sha256]
+
+    Methods
+    -------
+    is_fresh(stage, job, inputs, params, outputs = None)
+        returns True if the job's recorded outputs are up to date
+    record(stage, job, inputs, params, outputs, intermediate = False)
+        records the outputs of a job which has just been run
+    evict()
+        deletes the least recently used intermediate outputs until they fit in max_intermediate_bytes
+    save()
+        writes the manifest to disk
+    """
+    def __init__(self, cache_dir, max_intermediate_bytes = None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        self.max_intermediate_bytes = max_intermediate_bytes
+        self.jobs = {}
+        self.file_hashes = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.jobs = manifest.get('jobs', {})
+            self.file_hashes = manifest.get('file_hashes', {})
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.file_hashes.get(path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self.file_hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def content_hash(self, path):
+        """
+        content_hash : Returns the sha256 of a file, or of every file (with its relative path) in a directory, i.e. a patient's DICOM folder.
+        """
+        if not os.path.isdir(path):
+            return self.file_hash(path)
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                full_path = os.path.join(root, f)
+                sha.update(os.path.relpath(full_path, path).encode())
+                sha.update(self.file_hash(full_path).encode())
+        return sha.hexdigest()
+
+    def job_key(self, stage, inputs, params):
+        sha = hashlib.sha256(stage.encode())
+        for path in inputs:
+            sha.update(self.content_hash(path).encode())
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def is_fresh(self, stage, job, inputs, params, outputs = None):
+        """
+        is_fresh : Returns True if the job was recorded with the same input content and parameters, and all its outputs exist. A missing input makes the job stale.
+
+
+        Parameters
+        ----------
+        stage : str
+            The stage name (i.e. "s3")
+        job : str
+            The job name within the stage (i.e. "1/left_manual_3")
+        inputs : array of filepath
+            The files (or directories) the job reads
+        params : dict
+            The stage parameters which change the outputs (i.e. the marching cubes level)
+        outputs : array of filepath, optional
+            The outputs expected from the job. If None, the outputs recorded for the job are checked
+
+        Returns
+        -------
+        fresh : bool
+        """
+        entry = self.jobs.get(f"{stage}/{job}")
+        if entry is None:
+            return False
+        if outputs is None:
+            outputs = entry['outputs']
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+        if not all(os.path.exists(path) for path in inputs):
+            return False
+        if entry['key'] != self.job_key(stage, inputs, params):
+            return False
+        entry['last_used'] = time.time()
+        return True
+
+    def record(self, stage, job, inputs, params, outputs, intermediate = False):
+        """
+        record : Records the outputs of a job which has just been run.
+
+
+        Parameters
+        ----------
+        stage : str
+            The stage name (i.e. "s3")
+        job : str
+            The job name within the stage
+        inputs : array of filepath
+            The files (or directories) the job read
+        params : dict
+            The stage parameters used
+        outputs : array of filepath
+            The files (or directories) written by the job
+        intermediate : bool
+            If True, the outputs may be deleted by evict
+
+        Returns
+        -------
+        None
+        """
+        outputs = [os.path.abspath(path) for path in outputs]
+        self.jobs[f"{stage}/{job}"] = {'key': self.job_key(stage, inputs, params),
+                                       'outputs': outputs,
+                                       'intermediate': intermediate,
+                                       'bytes': sum(_path_size(path) for path in outputs if os.path.exists(path)),
+                                       'last_used': time.time()}
+        self.save()
+
+    def evict(self):
+        if self.max_intermediate_bytes is None:
+            return
+        intermediate = sorted((entry['last_used'], name) for name, entry in self.jobs.items() if entry['intermediate'])
+        total = sum(self.jobs[name]['bytes'] for _, name in intermediate)
+        for _, name in intermediate:
+            if total <= self.max_intermediate_bytes:
+                break
+            entry = self.jobs.pop(name)
+            for path in entry['outputs']:
+                _remove_path(path)
+            total -= entry['bytes']
+            print(f"Evicted cached outputs of {name}")
+        self.save()
+
+    def save(self):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({'jobs': self.jobs, 'file_hashes': self.file_hashes}, f)
+        os.replace(temp_path, self.manifest_path)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+import s3_nii_to_meshes
+import s4_calc_BLDs
+import s5_calc_SDs
+import s6_calc_dist_metrics
+
+# Compares the meshes, BLDs, per-point summaries and distance metrics of the compact "float32" precision (see numeric_precision) with those of the default "float64" precision on the same masks,
+# so that the compact mode can be checked on a study's own contours before steps 3 to 5 are run with it.
+
+def _in_memory_blds(reference, name, verts_b, faces_b, distance_mode):
+    # one-sided distances, nearest reference vertex of each comparison vertex and BLDs, from a ReferenceIndex and the comparison arrays (as bidir_distances calculates them)
+    result = s4_calc_BLDs.reference_distances(reference, name, verts_b, faces_b, distance_mode)
+    dists_a, dists_b, targets_on_a_index, bidir = result[0], result[2], result[-2], result[-1]
+    return {'distance from reference': dists_a, 'distance from comparison': dists_b, 'bidir_distance_on_reference': bidir, 'nearest reference vertex': targets_on_a_index}
+
+def _run_precision(nifti_paths, precision, level, crop, distance_mode, percentiles):
+    # every array steps 3 to 6 hold for one reference and its comparisons, in the given precision
+    meshes = []
+    for nifti_path in nifti_paths:
+        verts, faces, _, _ = s3_nii_to_meshes.mesh_arrays_from_image(sitk.ReadImage(nifti_path), level, crop, precision)
+        if len(verts) == 0:
+            raise ValueError(f"no surface found in {nifti_path}")
+        meshes.append((verts, faces))
+    reference = s4_calc_BLDs.ReferenceIndex(s4_calc_BLDs.Contour(s4_calc_BLDs.MeshArrays(*meshes[0]), "reference"), precision = precision)
+    comparisons = [_in_memory_blds(reference, str(n), verts, faces, distance_mode) for n, (verts, faces) in enumerate(meshes[1:])]
+
+    arrays = {'vertices': np.concatenate([verts for verts, _ in meshes]), 'triangles': np.concatenate([faces for _, faces in meshes])}
+    for quantity in comparisons[0]:
+        arrays[quantity] = np.concatenate([comparison[quantity] for comparison in comparisons])
+    bld_matrix = np.column_stack([comparison['bidir_distance_on_reference'] for comparison in comparisons])
+    arrays['bld matrix (s5)'] = bld_matrix
+    arrays['mean_at_point'], arrays['std_at_point'] = s5_calc_SDs.point_statistics(bld_matrix, precision)
+    for metric, values in s6_calc_dist_metrics.distance_metrics(bld_matrix.T, percentiles).items():
+        arrays[metric] = values
+    return arrays
+
+def precision_report(ref_nifti_path, comparison_nifti_paths, level = 0.5, crop = True, distance_mode = "vertex", percentiles = (95,), output_path = None):
+    """
+    precision_report : Runs the meshing, BLD, per-point summary and distance metric calculations of one reference contour and its comparisons in both precisions ("float64" and the compact "float32", see numeric_precision),
+    and reports the largest deviation of each compact result from the double precision one, with the memory each takes.
+
+
+    Parameters
+    ----------
+    ref_nifti_path : filepath
+        The nifti file of the reference (STAPLE) contour
+    comparison_nifti_paths : array of filepath
+        The nifti files of the comparison (observer) contours
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of each mask
+    distance_mode : str
+        "vertex" or "surface" (see s4_calc_BLDs.bidir_distances)
+    percentiles : array of float
+        Percentiles of the BLDs to report (the 95th as HD95)
+    output_path : filepath, optional
+        If given, the report is also written to this .csv file
+
+    Returns
+    -------
+    report : pd.DataFrame
+        one row per quantity (vertices, triangles, one-sided distances, BLDs, nearest reference vertex, the s5 matrix and per-point mean and std, and each distance metric), with the dtype and megabytes in each precision,
+        the largest absolute deviation (in mm for coordinates and distances) and the largest deviation relative to the largest double precision value.
+        Indices are compared by the fraction of them which differ (a float32 coordinate can change which of two almost equidistant vertices is the nearest)
+    """
+    if distance_mode not in s4_calc_BLDs.DISTANCE_MODES:
+        raise ValueError(f"distance_mode must be one of {s4_calc_BLDs.DISTANCE_MODES}, not {distance_mode!r}")
+    nifti_paths = [ref_nifti_path] + list(comparison_nifti_paths)
+    full = _run_precision(nifti_paths, "float64", level, crop, distance_mode, percentiles)
+    compact = _run_precision(nifti_paths, "float32", level, crop, distance_mode, percentiles)
+
+    records = []
+    for quantity, values in full.items():
+        values = np.asarray(values)
+        compact_values = np.asarray(compact[quantity])
+        record = {'quantity': quantity, 'n_values': values.size, 'float64 dtype': str(values.dtype), 'float32 dtype': str(compact_values.dtype),
+                  'float64 MB': values.nbytes / (1024 * 1024), 'float32 MB': compact_values.nbytes / (1024 * 1024),
+                  'max abs deviation': None, 'max relative deviation': None, 'fraction different': None}
+        if values.dtype.kind in "iu":
+            record['fraction different'] = float(np.mean(values != compact_values))
+        else:
+            deviation = np.abs(values - compact_values.astype(np.float64))
+            record['max abs deviation'] = float(deviation.max())
+            record['max relative deviation'] = float(deviation.max() / max(np.abs(values).max(), np.finfo(np.float64).tiny))
+        records.append(record)
+    report = pd.DataFrame(records)
+
+    if output_path is not None:
+        report.to_csv(output_path, index = False)
+    print(report.to_string(index = False))
+    return report
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+import pandas as pd
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak memory is not recorded
+    resource = None
+
+def peak_rss_mb():
+    """
+    peak_rss_mb : Returns the peak resident memory of the current process in MB, or None if it cannot be measured on this platform.
+    This is the peak over the whole life of the process, so in a pool worker it covers every job the worker has run so far.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class JobTimer:
+    """
+    A class to measure the wall time and CPU time of one job, run in the process which creates the timer
+    ...
+
+    Attributes
+    ----------
+    wall_start : float
+        time.perf_counter() when the timer was created
+    cpu_start : float
+        time.process_time() when the timer was created
+
+    Methods
+    -------
+    metrics()
+        returns the wall time and CPU time since the timer was created, and the process' peak memory
+    """
+    def __init__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def metrics(self):
+        return {'wall_time_s': time.perf_counter() - self.wall_start,
+                'cpu_time_s': time.process_time() - self.cpu_start,
+                'peak_rss_mb': peak_rss_mb()}
+
+def _to_json(value):
+    # numpy values found in the stage summaries
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+class RunLog:
+    """
+    A class to append one JSON line per job (and per stage) of a pipeline run to a run log file, to find which patients and stages dominate a run and to compare runs
+    ...
+
+    Attributes
+    ----------
+    path : filepath
+        the JSON lines file the records are appended to
+    run_id : str
+        identifier stored in every record of this run (the start time of the run by default)
+
+    Methods
+    -------
+    record(stage, job, **fields)
+        appends one record
+    """
+    def __init__(self, path, run_id = None):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.run_id = run_id if run_id is not None else time.strftime("%Y%m%d-%H%M%S")
+
+    def record(self, stage, job, **fields):
+        """
+        record : Appends one record to the run log. The record is written straight away, so the log of a run which crashes is kept up to the failing job.
+
+
+        Parameters
+        ----------
+        stage : str
+            The stage name (i.e. "s2")
+        job : str
+            The job name within the stage (i.e. "1/left_manual"), or "all" for the whole stage
+        **fields
+            The metrics of the job (i.e. wall_time_s, cpu_time_s, peak_rss_mb, n_vertices, sensitivity)
+
+        Returns
+        -------
+        None
+        """
+        entry = {'run_id': self.run_id, 'stage': stage, 'job': job, 'timestamp': time.time()}
+        entry.update(fields)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, default=_to_json) + "\n")
+
+def read_run_log(path, run_id = None):
+    """
+    read_run_log : Reads a run log into a DataFrame (one row per record), i.e. to sum the wall time per stage and patient with df.groupby(["stage", "patient"])["wall_time_s"].sum()
+
+
+    Parameters
+    ----------
+    path : filepath
+        The run log file
+    run_id : str, optional
+        If given, only the records of this run are returned
+
+    Returns
+    -------
+    df : pd.DataFrame
+    """
+    with open(path) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    if run_id is not None and len(df) > 0:
+        df = df[df['run_id'] == run_id].reset_index(drop=True)
+    return df
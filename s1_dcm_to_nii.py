@@ -1,52 +1,167 @@
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from DicomRTTool import DicomReaderWriter   # using this magic package to convert from dicom to nifti: https://pypi.org/project/DicomRTTool/
 import SimpleITK as sitk
+import run_metrics
 
-def s1_main(dicom_base_dir, nifti_base_dir, patient_numbers, organ_name):
+def convert_patient(dicom_dir, nifti_dir, organ_name, compress = False, batched = True):
+    """
+    convert_patient : Converts the regions of interest of one patient's RTStruct which contain organ_name to nifti files, and times each part of the conversion.
+    In batched mode all selected regions of interest are rasterised in one call to get_mask (read back per region of interest from the reader's mask_dictionary), instead of re-processing the image and RTStruct once per region of interest.
+
+
+    Parameters
+    ----------
+    dicom_dir : filepath
+        The patient's DICOM directory
+    nifti_dir : filepath
+        The patient's directory to store the nifti files in
+    organ_name : str
+        The organ name which is featured in every region of interest to be converted to nifti files
+    compress : bool
+        If True, writes .nii.gz files instead of .nii files
+    batched : bool
+        If True, rasterises all selected regions of interest in one pass. If False, one region of interest at a time (the original behaviour)
+
+    Returns
+    -------
+    summary : dict
+        the nifti files written, the number of regions of interest, the read/mask/write/total times in seconds, CPU time, peak memory (see run_metrics) and the error traceback (None if the conversion succeeded)
+    """
+    summary = {'written': [], 'n_rois': 0, 'read_time_s': 0.0, 'mask_time_s': 0.0, 'write_time_s': 0.0, 'total_time_s': None, 'cpu_time_s': None, 'peak_rss_mb': None, 'error': None}
+    extension = ".nii.gz" if compress else ".nii"
+    t_start = time.perf_counter()
+    timer = run_metrics.JobTimer()
+    try:
+        # making the directory to store that patients' nifti files
+        os.makedirs(nifti_dir, exist_ok=True)
+
+        reader = DicomReaderWriter()
+        reader.walk_through_folders(dicom_dir)
+        reader.get_images()
+
+        # create array of the regions of interest names store in the RTStruct file
+        # only convert the regions of interest in the RTStruct which contain the 'organ_name' (specfied in the call to the function)
+        names = [name for name in reader.return_rois(print_rois=False) if (organ_name in name)]
+        summary['n_rois'] = len(names)
+        t_read = time.perf_counter()
+        summary['read_time_s'] = t_read - t_start
+
+        if batched and len(names) > 0:
+            reader.set_contour_names_and_associations(names)
+            reader.get_mask()
+            t_mask = time.perf_counter()
+            summary['mask_time_s'] = t_mask - t_read
+            for name in names:
+                # mask_dictionary keeps one mask per region of interest, so overlapping contours (i.e. from different observers) are kept apart
+                # apply the same flips DicomRTTool applies to its combined mask (and so to annotation_handle, written by the one-at-a-time mode)
+                roi_mask = sitk.GetArrayFromImage(reader.mask_dictionary[name.lower()])
+                if reader.flip_axes[0]:
+                    roi_mask = roi_mask[:, :, ::-1]
+                if reader.flip_axes[1]:
+                    roi_mask = roi_mask[:, ::-1]
+                if reader.flip_axes[2]:
+                    roi_mask = roi_mask[::-1]
+                roi_image = sitk.GetImageFromArray(roi_mask.astype(np.int8))
+                roi_image.CopyInformation(reader.annotation_handle)
+                fname = os.path.join(nifti_dir, f"{name}{extension}")
+                sitk.WriteImage(roi_image, fname)
+                summary['written'].append(fname)
+                print(f"Completed converting contour {name}")
+            summary['write_time_s'] = time.perf_counter() - t_mask
+        else:
+            for name in names:
+                t_roi = time.perf_counter()
+                reader.set_contour_names_and_associations([name])
+                reader.get_mask()
+                t_mask = time.perf_counter()
+                fname = os.path.join(nifti_dir, f"{name}{extension}")
+                sitk.WriteImage(reader.annotation_handle, fname)
+                summary['written'].append(fname)
+                summary['mask_time_s'] += t_mask - t_roi
+                summary['write_time_s'] += time.perf_counter() - t_mask
+                print(f"Completed converting contour {name}")
+    except Exception:
+        summary['error'] = traceback.format_exc()
+    summary['total_time_s'] = time.perf_counter() - t_start
+    metrics = timer.metrics()
+    summary['cpu_time_s'] = metrics['cpu_time_s']
+    summary['peak_rss_mb'] = metrics['peak_rss_mb']
+    return summary
+
+def s1_main(dicom_base_dir, nifti_base_dir, patient_numbers, organ_name, cache = None, workers = 1, compress = False, batched = True, run_log = None):
     """Step 1 main function: Converts the DICOM RTStruct file to a nifti file for each contour.
 
 
     Parameters
     ----------
     dicom_base_dir : filepath
-        The filepath which is the base directory for all the patient directories which contain patients' DICOM data. 
+        The filepath which is the base directory for all the patient directories which contain patients' DICOM data.
     nifti_base_dir : filepath
         The filepath which is the base directory for all the patient directories which will store patients' nifti files, created in this step.
     patient_numbers : array of str
         The patient numbers, which are also the directory names for the directories in dicom_base_dir and nifti_base_dir
     organ_name : str
-        The organ name which is featured in every region of interest to be converted to nifti files. This flag avoids converting unnecessary regions of interest stored in the RT struct file, thus avoiding pre-processing in your treatment planning system 
-    
- 
+        The organ name which is featured in every region of interest to be converted to nifti files. This flag avoids converting unnecessary regions of interest stored in the RT struct file, thus avoiding pre-processing in your treatment planning system
+    cache : pipeline_cache.PipelineCache, optional
+        If given, patients whose DICOM folder content is unchanged since their nifti files were written are skipped
+    workers : int
+        Number of worker processes to convert patients on in parallel
+    compress : bool
+        If True, writes .nii.gz files instead of .nii files (steps 2 and 3 then need nifti_extension = ".nii.gz")
+    batched : bool
+        If True, rasterises all of a patient's selected regions of interest in one pass (see convert_patient)
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every patient conversion (and of the whole step) are appended to this run log
+
+
     Returns
     -------
-    None
+    summaries : dict
+        per-patient summary of the conversion (see convert_patient), keyed by patient number
     """
-
+    stage_timer = run_metrics.JobTimer()
+    cache_params = {'organ_name': organ_name, 'compress': compress}
+    summaries = {}
+    pending = []
     #loop over patients' DICOM directories
     for patient in patient_numbers:
-        print("Working with patient " + str(patient))
-
         #going into the dicom directory for that patient
         dicom_dir = os.path.join(dicom_base_dir, patient)
+        if cache is not None and cache.is_fresh("s1", patient, [dicom_dir], cache_params):
+            print(f"Skipping patient {patient}: nifti files are up to date")
+            continue
+        pending.append(patient)
 
-        # making the directory to store that patients' nifti files 
-        nifti_dir = os.path.join(nifti_base_dir, patient)
-        if not os.path.exists(nifti_dir):
-            os.mkdir(nifti_dir)
-        
-        reader = DicomReaderWriter()
-        reader.walk_through_folders(dicom_dir)
-        reader.get_images()
-        
-        # create array of the regions of interest names store in the RTStruct file 
-        names = reader.return_rois(print_rois=False)
-        for name in names:
-            # only convert the regions of interest in the RTStruct which contain the 'organ_name' (specfied in the call to the function)
-            if (organ_name in name): 
-                reader.set_contour_names_and_associations([name])
-                reader.get_mask()
-                sitk.WriteImage(reader.annotation_handle, os.path.join(nifti_dir, f"{name}.nii"))
-                print(f"Completed converting contour {name}")
+    def finish_patient(patient, summary):
+        summaries[patient] = summary
+        if run_log is not None:
+            run_log.record("s1", patient, patient = patient, batched = batched, wall_time_s = summary['total_time_s'], **summary)
+        if summary['error'] is None:
+            print(f"Converted patient {patient}: {summary['n_rois']} contours in {summary['total_time_s']:.1f} s "
+                  f"(read {summary['read_time_s']:.1f} s, mask {summary['mask_time_s']:.1f} s, write {summary['write_time_s']:.1f} s)")
+            if cache is not None:
+                cache.record("s1", patient, [os.path.join(dicom_base_dir, patient)], cache_params, summary['written'])
+        else:
+            print(f"Failed to convert patient {patient}\n{summary['error']}")
+
+    if workers <= 1:
+        for patient in pending:
+            print("Working with patient " + str(patient))
+            finish_patient(patient, convert_patient(os.path.join(dicom_base_dir, patient), os.path.join(nifti_base_dir, patient), organ_name, compress, batched))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for patient in pending:
+                futures[patient] = pool.submit(convert_patient, os.path.join(dicom_base_dir, patient), os.path.join(nifti_base_dir, patient), organ_name, compress, batched)
+            for patient in pending:
+                finish_patient(patient, futures[patient].result())
 
+    if run_log is not None:
+        run_log.record("s1", "all", n_jobs = len(summaries), n_failed = sum(summary['error'] is not None for summary in summaries.values()), 
+                       workers = workers, **stage_timer.metrics())
     print("Step 1 complete: \n\t.dcm converted to .nii")
+    return summaries
@@ -1,5 +1,11 @@
 import SimpleITK as sitk
+import numpy as np
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage
+import run_metrics
 
 class NiftiFile:
     """
@@ -23,9 +29,242 @@ class NiftiFile:
         self.filepath = filepath;
         self.name = name;
 
-def s2_main(nifti_base_dir, patient_numbers, sides, contour_set, observers, organ_name = "breast"): 
+def mask_bounding_box(image, foreground_value = 1):
     """
-    Step 2 main function: Creates staple contour from all observers' contours as a nifti file.
+    mask_bounding_box : Returns the foreground voxels of a mask image cropped to their bounding box, so that only the cropped mask needs to be kept in memory.
+
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        The observer's mask
+    foreground_value : int
+        The value of the voxels inside the contour
+
+    Returns
+    -------
+    cropped : np.array of bool (cc, ap, lr), or None
+        foreground voxels in the bounding box (None if the mask is empty)
+    offset : np.array of int
+        index of the first voxel of the bounding box in the numpy (cc, ap, lr) order
+    """
+    foreground = sitk.GetArrayViewFromImage(image) == foreground_value
+    boxes = ndimage.find_objects(foreground.view(np.uint8))
+    if len(boxes) == 0:
+        return None, None
+    return foreground[boxes[0]].copy(), np.array([box.start for box in boxes[0]])
+
+def staple_vote_patterns(patterns, counts, max_iterations = 1000, tolerance = 1e-7):
+    """
+    staple_vote_patterns : Runs the STAPLE expectation maximisation (Warfield et al. 2004, as in sitk.STAPLEImageFilter) on the distinct patterns of observer votes instead of on every voxel. 
+    Every voxel with the same votes gets the same probability, so each pattern only needs to be weighted by its number of voxels. This is what allows step 2 to crop the masks: all voxels outside the union of the observers' masks have the all-background pattern, and are kept in its count.
+
+
+    Parameters
+    ----------
+    patterns : np.array of bool (n_patterns, n_observers)
+        The distinct votes, True where the observer included the voxel in their contour
+    counts : np.array (n_patterns,)
+        The number of voxels with each pattern
+    max_iterations : int
+        Maximum number of expectation maximisation iterations
+    tolerance : float
+        The iterations stop once no sensitivity or specificity changes by more than this (sitk.STAPLEImageFilter's results are matched to about 1e-7)
+
+    Returns
+    -------
+    probability : np.array (n_patterns,)
+        STAPLE probability that a voxel with each pattern is inside the true contour
+    sensitivity, specificity : np.array (n_observers,)
+        estimated sensitivity and specificity of each observer
+    iterations : int
+        number of iterations run
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n_observers = patterns.shape[1]
+    # prior probability of a voxel being inside the contour: the mean fraction of foreground votes
+    prior = (patterns.T @ counts).sum() / (n_observers * counts.sum())
+    sensitivity = np.full(n_observers, 0.99999)
+    specificity = np.full(n_observers, 0.99999)
+
+    def expectation(sensitivity, specificity):
+        inside = prior * np.where(patterns, sensitivity, 1 - sensitivity).prod(axis=1)
+        outside = (1 - prior) * np.where(patterns, 1 - specificity, specificity).prod(axis=1)
+        return inside / (inside + outside)
+
+    for iteration in range(1, max_iterations + 1):
+        probability = expectation(sensitivity, specificity)
+        last_sensitivity, last_specificity = sensitivity, specificity
+        weight_inside = counts * probability
+        weight_outside = counts * (1 - probability)
+        sensitivity = (patterns.T @ weight_inside) / weight_inside.sum()
+        specificity = ((~patterns).T @ weight_outside) / weight_outside.sum()
+        if np.abs(sensitivity - last_sensitivity).max() <= tolerance and np.abs(specificity - last_specificity).max() <= tolerance:
+            break
+    return expectation(sensitivity, specificity), sensitivity, specificity, iteration
+
+def _geometry(image):
+    # size, spacing, origin and direction of an image, to paste the STAPLE contour back into
+    return (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+
+def _staple_from_boxes(boxes, geometry):
+    # STAPLE contour of the observers' masks cropped to their bounding boxes (see mask_bounding_box), pasted back into the full image geometry
+    # union bounding box of all observers' masks
+    filled = [(cropped, offset) for cropped, offset in boxes if cropped is not None]
+    if len(filled) == 0:
+        raise ValueError("none of the observers' masks have foreground voxels")
+    union_start = np.min([offset for _, offset in filled], axis=0)
+    union_stop = np.max([offset + cropped.shape for cropped, offset in filled], axis=0)
+
+    # code every voxel of the union bounding box by its observer votes (bit n set if observer n included it)
+    votes = np.zeros(tuple(union_stop - union_start), dtype=np.uint64)
+    for n, (cropped, offset) in enumerate(boxes):
+        if cropped is None:
+            continue
+        start = offset - union_start
+        box = tuple(slice(a, a + size) for a, size in zip(start, cropped.shape))
+        votes[box] |= cropped.astype(np.uint64) << np.uint64(n)
+    codes, inverse, counts = np.unique(votes.ravel(), return_inverse=True, return_counts=True)
+    counts = counts.astype(np.float64)
+    # the voxels outside the union bounding box all have the all-background pattern
+    n_outside = np.prod(geometry[0], dtype=np.float64) - votes.size
+    if codes[0] != 0:
+        codes = np.concatenate([[np.uint64(0)], codes])
+        counts = np.concatenate([[0.0], counts])
+        inverse = inverse + 1
+    counts[0] += n_outside
+    patterns = ((codes[:, None] >> np.arange(len(boxes), dtype=np.uint64)) & np.uint64(1)).astype(bool)
+    probability, sensitivity, specificity, iterations = staple_vote_patterns(patterns, counts)
+
+    # paste the STAPLE probabilities of the union bounding box back into the full image
+    # (the voxels outside it get the probability of the all-background pattern)
+    staple_image = sitk.Image(geometry[0], sitk.sitkFloat64) + float(probability[0])
+    staple_image.SetSpacing(geometry[1])
+    staple_image.SetOrigin(geometry[2])
+    staple_image.SetDirection(geometry[3])
+    cropped_image = sitk.GetImageFromArray(probability[inverse].reshape(votes.shape))
+    staple_image = sitk.Paste(staple_image, cropped_image, cropped_image.GetSize(), [0, 0, 0], [int(i) for i in union_start[::-1]])
+    details = {'sensitivity': sensitivity.tolist(), 'specificity': specificity.tolist(), 'iterations': iterations, 
+               'crop_fraction': votes.size / np.prod(geometry[0], dtype=np.float64), 'n_voxels': int(np.prod(geometry[0]))}
+    return staple_image, details
+
+def staple_from_images(images, foreground_value = 1, crop = True):
+    """
+    staple_from_images : Creates the STAPLE contour of one (patient, side, contour set) from the observers' masks held in memory, without reading or writing any files (see make_staple for the file based version).
+
+
+    Parameters
+    ----------
+    images : array of SimpleITK.Image
+        The observers' masks, all of the same size
+    foreground_value : int
+        The value of the voxels inside the contours
+    crop : bool
+        If True, runs STAPLE on the union bounding box of the observers' masks (see staple_vote_patterns), otherwise sitk.STAPLEImageFilter is run on the full images
+
+    Returns
+    -------
+    staple_image : SimpleITK.Image
+        float64 STAPLE probability of every voxel, in the geometry of the first observer's mask
+    details : dict
+        sensitivity and specificity of each observer, number of iterations, the fraction of the image in the union bounding box and the number of voxels
+    """
+    images = list(images)
+    if not crop:
+        staple_filter = sitk.STAPLEImageFilter()
+        staple_filter.SetForegroundValue(foreground_value)
+        staple_image = staple_filter.Execute(images)
+        details = {'sensitivity': list(staple_filter.GetSensitivity()), 'specificity': list(staple_filter.GetSpecificity()), 'iterations': staple_filter.GetElapsedIterations(), 
+                   'crop_fraction': 1.0, 'n_voxels': int(np.prod(images[0].GetSize()))}
+        return staple_image, details
+    if len(images) > 64:
+        raise ValueError("cropped STAPLE supports up to 64 observers, use crop = False")
+    geometry = _geometry(images[0])
+    for n, image in enumerate(images):
+        if image.GetSize() != geometry[0]:
+            raise ValueError(f"observer {n+1}'s mask does not have the same size as observer 1's")
+    return _staple_from_boxes([mask_bounding_box(image, foreground_value) for image in images], geometry)
+
+def make_staple(observer_paths, staple_path, foreground_value = 1, crop = True):
+    """
+    make_staple : Creates the STAPLE contour of one (patient, side, contour set) from the observers' nifti files, and times each part. Exceptions are caught and returned, so that one failing contour set does not stop the others.
+    With crop = True, each observer's mask is read once and only its bounding box is kept. STAPLE is run on the union bounding box of all observers (see staple_vote_patterns) and pasted back into the geometry of the first observer's image, so the full size images are never held together in memory. 
+    With crop = False, sitk.STAPLEImageFilter is run on the full images (the original behaviour).
+
+
+    Parameters
+    ----------
+    observer_paths : array of filepath
+        The observers' nifti files
+    staple_path : filepath
+        The STAPLE nifti file to write
+    foreground_value : int
+        The value of the voxels inside the contours
+    crop : bool
+        If True, runs STAPLE on the union bounding box of the observers' masks
+
+    Returns
+    -------
+    summary : dict
+        the STAPLE file, number of observers and voxels, sensitivity and specificity of each observer, number of iterations, the fraction of the image in the union bounding box, read/STAPLE/write/total times in seconds, CPU time, peak memory (see run_metrics) and the error traceback (None if STAPLE succeeded)
+    """
+    summary = {'staple': staple_path, 'n_observers': len(observer_paths), 'n_voxels': None, 'sensitivity': None, 'specificity': None, 'iterations': None, 'crop_fraction': None, 
+               'read_time_s': None, 'staple_time_s': None, 'write_time_s': None, 'total_time_s': None, 'cpu_time_s': None, 'peak_rss_mb': None, 'error': None}
+    t_start = time.perf_counter()
+    timer = run_metrics.JobTimer()
+    try:
+        if not crop:
+            # read niftis using SITK 
+            nibs = [sitk.ReadImage(path) for path in observer_paths]
+            t_read = time.perf_counter()
+            # run STAPLE algorithm 
+            staple_image, details = staple_from_images(nibs, foreground_value, crop = False)
+            summary.update(details)
+        else:
+            if len(observer_paths) > 64:
+                raise ValueError("cropped STAPLE supports up to 64 observers, use crop = False")
+            # read each observer's mask and keep only its bounding box
+            geometry = None
+            boxes = []
+            for path in observer_paths:
+                image = sitk.ReadImage(path)
+                if geometry is None:
+                    # geometry of the first image, to paste the STAPLE contour back into
+                    geometry = _geometry(image)
+                elif image.GetSize() != geometry[0]:
+                    raise ValueError(f"{path} does not have the same size as {observer_paths[0]}")
+                boxes.append(mask_bounding_box(image, foreground_value))
+                del image
+            t_read = time.perf_counter()
+
+            staple_image, details = _staple_from_boxes(boxes, geometry)
+            summary.update(details)
+        t_staple = time.perf_counter()
+
+        # save STAPLE contour to .nii file
+        sitk.WriteImage(staple_image, staple_path) 
+        t_end = time.perf_counter()
+        summary['read_time_s'] = t_read - t_start
+        summary['staple_time_s'] = t_staple - t_read
+        summary['write_time_s'] = t_end - t_staple
+    except Exception:
+        summary['error'] = traceback.format_exc()
+    summary['total_time_s'] = time.perf_counter() - t_start
+    metrics = timer.metrics()
+    summary['cpu_time_s'] = metrics['cpu_time_s']
+    summary['peak_rss_mb'] = metrics['peak_rss_mb']
+    return summary
+
+def _set_sitk_threads(threads):
+    # sets SimpleITK's process-wide default number of threads (kept if threads is None), and returns the previous default so the caller can restore it
+    previous = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    if threads is not None:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    return previous
+
+def s2_main(nifti_base_dir, patient_numbers, sides, contour_set, observers, organ_name = "breast", cache = None, nifti_extension = ".nii", workers = 1, threads = None, crop = True, run_log = None): 
+    """
+    Step 2 main function: Creates staple contour from all observers' contours as a nifti file. Raises a FileNotFoundError if a patient's nifti directory is missing (see staple_from_images to make a STAPLE contour from masks held in memory).
 
 
     Parameters
@@ -42,58 +281,94 @@ def s2_main(nifti_base_dir, patient_numbers, sides, contour_set, observers, orga
         Array of strings which idicate the observer which generated the organ contour. Included in the naming of the region of interest contour in you treatment planning system, thus included in the naming of the nifti file sed to generate the STAPLE contour.      
     organ_name : str
         The organ name which is featured in the name of the region of interest's nifti file.
+    cache : pipeline_cache.PipelineCache, optional
+        If given, STAPLE contours whose observer nifti files are unchanged since they were made are skipped
+    nifti_extension : str
+        Extension of the observers' nifti files written in step 1 (".nii", or ".nii.gz" if step 1 was run with compress = True)
+    workers : int
+        Number of worker processes to run the (patient, side, contour set) STAPLE jobs on in parallel
+    threads : int, optional
+        Number of threads used by each SimpleITK filter (sitk.ProcessObject.SetGlobalDefaultNumberOfThreads, restored when the step returns). If None, SimpleITK's default is kept when workers = 1, and the CPUs are shared out between the workers otherwise
+    crop : bool
+        If True, STAPLE is run on the union bounding box of the observers' masks and pasted back into the full image (see make_staple)
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every STAPLE contour, with the sensitivity and specificity of each observer, (and of the whole step) are appended to this run log
     
  
     Returns
     -------
-    None
+    summaries : dict
+        per contour set summary of STAPLE (see make_staple), keyed by "<patient>/<side>_<contour set>"
     """
+    stage_timer = run_metrics.JobTimer()
+    # parameters which change the STAPLE contours, used by the cache to detect stale contours
+    cache_params = {'foreground_value': 1, 'crop': crop}
+    # (job name, observer nifti files, STAPLE nifti file) of every STAPLE contour to make
+    tasks = []
     #loop over patients' nifti directories
     for patient in patient_numbers:
         print("Creating staple contours for " + patient)
+        # locate the nifti directory for the patient
+        pt_nifti_dir = os.path.join(nifti_base_dir, patient)
+        if not os.path.isdir(pt_nifti_dir):
+            raise FileNotFoundError(f"step 2: could not find the nifti directory for patient {patient} ({pt_nifti_dir})")
 
         # loop over laterality of the contour
         for side in sides:
             # loop over the type of contour ("manual" or "atlas-edited")
             for contour in contour_set:
-                # locate the nifti directory for the patient
-                try:
-                    os.chdir(os.path.join(nifti_base_dir, patient))
-                except:
-                    print("step 2, line 10; could not find the nifti directory for the given patient")
-                    exit();
-
                 # load nifti file filepaths into array
                 niftis = []
                 for n in range(0,len(observers)):
-                    niftis.append(NiftiFile(f"{side}{observers[n]}{contour}.nii", str(n+1)))
-                        
-                # read niftis using SITK 
-                nibs = []
-                for nii in niftis:
-                    seg_sitk = sitk.ReadImage(nii.filepath)
-                    nibs.append(seg_sitk)
-
-                # run STAPLE algorithm 
-                staple_filter = sitk.STAPLEImageFilter()
-                staple_filter.SetForegroundValue(1)
-                staple_image = staple_filter.Execute(nibs)
-
-                # print specificity of STAPLE algorithm 
-                # TODO: save specificity to separate file 
-                staple_specificity = staple_filter.GetSpecificity()
-                print("staple_specificity")
-                print(staple_specificity)
-                # print sensitivity of STAPLE algorithm 
-                # TODO: save sensitivity to separate file 
-                staple_sensitivity = staple_filter.GetSensitivity()
-                print("staple_sensitivity")
-                print(staple_sensitivity)
-
-                # save STAPLE contour to .nii file
-                fname = f"{side}_{organ_name}_{contour}_staple.nii"
-                sitk.WriteImage(staple_image, fname) 
-                print(f"Made {side}_{organ_name}_{contour}_staple.nii")
-            
-    print("Completed step 2: generated STAPLE contours")
+                    niftis.append(NiftiFile(os.path.join(pt_nifti_dir, f"{side}{observers[n]}{contour}{nifti_extension}"), str(n+1)))
+
+                fname = os.path.join(pt_nifti_dir, f"{side}_{organ_name}_{contour}_staple.nii")
+                cache_inputs = [nii.filepath for nii in niftis]
+                if cache is not None and cache.is_fresh("s2", f"{patient}/{side}_{contour}", cache_inputs, cache_params, [fname]):
+                    print(f"Skipping {side}_{organ_name}_{contour}_staple.nii: up to date")
+                    continue
+                tasks.append((f"{patient}/{side}_{contour}", cache_inputs, fname))
 
+    summaries = {}
+    def finish_staple(job, cache_inputs, summary):
+        summaries[job] = summary
+        # the STAPLE sensitivity and specificity of each observer are stored in the run log
+        if run_log is not None:
+            patient, name = job.split("/")
+            run_log.record("s2", job, patient = patient, contour_set = name, foreground_value = 1, crop = crop, wall_time_s = summary['total_time_s'], **summary)
+        if summary['error'] is not None:
+            print(f"Failed to make the STAPLE contour {summary['staple']}\n{summary['error']}")
+            return
+        # print specificity of STAPLE algorithm 
+        print("staple_specificity")
+        print(summary['specificity'])
+        # print sensitivity of STAPLE algorithm 
+        print("staple_sensitivity")
+        print(summary['sensitivity'])
+        print(f"Made {os.path.basename(summary['staple'])} in {summary['total_time_s']:.1f} s "
+              f"(read {summary['read_time_s']:.1f} s, STAPLE {summary['staple_time_s']:.1f} s on {100 * summary['crop_fraction']:.1f}% of the image, write {summary['write_time_s']:.1f} s)")
+        if cache is not None:
+            cache.record("s2", job, cache_inputs, cache_params, [summary['staple']])
+
+    if workers <= 1:
+        # the thread count is restored afterwards, so the rest of the calling process keeps its own setting
+        previous_threads = _set_sitk_threads(threads)
+        try:
+            for job, cache_inputs, fname in tasks:
+                finish_staple(job, cache_inputs, make_staple(cache_inputs, fname, 1, crop))
+        finally:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(previous_threads)
+    else:
+        if threads is None:
+            # share the CPUs out between the workers, rather than every worker using all of them
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_set_sitk_threads, initargs=(threads,)) as pool:
+            futures = [pool.submit(make_staple, cache_inputs, fname, 1, crop) for _, cache_inputs, fname in tasks]
+            for (job, cache_inputs, _), future in zip(tasks, futures):
+                finish_staple(job, cache_inputs, future.result())
+
+    if run_log is not None:
+        run_log.record("s2", "all", n_jobs = len(summaries), n_failed = sum(summary['error'] is not None for summary in summaries.values()), 
+                       workers = workers, threads = threads, **stage_timer.metrics())
+    print("Completed step 2: generated STAPLE contours")
+    return summaries
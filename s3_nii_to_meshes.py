@@ -3,11 +3,79 @@ import skimage.measure
 import SimpleITK as sitk
 import open3d as o3d
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from scipy import ndimage
+import run_metrics
+import numeric_precision
+
+# mesh simplification methods of smooth_n_simplify (see SimplifySettings)
+SIMPLIFY_METHODS = ["quadric", "clustering"]
 
 # FUNCTION DEFINITIONS 
 
-def load_n_mesh(fname):
+def crop_to_mask(mask, level = 0.5, pad = 1):
+    """
+    crop_to_mask : Finds the tight bounding box of the voxels at or above level, padded by pad voxels (clipped to the volume), so marching cubes only needs to visit that sub-volume.
+
+
+    Parameters
+    ----------
+    mask : np.array
+        the mask (or STAPLE probability map) to be meshed
+    level : float
+        The marching cubes iso-level
+    pad : int
+        Number of voxels to pad the bounding box with on each side, so the surface is closed inside the crop as in the full volume
+
+    Returns
+    -------
+    slices : tuple of slice
+        the cropped region of mask
+    offset : np.array (3,)
+        index of the first voxel of the cropped region in mask
+    """
+    objects = ndimage.find_objects((mask >= level).astype(np.uint8))
+    if len(objects) == 0 or objects[0] is None:
+        # nothing to crop to, keep the whole volume
+        return tuple(slice(0, n) for n in mask.shape), np.zeros(mask.ndim, dtype=int)
+    slices = tuple(slice(max(s.start - pad, 0), min(s.stop + pad, n)) for s, n in zip(objects[0], mask.shape))
+    offset = np.array([s.start for s in slices])
+    return slices, offset
+
+def mesh_arrays_from_mask(mask, spacing, level = 0.5, crop = True):
+    """
+    mesh_arrays_from_mask : Runs marching cubes on a mask, optionally only on its bounding box (see crop_to_mask), and returns the vertices in the coordinates of the whole volume.
+
+
+    Parameters
+    ----------
+    mask : np.array
+        the mask to be meshed
+    spacing : np.array (3,)
+        voxel spacing along the axes of mask
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of the mask (plus a one voxel pad), and offsets the vertices back
+
+    Returns
+    -------
+    verts, faces, normals : np.array
+        the outputs of skimage.measure.marching_cubes
+    """
+    offset = np.zeros(3)
+    if crop:
+        slices, offset = crop_to_mask(mask, level)
+        mask = mask[slices]
+    # using marching cubes to get the triangulated surface
+    verts, faces, normals, _ = skimage.measure.marching_cubes(volume=mask, level=level, spacing=tuple(spacing))
+    # offset the vertices of the cropped volume back into the coordinates of the whole volume
+    verts += offset * spacing
+    return verts, faces, normals
+
+def load_n_mesh(fname, level = 0.5, crop = True, precision = "float64"):
     """
     load_n_mesh : Converts individual nifti files to .ply meshes 
 
@@ -16,6 +84,12 @@ def load_n_mesh(fname):
     ----------
     fname : filepath
         The filepath to the nifti file to be converted to the mesh
+    level : float
+        The marching cubes iso-level (0.5 for binary masks)
+    crop : bool
+        If True, marching cubes is only run on the bounding box of the mask (see mesh_arrays_from_mask), which gives the same mesh for much less time and memory
+    precision : str
+        One of numeric_precision.PRECISIONS. With "float32", the vertices are rounded to float32 (Open3D still stores them as doubles) and a floating point mask (i.e. a STAPLE probability map) is returned as float32
     
     Returns
     -------
@@ -29,47 +103,201 @@ def load_n_mesh(fname):
     # load data
     nii = sitk.ReadImage(fname)
     direction_matrix = nii.GetDirection();# --> covariance matic, orientation of the image, same for all masks
-    spacing = np.array(nii.GetSpacing())
 
-    # convert to numpy array (mask)
-    mask = sitk.GetArrayFromImage(nii)
-    mask = np.flip(mask, axis=2) # for LR flip 
-    
-    # switch axes order from (ap,lr,cc) to (cc,ap,lr) (done in conversion to np array)
-    spacing = spacing[[2,0,1]]
-    # using marching cubes to get the triangulated surface
-    verts, faces, normals, _ = skimage.measure.marching_cubes(volume=mask, level=0.5, spacing=spacing)
+    # mesh the mask without copying the whole voxel array (see mesh_arrays_from_image)
+    verts, faces, normals, mask = mesh_arrays_from_image(nii, level, crop, precision)
+    # the view is only valid while nii exists (the mask is meshed before it is made compact, so the mesh does not change)
+    mask = mask.astype(np.float32) if precision == "float32" and mask.dtype.kind == 'f' else mask.copy()
 
     # use Open3D to create 3D model
+    mesh = mesh_from_arrays(verts, faces, normals)
+
+    return mesh, mask
+
+def mesh_from_arrays(verts, faces, normals):
+    # use Open3D to create 3D model from the marching cubes outputs
     mesh = o3d.geometry.TriangleMesh()
     mesh.vertices = o3d.utility.Vector3dVector(verts)
     mesh.triangles = o3d.utility.Vector3iVector(faces)
     mesh.vertex_normals = o3d.utility.Vector3dVector(normals)
+    return mesh
 
-    return mesh, mask
+def write_mesh_arrays(mesh_path, verts, faces, normals):
+    """
+    write_mesh_arrays : Builds the Open3D mesh from mesh arrays and writes it to a .ply file, as step 3 does. Used to persist meshes made in memory (i.e. by s4_calc_BLDs.s4_fused_main, in a background thread). 
+    The arrays are written as given, so they should already be smoothed and simplified as step 3 would (see simplify_mesh_arrays).
+
+
+    Parameters
+    ----------
+    mesh_path : filepath
+        The .ply file to write
+    verts, faces, normals : np.array
+        the mesh vertices, triangles and vertex normals (i.e. the outputs of marching cubes)
+
+    Returns
+    -------
+    mesh_path : filepath
+    """
+    mesh = mesh_from_arrays(verts, faces, normals)
+    if not o3d.io.write_triangle_mesh(mesh_path, mesh):
+        raise IOError(f"could not write the mesh to {mesh_path}")
+    return mesh_path
+
+def mesh_arrays_from_image(nii, level = 0.5, crop = True, precision = "float64"):
+    """
+    mesh_arrays_from_image : Meshes a SimpleITK mask image without copying its whole voxel array. 
+    The mask is a read-only view of the image buffer, and the LR flip is a flipped view of it (np.flip does not copy), so the only copy made is the one marching cubes makes of the cropped sub-volume (see mesh_arrays_from_mask).
+    (Flipping the vertices instead of the volume was not used: marching cubes does not triangulate mirrored volumes symmetrically, so it would change the meshes.)
+
+
+    Parameters
+    ----------
+    nii : SimpleITK.Image
+        The mask image read from the nifti file
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of the mask
+    precision : str
+        One of numeric_precision.PRECISIONS ("float32" for float32 vertices and normals and int32 faces)
+
+    Returns
+    -------
+    verts, faces, normals : np.array
+        the outputs of marching cubes
+    mask : np.array
+        the flipped, read-only view of the image's voxel array (only valid while nii exists)
+    """
+    mask, spacing = mask_view_from_image(nii)
+    verts, faces, normals = mesh_arrays_from_mask(mask, spacing, level, crop)
+    return numeric_precision.compact_floats(verts, precision), numeric_precision.compact_indices(faces, precision), numeric_precision.compact_floats(normals, precision), mask
+
+def mask_view_from_image(nii):
+    """
+    mask_view_from_image : Returns the LR flipped, read-only view of a mask image's voxel array and the voxel spacing along its axes, in the orientation the meshes are built in (a voxel index times spacing is in mesh coordinates).
+
+
+    Parameters
+    ----------
+    nii : SimpleITK.Image
+        The mask image read from the nifti file
+
+    Returns
+    -------
+    mask : np.array
+        the flipped, read-only view of the image's voxel array (only valid while nii exists)
+    spacing : np.array (3,)
+        voxel spacing along the axes of mask
+    """
+    mask = np.flip(sitk.GetArrayViewFromImage(nii), axis=2) # for LR flip 
+    # switch axes order from (ap,lr,cc) to (cc,ap,lr) (done in conversion to np array)
+    spacing = np.array(nii.GetSpacing())[[2,0,1]]
+    return mask, spacing
+
+class SimplifySettings:
+    """
+    A class to hold the settings of the mesh simplification of step 3 (see smooth_n_simplify). Marching cubes on fine grids gives far more vertices than the BLDs need, and steps 4 to 7 all scale with the vertex count.
+    Use simplification_report.simplification_report to check the change in the BLD statistics before choosing the settings.
+    ...
+
+    Attributes
+    ----------
+    method : str
+        "quadric" (quadric error decimation, which keeps the vertices where the surface curves) or "clustering" (vertex clustering on a grid, faster and with a guaranteed error bound)
+    target_vertices : int
+        vertex count to decimate to (quadric only; decimation stops earlier if max_error_mm is reached)
+    max_error_mm : float
+        largest distance (in mm) a vertex may move. For clustering, the grid cell size is max_error_mm / sqrt(3), so no vertex moves further than this. 
+        For quadric decimation, the squared error of each merge is bounded by max_error_mm**2 (the quadric error is the sum of the squared distances to the planes of the faces around the vertex, so this bounds the distance from the surface, not from the original vertex)
+    taubin_iterations : int
+        Taubin smoothing iterations before simplifying (0 for none)
+
+    Methods
+    -------
+    params()
+        returns the settings, for the pipeline cache
+    """
+    def __init__(self, method = "quadric", target_vertices = None, max_error_mm = None, taubin_iterations = 0):
+        if method not in SIMPLIFY_METHODS:
+            raise ValueError(f"method must be one of {SIMPLIFY_METHODS}, not {method!r}")
+        if method == "clustering" and max_error_mm is None:
+            raise ValueError("vertex clustering needs max_error_mm (its grid cell size)")
+        if method == "quadric" and target_vertices is None and max_error_mm is None:
+            raise ValueError("quadric decimation needs a target_vertices and/or a max_error_mm")
+        self.method = method
+        self.target_vertices = target_vertices
+        self.max_error_mm = max_error_mm
+        self.taubin_iterations = taubin_iterations
+
+    def params(self):
+        return {'method': self.method, 'target_vertices': self.target_vertices, 'max_error_mm': self.max_error_mm, 'taubin_iterations': self.taubin_iterations}
 
 # smoothing taubin function
-def smooth_n_simplify(mesh):
+def smooth_n_simplify(mesh, simplify = None):
     """
-    Optional function to apply smoothing to the mesh returned from load_n_mesh. Taubin smoothing included as an example
+    Optional function to apply smoothing and simplification to the mesh returned from load_n_mesh (Taubin smoothing, then quadric decimation or vertex clustering, see SimplifySettings).
 
 
     Parameters
     ----------
     mesh : o3d.geometry.TriangleMesh()
         the triangulated mesh created from the nifti file 
+    simplify : SimplifySettings object, optional
+        How to smooth and simplify the mesh. The mesh is returned unchanged if None
     
     Returns
     -------
     mesh : o3d.geometry.TriangleMesh()
-        the triangulated mesh created from the nifti file, which has been smoothed by this function
+        the triangulated mesh created from the nifti file, which has been smoothed and simplified by this function
     
     """
-    
-    #mesh = mesh.filter_smooth_taubin(number_of_iterations=1)
+    if simplify is None:
+        return mesh
+    if simplify.taubin_iterations > 0:
+        mesh = mesh.filter_smooth_taubin(number_of_iterations=simplify.taubin_iterations)
+
+    if simplify.method == "quadric":
+        # a closed triangulated surface has about two triangles per vertex
+        target_triangles = 2 * simplify.target_vertices if simplify.target_vertices is not None else 4
+        maximum_error = simplify.max_error_mm**2 if simplify.max_error_mm is not None else np.inf
+        if target_triangles < len(mesh.triangles):
+            mesh = mesh.simplify_quadric_decimation(target_number_of_triangles=target_triangles, maximum_error=maximum_error)
+    else:
+        # each vertex moves to the mean of the vertices in its grid cell, so by at most the cell diagonal
+        mesh = mesh.simplify_vertex_clustering(voxel_size=simplify.max_error_mm / np.sqrt(3), contraction=o3d.geometry.SimplificationContraction.Average)
 
+    # merged vertices leave collapsed triangles and unused vertices, and the marching cubes normals no longer match the faces
+    mesh.remove_degenerate_triangles()
+    mesh.remove_unreferenced_vertices()
+    mesh.compute_vertex_normals()
     return mesh
 
+def simplify_mesh_arrays(verts, faces, normals, simplify = None, precision = "float64"):
+    """
+    simplify_mesh_arrays : Smooths and simplifies a mesh given as arrays (i.e. the outputs of marching cubes), as step 3 does (see smooth_n_simplify), for meshes which are used in memory (i.e. by s4_calc_BLDs.s4_fused_main).
+
+
+    Parameters
+    ----------
+    verts, faces, normals : np.array
+        the outputs of marching cubes
+    simplify : SimplifySettings object, optional
+        How to smooth and simplify the mesh. The arrays are returned unchanged if None
+    precision : str
+        One of numeric_precision.PRECISIONS, the precision of the simplified arrays (Open3D simplifies in double precision)
+
+    Returns
+    -------
+    verts, faces, normals : np.array
+        the vertices, triangles and vertex normals of the simplified mesh
+    """
+    if simplify is None:
+        return verts, faces, normals
+    mesh = smooth_n_simplify(mesh_from_arrays(verts, faces, normals), simplify)
+    return (numeric_precision.compact_floats(mesh.vertices, precision), numeric_precision.compact_indices(mesh.triangles, precision), 
+            numeric_precision.compact_floats(mesh.vertex_normals, precision))
+
 class NiftiFile:
     """
     A class to store a filepath to a nifti file, and store the name for ease of use in the remaining code.
@@ -91,9 +319,63 @@ class NiftiFile:
         self.filepath = filepath;
         self.name = name;
 
-def s3_main(nifti_base_dir, mesh_base_dir, patient_IDs, observers, sides, contour_names, organ_name = "breast"):
+def build_mesh(nifti_path, mesh_path, level = 0.5, crop = True, simplify = None):
+    """
+    build_mesh : Converts one nifti file to a .ply mesh (read, mesh, smooth, write), and times each part. Exceptions are caught and returned, so that one failing file does not stop the other files. 
+
+
+    Parameters
+    ----------
+    nifti_path : filepath
+        The nifti file to be converted
+    mesh_path : filepath
+        The .ply file to write
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of the mask
+    simplify : SimplifySettings object, optional
+        How to smooth and simplify the mesh (see smooth_n_simplify)
+
+    Returns
+    -------
+    result : dict
+        number of voxels and vertices (before and after simplifying), read/mesh/write/total times in seconds, CPU time, peak memory (see run_metrics) and the error traceback (None if the conversion succeeded)
+    """
+    result = {'nifti': nifti_path, 'mesh': mesh_path, 'n_voxels': None, 'n_vertices': None, 'n_marching_cubes_vertices': None, 
+              'read_time_s': None, 'mesh_time_s': None, 'write_time_s': None, 'total_time_s': None, 'cpu_time_s': None, 'peak_rss_mb': None, 'error': None}
+    t_start = time.perf_counter()
+    timer = run_metrics.JobTimer()
+    try:
+        nii = sitk.ReadImage(nifti_path)
+        t_read = time.perf_counter()
+        verts, faces, normals, _ = mesh_arrays_from_image(nii, level, crop)
+        mesh = mesh_from_arrays(verts, faces, normals)
+        # smooth and simplify meshes
+        mesh = smooth_n_simplify(mesh, simplify)
+        t_mesh = time.perf_counter()
+        #save to .ply file (a failed write must not be recorded as a built mesh)
+        if not o3d.io.write_triangle_mesh(mesh_path, mesh):
+            raise IOError(f"could not write the mesh to {mesh_path}")
+        t_end = time.perf_counter()
+
+        result['n_voxels'] = int(np.prod(nii.GetSize()))
+        result['n_vertices'] = len(mesh.vertices)
+        result['n_marching_cubes_vertices'] = len(verts)
+        result['read_time_s'] = t_read - t_start
+        result['mesh_time_s'] = t_mesh - t_read
+        result['write_time_s'] = t_end - t_mesh
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['total_time_s'] = time.perf_counter() - t_start
+    metrics = timer.metrics()
+    result['cpu_time_s'] = metrics['cpu_time_s']
+    result['peak_rss_mb'] = metrics['peak_rss_mb']
+    return result
+
+def s3_main(nifti_base_dir, mesh_base_dir, patient_IDs, observers, sides, contour_names, organ_name = "breast", level = 0.5, cache = None, nifti_extension = ".nii", workers = 1, crop = True, run_log = None, simplify = None):
     """
-    Step 3 main function: Convert nifit files to .ply meshes by looping over patient number, organ laterality, and contour names. 
+    Step 3 main function: Convert nifit files to .ply meshes by looping over patient number, organ laterality, and contour names. Raises a FileNotFoundError if a patient's nifti directory is missing.
 
 
     Parameters
@@ -112,25 +394,41 @@ def s3_main(nifti_base_dir, mesh_base_dir, patient_IDs, observers, sides, contou
         The type of the organ contour. Example used here is "manual" contours and "altas-edited" contours, as we are do inter observer and inter-method analysis simultaneously. Used to select the contours to be included in the STAPLE algorithm, i.e. only uses "manual" contours to create the "manual breast STAPLE contour").
     organ_name : str
         The organ name which is featured in the name of the region of interest's nifti file.
+    level : float
+        The marching cubes iso-level used in load_n_mesh
+    cache : pipeline_cache.PipelineCache, optional
+        If given, meshes whose nifti file and meshing parameters are unchanged since they were made are skipped
+    nifti_extension : str
+        Extension of the observers' nifti files written in step 1 (".nii", or ".nii.gz" if step 1 was run with compress = True)
+    workers : int
+        Number of worker processes to build the meshes of all patients on in parallel
+    crop : bool
+        If True, meshes only the bounding box of each mask (see mesh_arrays_from_mask)
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every mesh (and of the whole step) are appended to this run log
+    simplify : SimplifySettings object, optional
+        If given, each mesh is smoothed and simplified before it is written (see smooth_n_simplify), i.e. SimplifySettings("clustering", max_error_mm = 0.5)
     
  
     Returns
     -------
-    None
+    results : list of dict
+        One entry per mesh built, with its vertex count, timings and error (if any) (see build_mesh)
     """
+    stage_timer = run_metrics.JobTimer()
+    # parameters which change the meshes, used by the cache to detect stale meshes
+    cache_params = {'level': level, 'smooth_n_simplify': simplify.params() if simplify is not None else 'none'}
+    # (patient, NiftiFile, mesh path) of every mesh to build, over all patients
+    tasks = []
     for patient in patient_IDs: 
         print("           Working with patient " + str(patient))
-        #set current directory (patient folder with nifti masks)
-        try:
-            os.chdir(os.path.join(nifti_base_dir, patient))
-        except:
-            print("step 3, line 85; could not find the nifti directory for the given patient")
-            exit();
+        # check the patient folder with nifti masks exists
+        if not os.path.isdir(os.path.join(nifti_base_dir, patient)):
+            raise FileNotFoundError(f"step 3: could not find the nifti directory for patient {patient} ({os.path.join(nifti_base_dir, patient)})")
         
-        # create folders to save meshes to 
+        # create folders to save meshes to (with mesh_base_dir, and without failing if another run creates them at the same time)
         output_dir = os.path.join(mesh_base_dir, patient)
-        if not os.path.isdir(output_dir):
-            os.mkdir(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
 
         ### read nifti files and store to array 
         nifti_files = [];
@@ -139,23 +437,52 @@ def s3_main(nifti_base_dir, mesh_base_dir, patient_IDs, observers, sides, contou
             # loop over contour names included in file name (here either "manual" or "atlas-edited")
             for contour in contour_names:
                 # STAPLE contour
-                nifti_files.append(NiftiFile(f"{side}_{organ_name}_{contour}_staple.nii" , f"{side}_{organ_name}_{contour}_staple"))
+                nifti_files.append(NiftiFile(os.path.join(nifti_base_dir, patient, f"{side}_{organ_name}_{contour}_staple.nii") , f"{side}_{organ_name}_{contour}_staple"))
             
                 # comparison contours 
                 for n in range(0,len(observers)):
-                    nifti_files.append(NiftiFile(f"{side}{observers[n]}{contour}.nii" , f"{side}_{contour}_{n+1}"))
+                    nifti_files.append(NiftiFile(os.path.join(nifti_base_dir, patient, f"{side}{observers[n]}{contour}{nifti_extension}") , f"{side}_{contour}_{n+1}"))
 
         print("finished reading nifti files")
         
-        #loop over nifti files and convert to meshes
         for example in nifti_files:
-            # convert to meshes and masks
-            mesh, mask = load_n_mesh(example.filepath) 
-            # smooth meshes
-            mesh = smooth_n_simplify(mesh)
-            #save to .ply file
-            o3d.io.write_triangle_mesh(os.path.join(output_dir, f"{example.name}.ply"), mesh)
-            print("Converted " + example.name)
+            mesh_path = os.path.join(output_dir, f"{example.name}.ply")
+            if cache is not None and cache.is_fresh("s3", f"{patient}/{example.name}", [example.filepath], cache_params, [mesh_path]):
+                print("Skipping " + example.name + ": mesh is up to date")
+                continue
+            tasks.append((patient, example, mesh_path))
 
-    print("Completed step 3: converted all .nii files to meshes. ")
+    #loop over nifti files and convert to meshes
+    def finish_mesh(patient, example, result):
+        if run_log is not None:
+            run_log.record("s3", f"{patient}/{example.name}", patient = patient, level = level, crop = crop, wall_time_s = result['total_time_s'], **result)
+        if result['error'] is not None:
+            print(f"Failed to convert {example.name}\n{result['error']}")
+            return
+        print(f"Converted {example.name}: {result['n_vertices']} vertices in {result['total_time_s']:.2f} s "
+              f"({result['n_voxels'] / result['total_time_s'] / 1e6:.1f} Mvoxels/s, {result['n_vertices'] / result['total_time_s']:.0f} vertices/s)")
+        if cache is not None:
+            cache.record("s3", f"{patient}/{example.name}", [example.filepath], cache_params, [result['mesh']], intermediate = True)
+
+    results = []
+    t_start = time.perf_counter()
+    if workers <= 1:
+        for patient, example, mesh_path in tasks:
+            results.append(build_mesh(example.filepath, mesh_path, level, crop, simplify))
+            finish_mesh(patient, example, results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(build_mesh, example.filepath, mesh_path, level, crop, simplify) for _, example, mesh_path in tasks]
+            for (patient, example, _), future in zip(tasks, futures):
+                results.append(future.result())
+                finish_mesh(patient, example, results[-1])
+    elapsed = time.perf_counter() - t_start
+    if run_log is not None:
+        run_log.record("s3", "all", n_jobs = len(results), n_failed = sum(result['error'] is not None for result in results), 
+                       workers = workers, **stage_timer.metrics())
 
+    n_done = sum(result['error'] is None for result in results)
+    if n_done > 0:
+        print(f"Meshed {n_done} of {len(results)} files in {elapsed:.1f} s ({n_done / elapsed:.2f} files/s)")
+    print("Completed step 3: converted all .nii files to meshes. ")
+    return results
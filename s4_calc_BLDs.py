@@ -1,8 +1,25 @@
 import numpy as np
 import open3d as o3d
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
 import pandas as pd
+import SimpleITK as sitk
+from scipy import ndimage
+import bld_store
+import run_metrics
+import numeric_precision
+import s3_nii_to_meshes
+import s5_calc_SDs
+import surface_query
+
+# how the BLDs are calculated from the nifti masks in s4_fused_main: "mesh" (marching cubes meshes, as steps 3 and 4) or "voxel" (distance transforms of the mask surfaces, see run_voxel_group)
+FUSED_BACKENDS = ["mesh", "voxel"]
+# how the nearest point on the other contour is found: "vertex" (nearest mesh vertex, KDTree) or "surface" (closest point on the mesh triangles, see surface_query)
+DISTANCE_MODES = ["vertex", "surface"]
 
 ##### CLASS DEFINITIONS 
 # class to definte the contours with mesh and name
@@ -26,14 +43,343 @@ class Contour:
         self.mesh = mesh;
         self.name = name;
 
+class MeshArrays:
+    """
+    A class to store the vertex (and optionally triangle) arrays of a mesh under the same attribute names as an Open3D TriangleMesh, so it can be stored in a Contour object without building an Open3D mesh
+    ...
+
+    Attributes
+    ----------
+    vertices : np.array (n, 3)
+        vertex coordinates of the mesh
+    triangles : np.array (m, 3) or None
+        vertex indices of each triangle of the mesh
+
+    Methods
+    -------
+    None
+    """
+    def __init__(self, vertices, triangles = None):
+        self.vertices = vertices;
+        self.triangles = triangles;
+
+class TreeSettings:
+    """
+    A class to store the build and query settings of the nearest neighbour lookup trees (scipy.spatial.cKDTree) used to calculate the BLDs
+    ...
+
+    Attributes
+    ----------
+    leafsize : int
+        number of points at which the tree switches to brute force search
+    balanced_tree : bool
+        if True, the tree is split at the median of the points (slower to build, can be faster to query); if False, at the midpoint of the bounding box
+    workers : int
+        number of threads each query is split over (-1 uses every core). With a process pool, keep workers * pool workers at or below the core count
+    distance_upper_bound : float or None
+        if given (in mm), each query first only searches within this distance, which prunes most of the tree when the contours agree closely. 
+        Points with no neighbour that close are queried again without the bound, so the distances are the same as without it
+
+    Methods
+    -------
+    build(points)
+        returns a lookup tree on points
+    query(tree, points)
+        returns the distance to, and the index of, the nearest neighbour in tree of each point
+    """
+    def __init__(self, leafsize = 16, balanced_tree = True, workers = 1, distance_upper_bound = None):
+        self.leafsize = leafsize
+        self.balanced_tree = balanced_tree
+        self.workers = workers
+        self.distance_upper_bound = distance_upper_bound
+
+    def build(self, points):
+        return cKDTree(points, leafsize = self.leafsize, balanced_tree = self.balanced_tree)
+
+    def query(self, tree, points):
+        if self.distance_upper_bound is None:
+            return tree.query(points, workers = self.workers)
+        dists, indices = tree.query(points, distance_upper_bound = self.distance_upper_bound, workers = self.workers)
+        # points beyond the bound come back with an infinite distance (and index len(tree.data)), so look those up again without the bound
+        beyond = np.flatnonzero(np.isinf(dists))
+        if len(beyond) > 0:
+            dists[beyond], indices[beyond] = tree.query(points[beyond], workers = self.workers)
+        return dists, indices
+
+class BLDJob:
+    """
+    A class to store one (patient, side, contour set, observer) comparison to be run by run_bld_job, with absolute paths to its inputs and outputs
+    ...
+
+    Attributes
+    ----------
+    patient : str
+        patient number
+    side : str
+        laterality of the contour (i.e. "left")
+    contour : str
+        contour set (i.e. "manual")
+    observer : int
+        observer number of the comparison contour
+    ref_mesh_path : filepath
+        absolute path to the reference (STAPLE) .ply mesh
+    ref_name : str
+        name of the reference contour
+    comparison_mesh_path : filepath
+        absolute path to the comparison .ply mesh
+    comparison_name : str
+        name of the comparison contour
+    output_dir : filepath
+        the patient's directory to store the bilateral distance files
+    output_format : str
+        format of the slimmed down BLD output (see bld_store.BLD_FORMATS)
+    write_full_csv : bool
+        if True, also writes the full nearest neighbour tables as CSV files
+    distance_mode : str
+        "vertex" or "surface" (see bidir_distances)
+    tree_settings : TreeSettings object or None
+        build and query settings of the lookup trees (defaults if None)
+    precision : str
+        precision of the vertices and distances in memory, one of numeric_precision.PRECISIONS
+
+    Methods
+    -------
+    None
+    """
+    def __init__(self, patient, side, contour, observer, ref_mesh_path, ref_name, comparison_mesh_path, comparison_name, output_dir, output_format = "pickle", write_full_csv = False, distance_mode = "vertex", tree_settings = None, precision = "float64"):
+        self.patient = patient
+        self.side = side
+        self.contour = contour
+        self.observer = observer
+        self.ref_mesh_path = ref_mesh_path
+        self.ref_name = ref_name
+        self.comparison_mesh_path = comparison_mesh_path
+        self.comparison_name = comparison_name
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.write_full_csv = write_full_csv
+        self.distance_mode = distance_mode
+        self.tree_settings = tree_settings
+        self.precision = precision
+
+class ReferenceIndex:
+    """
+    A class to store the vertices and nearest neighbour lookup tree of a reference contour, so that the tree is built once and shared by every comparison contour measured against it
+    ...
+
+    Attributes
+    ----------
+    name : str
+        name of the reference contour
+    vertices : np.array (n, 3)
+        vertices of the reference contour mesh (float32 for the "float32" precision)
+    vertex_hash : str
+        hash of the vertices as given, before they are made compact (see bld_store.reference_hash), recorded with every table aligned to them. It is the hash of the mesh file's vertices, which step 7 checks the summaries against
+    lookup_tree : scipy.spatial.cKDTree
+        nearest neighbour lookup tree built on vertices
+    triangles : np.array (m, 3) or None
+        vertex indices of each triangle of the reference contour mesh (needed for the "surface" distance mode)
+    surface : surface_query.SurfaceIndex or None
+        closest point lookup on the triangles, built the first time surface_index() is called
+    tree_settings : TreeSettings object
+        build and query settings of the lookup trees
+    precision : str
+        precision of the vertices and of the distances measured to them, one of numeric_precision.PRECISIONS
+    cache_results : bool
+        if True, the outputs of compute_bidir_distances are stored per comparison contour name in results
+    results : dict
+        outputs of compute_bidir_distances keyed by the comparison contour name (only filled if cache_results is True)
+
+    Methods
+    -------
+    surface_index()
+        returns the closest point lookup on the reference triangles, building it on the first call
+    get_result(comparison_name)
+        returns the cached outputs for comparison_name, or None
+    store_result(comparison_name, result)
+        caches the outputs for comparison_name (if cache_results is True)
+    """
+    def __init__(self, contour, cache_results = False, tree_settings = None, precision = "float64", vertex_hash = None):
+        self.name = contour.name;
+        self.precision = numeric_precision.check_precision(precision)
+        vertices = np.asarray(contour.mesh.vertices)
+        self.vertex_hash = vertex_hash if vertex_hash is not None else bld_store.reference_hash(vertices)
+        self.vertices = numeric_precision.compact_floats(vertices, precision)
+        self.tree_settings = tree_settings if tree_settings is not None else TreeSettings()
+        self.lookup_tree = self.tree_settings.build(self.vertices)
+        triangles = getattr(contour.mesh, "triangles", None)
+        self.triangles = numeric_precision.compact_indices(triangles, precision) if triangles is not None else None
+        self.surface = None
+        self.cache_results = cache_results
+        self.results = {}
+
+    def surface_index(self):
+        if self.surface is None:
+            if self.triangles is None or len(self.triangles) == 0:
+                raise ValueError(f"the reference contour {self.name} has no triangles to measure surface distances to")
+            self.surface = surface_query.SurfaceIndex(self.vertices, self.triangles)
+        return self.surface
+
+    def get_result(self, comparison_name):
+        return self.results.get(comparison_name)
+
+    def store_result(self, comparison_name, result):
+        if self.cache_results:
+            self.results[comparison_name] = result
+
 ##### FUNCTION DEFINITIONS 
+#function to return the nearest neighbour and bidirectional distances as arrays
+def compute_bidir_distances(verts_a, verts_b, lookup_tree_a = None, tree_settings = None, precision = "float64"):
+    """
+    compute_bidir_distances : Calculates the nearest neighbour distances between two vertex arrays in both directions, and the bidirectional local distance at each vertex of verts_a. 
+    The bidirectional local distance at vertex_i on verts_a is the maximum of its own nearest neighbour distance to verts_b and the distances of all vertices on verts_b which have vertex_i as their nearest neighbour (scatter-max over targets_on_a_index).
+
+
+    Parameters
+    ----------
+    verts_a : np.array (n_a, 3)
+        Vertices of the reference contour (here, the STAPLE contour)
+    verts_b : np.array (n_b, 3)
+        Vertices of the comparison contour
+    lookup_tree_a : scipy.spatial.cKDTree, optional
+        Prebuilt lookup tree on verts_a (i.e. from a ReferenceIndex), reused instead of building a new one
+    tree_settings : TreeSettings object, optional
+        Build and query settings of the lookup trees (threads, distance upper bound, leaf size). Defaults if None
+    precision : str
+        One of numeric_precision.PRECISIONS ("float32" for float32 distances and int32 indices; the trees measure in double precision either way)
+    
+    Returns
+    -------
+    dists_a : np.array (n_a,)
+        distance from each vertex on verts_a to its nearest neighbour on verts_b
+    targets_on_b_index : np.array (n_a,)
+        index of the nearest neighbour on verts_b for each vertex on verts_a
+    dists_b : np.array (n_b,)
+        distance from each vertex on verts_b to its nearest neighbour on verts_a
+    targets_on_a_index : np.array (n_b,)
+        index of the nearest neighbour on verts_a for each vertex on verts_b
+    bidir : np.array (n_a,)
+        bidirectional local distance at each vertex on verts_a
+    """
+    if tree_settings is None:
+        tree_settings = TreeSettings()
+    # Creates the look up tree for easy searching (the reference tree is only built if not supplied)
+    if lookup_tree_a is None:
+        lookup_tree_a = tree_settings.build(verts_a)
+    lookup_tree_b = tree_settings.build(verts_b)
+    # query lookup_tree_b for distances to verts_a, and the indices on mesh B which connects those points    
+    dists_a, targets_on_b_index = tree_settings.query(lookup_tree_b, verts_a)
+    # query lookup_tree_a for distances to verts_b, and the indices on mesh A which connects those points 
+    dists_b, targets_on_a_index = tree_settings.query(lookup_tree_a, verts_b)
+    dists_a, dists_b = numeric_precision.compact_floats(dists_a, precision), numeric_precision.compact_floats(dists_b, precision)
+    targets_on_b_index, targets_on_a_index = numeric_precision.compact_indices(targets_on_b_index, precision), numeric_precision.compact_indices(targets_on_a_index, precision)
+
+    ##### BIDIRECTIONAL DISTANCES CALCULATION 
+    # start from the a-to-b distances, then keep the largest b-to-a distance landing on each vertex of a
+    bidir = np.array(dists_a, copy=True)
+    np.maximum.at(bidir, targets_on_a_index, dists_b)
+
+    return dists_a, targets_on_b_index, dists_b, targets_on_a_index, bidir
+
+#function to return the point-to-surface and bidirectional distances as arrays
+def compute_bidir_surface_distances(verts_a, triangles_a, verts_b, triangles_b, surface_a = None, precision = "float64"):
+    """
+    compute_bidir_surface_distances : Calculates the distances from the vertices of each mesh to the closest point on the triangles of the other mesh, and the bidirectional local distance at each vertex of verts_a. 
+    Unlike compute_bidir_distances, the distances do not depend on where the vertices of the other mesh happen to lie, so coarser meshes give the same accuracy. 
+    Each vertex on verts_b is assigned to the corner of its closest triangle on mesh a nearest to its closest point, and the bidirectional local distance is the scatter-max over those vertices as in compute_bidir_distances.
+
+
+    Parameters
+    ----------
+    verts_a : np.array (n_a, 3)
+        Vertices of the reference contour (here, the STAPLE contour)
+    triangles_a : np.array (m_a, 3)
+        Triangles of the reference contour
+    verts_b : np.array (n_b, 3)
+        Vertices of the comparison contour
+    triangles_b : np.array (m_b, 3)
+        Triangles of the comparison contour
+    surface_a : surface_query.SurfaceIndex, optional
+        Prebuilt closest point lookup on mesh a (i.e. from a ReferenceIndex), reused instead of building a new one
+    precision : str
+        One of numeric_precision.PRECISIONS ("float32" for float32 distances and closest points and int32 indices; the closest points are found in double precision either way)
+    
+    Returns
+    -------
+    dists_a : np.array (n_a,)
+        distance from each vertex on verts_a to the surface of mesh b
+    closest_on_b : np.array (n_a, 3)
+        closest point on mesh b to each vertex on verts_a
+    dists_b : np.array (n_b,)
+        distance from each vertex on verts_b to the surface of mesh a
+    closest_on_a : np.array (n_b, 3)
+        closest point on mesh a to each vertex on verts_b
+    targets_on_a_index : np.array (n_b,)
+        index of the vertex on verts_a each vertex on verts_b is assigned to
+    bidir : np.array (n_a,)
+        bidirectional local distance at each vertex on verts_a
+    """
+    if surface_a is None:
+        surface_a = surface_query.SurfaceIndex(verts_a, triangles_a)
+    surface_b = surface_query.SurfaceIndex(verts_b, triangles_b)
+    # closest points on mesh b to the vertices of a, and on mesh a to the vertices of b (batched queries)
+    dists_a, closest_on_b, _ = surface_b.closest_points(verts_a)
+    dists_b, closest_on_a, triangles_on_a = surface_a.closest_points(verts_b)
+    targets_on_a_index = numeric_precision.compact_indices(surface_a.nearest_corner(closest_on_a, triangles_on_a), precision)
+    dists_a, dists_b = numeric_precision.compact_floats(dists_a, precision), numeric_precision.compact_floats(dists_b, precision)
+    closest_on_b, closest_on_a = numeric_precision.compact_floats(closest_on_b, precision), numeric_precision.compact_floats(closest_on_a, precision)
+
+    ##### BIDIRECTIONAL DISTANCES CALCULATION 
+    bidir = np.array(dists_a, copy=True)
+    np.maximum.at(bidir, targets_on_a_index, dists_b)
+
+    return dists_a, closest_on_b, dists_b, closest_on_a, targets_on_a_index, bidir
+
 #function to return the bidirectional distance at a point
-def bidir_distances(pt_bidir_df_dir, contour_a, contour_b):
+def reference_distances(reference_index, comparison_name, verts_b, triangles_b = None, distance_mode = "vertex"):
+    """
+    reference_distances : Calculates the one-sided and bidirectional local distances of one comparison contour against a reference contour held in a ReferenceIndex, without reading or writing any files.
+    The outputs are taken from (and stored in) the reference index's results if it caches them.
+
+
+    Parameters
+    ----------
+    reference_index : ReferenceIndex object
+        Vertices, triangles and lookup tree of the reference contour
+    comparison_name : str
+        Name of the comparison contour, which its cached outputs are stored under
+    verts_b : np.array (m, 3)
+        Vertices of the comparison contour mesh (made compact to the reference index's precision)
+    triangles_b : np.array (k, 3), optional
+        Vertex indices of each triangle of the comparison contour mesh (needed for the "surface" distance mode)
+    distance_mode : str
+        One of DISTANCE_MODES (see bidir_distances)
+
+    Returns
+    -------
+    result : tuple
+        the outputs of compute_bidir_distances ("vertex") or compute_bidir_surface_distances ("surface")
+    """
+    if distance_mode not in DISTANCE_MODES:
+        raise ValueError(f"distance_mode must be one of {DISTANCE_MODES}, not {distance_mode!r}")
+    result = reference_index.get_result(comparison_name)
+    if result is None:
+        verts_b = numeric_precision.compact_floats(verts_b, reference_index.precision)
+        if distance_mode == "surface":
+            result = compute_bidir_surface_distances(reference_index.vertices, reference_index.triangles, verts_b, np.asarray(triangles_b), 
+                                                     surface_a = reference_index.surface_index(), precision = reference_index.precision)
+        else:
+            result = compute_bidir_distances(reference_index.vertices, verts_b, lookup_tree_a = reference_index.lookup_tree, 
+                                             tree_settings = reference_index.tree_settings, precision = reference_index.precision)
+        reference_index.store_result(comparison_name, result)
+    return result
+
+def bidir_distances(pt_bidir_df_dir, contour_a, contour_b, reference_index = None, output_format = "pickle", write_full_csv = False, distance_mode = "vertex", tree_settings = None, precision = "float64"):
     """
     bidir_distances : Calculates the bidirectional local distance (https://aapm.onlinelibrary.wiley.com/doi/full/10.1118/1.4754802) between two contours. 
-    1) Calculates the nearest neighbour distance between contour_a and contour_b using KDTrees queries from scipy.spatial. Exports the coordinates of nearest neighbours and and the distances between them both on contour_a and contour_b to CSV files to check the outputs. 
-    2) For each point on the reference contour (contour_a), calculates the bidrectional local distance.  For a vertex_i on contour_a, if there is a vertex_x on contour_b which has vertex_i as its nearest neighbout, and it is further away than the current nearest neighbour to vertex_i, overwrite the nearest neighbout of vertex_i to this new vertex, vertex_x. This defines the bidirectional local distance. 
-    3) Writes the bidirectional local distances to a CSV file (for checking outputs) and a .pkl file (for use in later steps)
+    1) Calculates the nearest neighbour distance between contour_a and contour_b using cKDTree queries from scipy.spatial. Exports the coordinates of nearest neighbours and and the distances between them both on contour_a and contour_b to CSV files to check the outputs. 
+    2) For each point on the reference contour (contour_a), calculates the bidrectional local distance.  For a vertex_i on contour_a, if there are vertices on contour_b which have vertex_i as their nearest neighbour, and they are further away than the current nearest neighbour to vertex_i, the largest of these distances overwrites the distance at vertex_i. This defines the bidirectional local distance (see compute_bidir_distances). 
+    3) Writes the bidirectional local distances (and the one-sided distances to contour_b) on the reference contour in output_format (for use in later steps) as bare float32 columns in the order of the reference vertices, which are stored once per reference (see bld_store.write_reference). Also writes the one-sided distances from the vertices of contour_b to the reverse_BLD_DFs folder (for the surface metrics of step 6), and optionally the full nearest neighbour tables to CSV files (for checking outputs)
 
 
     Parameters
@@ -44,10 +390,23 @@ def bidir_distances(pt_bidir_df_dir, contour_a, contour_b):
         Reference contour (here, the STAPLE contour). A Contour object, which stores the triangulated mesh of the contour and the contour name
     contour_b : Contour object
         Comparison contour (i.e. the left, manual contour, generated by observer 5). A Contour object, which stores the triangulated mesh of the contour and the contour name
+    reference_index : ReferenceIndex object, optional
+        Vertices and lookup tree of contour_a, built once and shared across all comparison contours. If None, the lookup tree is built in this call
+    output_format : str
+        Format of the slimmed down BLD output, one of bld_store.BLD_FORMATS ("pickle", "csv", "npy" or "parquet")
+    write_full_csv : bool
+        If True, also writes the full a-to-b and b-to-a tables as CSV files to the full_BLD_dataframes folder
+    distance_mode : str
+        "vertex" measures the distance to the nearest vertex of the other mesh (compute_bidir_distances). "surface" measures the distance to the closest point on the other mesh's triangles (compute_bidir_surface_distances), which needs both meshes' triangles; the comparison/reference coordinates in the full tables are then the closest points on the surface
+    tree_settings : TreeSettings object, optional
+        Build and query settings of the lookup trees, used if reference_index is None (otherwise the reference index's settings are used)
+    precision : str
+        One of numeric_precision.PRECISIONS, used if reference_index is None (otherwise the reference index's precision is used). With "float32", the vertices and distances are held as float32 and the indices as int32, and the full tables are written with those dtypes
     
     Returns
     -------
-    None
+    vertex_hash : str
+        hash of the reference vertices the BLDs are aligned to (see bld_store.reference_hash)
     """
     
     ### https://aapm.onlinelibrary.wiley.com/doi/full/10.1118/1.4754802
@@ -65,95 +424,502 @@ def bidir_distances(pt_bidir_df_dir, contour_a, contour_b):
     original_index = 'original_index_on_reference'
     bidir_dis_on_a = 'bidir_distance_on_reference' # initially a copy of column_c_i, then overwritten in bidir step if needed. 
 
-    verts_a = np.asarray(contour_a.mesh.vertices)
-    verts_b = np.asarray(contour_b.mesh.vertices)
+    if distance_mode not in DISTANCE_MODES:
+        raise ValueError(f"distance_mode must be one of {DISTANCE_MODES}, not {distance_mode!r}")
+    if reference_index is not None:
+        precision = reference_index.precision
+    verts_b = numeric_precision.compact_floats(contour_b.mesh.vertices, precision)
 
-    ### Calculate the nearest neighbours for all vertices on contour_a to-and-from contour_b
-    # Creates the look up tree for easy searching
-    lookup_tree_a = KDTree(verts_a)
-    lookup_tree_b = KDTree(verts_b)
-    # query lookup_tree_b for distances to verts_a, and the indices on mesh B which connects those points    
-    dists_a, targets_on_b_index = lookup_tree_b.query(verts_a)
-    # query lookup_tree_a for distances to verts_b, and the indices on mesh A which connects those points 
-    dists_b, targets_on_a_index = lookup_tree_a.query(verts_b)
-
-    # write a_to_b dataframe
-    df_a_to_b = pd.DataFrame(columns=[column_a_X, column_a_Y, column_a_Z, 
-                                      column_b_X, column_b_Y, column_b_Z, 
-                                      column_c_i, original_index, bidir_dis_on_a])
-    for i in range(0, len(verts_a)):
-        # verts_a is a list of arrays with three components (i.e. verts_a[row][0] == x coordinate)
-        # to get the corrdinate of the connected point from reference (i.e. the vertex on b), find the index value on verts_b (targets_on_b_index[i]) then find the coordinates on lookup_tree_b.data corresponding to that index
-        # original_index is used in the bidirectional calculation in order to compare the two distances
-        new_row = {column_a_X : verts_a[i][0], 
-                   column_a_Y : verts_a[i][1], 
-                   column_a_Z : verts_a[i][2], 
-                   column_b_X : lookup_tree_b.data[targets_on_b_index[i]][0], 
-                   column_b_Y : lookup_tree_b.data[targets_on_b_index[i]][1], 
-                   column_b_Z : lookup_tree_b.data[targets_on_b_index[i]][2], 
-                   column_c_i : dists_a[i], 
-                   original_index: i, 
-                   bidir_dis_on_a: dists_a[i]}
-        df_a_to_b = df_a_to_b.append(new_row, ignore_index=True)
+    ### Calculate the nearest neighbours and the bidirectional local distances for all vertices on contour_a to-and-from contour_b
+    if reference_index is None:
+        verts_a = numeric_precision.compact_floats(contour_a.mesh.vertices, precision)
+        if distance_mode == "surface":
+            result = compute_bidir_surface_distances(verts_a, np.asarray(contour_a.mesh.triangles), verts_b, np.asarray(contour_b.mesh.triangles), precision = precision)
+        else:
+            result = compute_bidir_distances(verts_a, verts_b, tree_settings = tree_settings, precision = precision)
+    else:
+        verts_a = reference_index.vertices
+        result = reference_distances(reference_index, contour_b.name, verts_b, getattr(contour_b.mesh, "triangles", None), distance_mode)
 
-    # write b_to_a dataframe
-    df_b_to_a = pd.DataFrame(columns=[column_b_X, column_b_Y, column_b_Z, column_a_X, column_a_Y, column_a_Z, column_a_index, column_c_ii])
-    for i in range(0, len(verts_b)):
-        
-        new_row = {column_b_X : verts_b[i][0], 
-                   column_b_Y  : verts_b[i][1], 
-                   column_b_Z  : verts_b[i][2], 
-                   column_a_X : lookup_tree_a.data[targets_on_a_index[i]][0], 
-                   column_a_Y : lookup_tree_a.data[targets_on_a_index[i]][1], 
-                   column_a_Z : lookup_tree_a.data[targets_on_a_index[i]][2], 
-                   column_a_index: targets_on_a_index[i], 
-                   column_c_ii : dists_b[i]}
-        df_b_to_a = df_b_to_a.append(new_row, ignore_index=True)
+    # coordinates of the connected points on each contour
+    if distance_mode == "surface":
+        dists_a, targets_on_b, dists_b, targets_on_a, targets_on_a_index, bidir = result
+    else:
+        dists_a, targets_on_b_index, dists_b, targets_on_a_index, bidir = result
+        targets_on_b = verts_b[targets_on_b_index]
+        targets_on_a = verts_a[targets_on_a_index]
 
-    ##### BIDIRECTIONAL DISTANCES CALCULATION 
-    # find the column numbers for use in iloc 
-    bidir_col_no = df_a_to_b.columns.get_loc(bidir_dis_on_a)
-    c_i_col_no = df_a_to_b.columns.get_loc(column_c_i)
-    c_ii_col_no = df_b_to_a.columns.get_loc(column_c_ii)
-
-    # create bidir column, i.e. the max distance between the two distance arrays from both files, by overwriting bidir_dis_on_a (originally just the ref_to_b distances)
-    for target_idx, targ in enumerate(df_b_to_a[column_a_index]):
-        target = int(targ)
-        # match to corresponding point on mesh a
-        # check if target distance greater than distance of current resident on this vert on mesh a
-        if df_a_to_b.iloc[target, c_i_col_no] < df_b_to_a.iloc[target_idx, c_ii_col_no]:
-            # replace if its less (i.e save the bigger value, the max distance)
-            df_a_to_b.iloc[target, bidir_col_no] = df_b_to_a.iloc[target_idx, c_ii_col_no]
+    # write a_to_b dataframe (built column-wise from the query outputs)
+    # the coordinates of the connected point on b are the nearest vertex (vertex mode) or the closest point on the surface (surface mode)
+    # original_index is kept as a float column, as in the outputs of the previous row-by-row implementation (int32 for the "float32" precision)
+    index_dtype = np.int32 if precision == "float32" else np.float64
+    df_a_to_b = pd.DataFrame({column_a_X : verts_a[:, 0], 
+                              column_a_Y : verts_a[:, 1], 
+                              column_a_Z : verts_a[:, 2], 
+                              column_b_X : targets_on_b[:, 0], 
+                              column_b_Y : targets_on_b[:, 1], 
+                              column_b_Z : targets_on_b[:, 2], 
+                              column_c_i : dists_a, 
+                              original_index : np.arange(len(verts_a), dtype=index_dtype), 
+                              bidir_dis_on_a : bidir})
+
+    # write b_to_a dataframe
+    df_b_to_a = pd.DataFrame({column_b_X : verts_b[:, 0], 
+                              column_b_Y : verts_b[:, 1], 
+                              column_b_Z : verts_b[:, 2], 
+                              column_a_X : targets_on_a[:, 0], 
+                              column_a_Y : targets_on_a[:, 1], 
+                              column_a_Z : targets_on_a[:, 2], 
+                              column_a_index : targets_on_a_index.astype(index_dtype), 
+                              column_c_ii : dists_b})
     
     ### WRITING BLD OUTPUTS TO FILES 
-    # write full data frames as .csv files for checking the output of this step
-    csv_path =  os.path.join(pt_bidir_df_dir, "full_BLD_dataframes")
-    if not os.path.exists(csv_path):
-        os.makedirs(csv_path)
-    # a to b
-    print("Writing distances dataframe to file; " + contour_a.name +"_to_" + contour_b.name)
     a_to_b_fname = f"{contour_a.name}_to_{contour_b.name}"
-    df_a_to_b.to_csv(os.path.join(csv_path, f"{a_to_b_fname}.csv"))
-    # b to a
-    print("Writing distances dataframe to file; " + contour_b.name +"_to_" + contour_a.name)
     b_to_a_fname = f"{contour_b.name}_to_{contour_a.name}"
-    df_b_to_a.to_csv(os.path.join(csv_path, f"{b_to_a_fname}.csv"))
+    # write full data frames as .csv files for checking the output of this step (only if asked for, as formatting every float as text is slow for large meshes)
+    if write_full_csv:
+        csv_path =  os.path.join(pt_bidir_df_dir, "full_BLD_dataframes")
+        # exist_ok, as pool workers may create the folder at the same time
+        os.makedirs(csv_path, exist_ok=True)
+        # a to b
+        print("Writing distances dataframe to file; " + a_to_b_fname)
+        df_a_to_b.to_csv(os.path.join(csv_path, f"{a_to_b_fname}.csv"))
+        # b to a
+        print("Writing distances dataframe to file; " + b_to_a_fname)
+        df_b_to_a.to_csv(os.path.join(csv_path, f"{b_to_a_fname}.csv"))
     
-    # slimmed down output (just the BLDs on the reference contour, no data for the points on contour b) 
-    temp = df_a_to_b[["reference_X", "reference_Y", "reference_Z", "bidir_distance_on_reference"]]
-    # save the slimmed down pkl files
+    # slimmed down output (just the BLDs and one-sided distances on the reference contour, no data for the points on contour b). 
+    # The rows are in the order of the reference vertices, which are stored once for all the comparisons instead of in every table
     slimmed_path = os.path.join(pt_bidir_df_dir, "just_BLD_DFs") 
-    if not os.path.exists(slimmed_path):
-        os.makedirs(slimmed_path)
-    temp.to_pickle(os.path.join(slimmed_path, f"{a_to_b_fname}.pkl"))
+    vertex_hash = bld_store.write_reference(slimmed_path, contour_a.name, verts_a, reference_index.vertex_hash if reference_index is not None else bld_store.reference_hash(contour_a.mesh.vertices))
+    temp = pd.DataFrame({bidir_dis_on_a : bidir.astype(np.float32), 
+                         column_c_i : dists_a.astype(np.float32)})
+    # save the slimmed down files in the chosen format (see bld_store)
+    print("Writing BLDs to file; " + a_to_b_fname)
+    bld_store.write_bld_table(slimmed_path, a_to_b_fname, temp, output_format, 
+                              metadata = {'reference': contour_a.name, 'comparison': contour_b.name, 'reference_hash': vertex_hash})
+    # the distances from the vertices of contour b, for the symmetric surface metrics of step 6 (see surface_metrics)
+    bld_store.write_bld_table(os.path.join(pt_bidir_df_dir, "reverse_BLD_DFs"), a_to_b_fname, pd.DataFrame({column_c_ii : dists_b.astype(np.float32)}), output_format, 
+                              metadata = {'reference': contour_a.name, 'comparison': contour_b.name})
+    return vertex_hash
+
+# reference index held by a pool worker process, attached to the shared memory blocks of the reference vertices (and triangles): (shared memory name, list of SharedMemory, ReferenceIndex)
+_worker_reference = None
+
+def _attach_shared_reference(shared_ref, tree_settings = None, precision = "float64"):
+    """
+    Returns the ReferenceIndex for a reference contour whose vertices are stored in shared memory, building its lookup tree only the first time this worker process sees it. 
+
+
+    Parameters
+    ----------
+    shared_ref : tuple
+        (reference contour name, shared memory block name, vertex array shape, vertex array dtype string, triangles, vertex hash), as created in s4_main. triangles is None, or (shared memory block name, triangle array shape, triangle array dtype string) for the "surface" distance mode. 
+        The vertex hash is that of the mesh file's vertices (the shared vertices are already compact for the "float32" precision)
+    tree_settings : TreeSettings object, optional
+        Build and query settings of the reference lookup tree
+    precision : str
+        One of numeric_precision.PRECISIONS
+    
+    Returns
+    -------
+    ref_index : ReferenceIndex object
+    """
+    global _worker_reference
+    ref_name, shm_name, shape, dtype, shared_triangles, vertex_hash = shared_ref
+    if _worker_reference is not None and _worker_reference[0] == shm_name:
+        return _worker_reference[2]
+
+    # release the previous reference before attaching to the next one
+    if _worker_reference is not None:
+        old_shms = _worker_reference[1]
+        _worker_reference = None
+        for old_shm in old_shms:
+            try:
+                old_shm.close()
+            except BufferError:
+                pass
+
+    shms = [shared_memory.SharedMemory(name=shm_name)]
+    verts = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shms[0].buf)
+    triangles = None
+    if shared_triangles is not None:
+        tri_shm_name, tri_shape, tri_dtype = shared_triangles
+        shms.append(shared_memory.SharedMemory(name=tri_shm_name))
+        triangles = np.ndarray(tri_shape, dtype=np.dtype(tri_dtype), buffer=shms[1].buf)
+    ref_index = ReferenceIndex(Contour(MeshArrays(verts, triangles), ref_name), tree_settings = tree_settings, precision = precision, vertex_hash = vertex_hash)
+    _worker_reference = (shm_name, shms, ref_index)
+    return ref_index
+
+def _share_array(array, shared_blocks):
+    # copies an array into a new shared memory block (kept in shared_blocks to be unlinked by the caller), returning (block name, shape, dtype string)
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_blocks.append(shm)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return (shm.name, array.shape, array.dtype.str)
+
+def _read_mesh_vertices(mesh_path):
+    # Open3D only warns on a missing or unreadable file, so raise here to record the failure against the job
+    mesh = o3d.io.read_triangle_mesh(mesh_path)
+    if not mesh.has_vertices():
+        raise FileNotFoundError(f"could not read a mesh with vertices from {mesh_path}")
+    return mesh
+
+def _new_job_result(job):
+    return {'patient': job.patient, 
+            'side': job.side, 
+            'contour': job.contour, 
+            'observer': job.observer, 
+            'reference': job.ref_name, 
+            'comparison': job.comparison_name, 
+            'n_reference_vertices': None, 
+            'n_comparison_vertices': None, 
+            'load_time_s': None, 
+            'bld_time_s': None, 
+            'total_time_s': None, 
+            'cpu_time_s': None, 
+            'peak_rss_mb': None, 
+            'reference_hash': None, 
+            'cached': False, 
+            'error': None}
+
+def run_bld_job(job, reference):
+    """
+    run_bld_job : Runs bidir_distances for one BLDJob and records its timing. Exceptions are caught and returned in the result, so that one failing pair does not stop the other jobs. 
+
 
-    # save the slimmed_down CSVs to another folder
-    slimmed_csv_path = os.path.join(slimmed_path, "just_BLD_DFs_CSVs")
-    if not os.path.exists(slimmed_csv_path):
-        os.makedirs(slimmed_csv_path)
-    temp.to_csv(os.path.join(slimmed_csv_path, f"{a_to_b_fname}.csv"))
+    Parameters
+    ----------
+    job : BLDJob object
+        The comparison to run
+    reference : ReferenceIndex object or tuple
+        The reference index of the job's reference contour, or the description of its vertices in shared memory (see _attach_shared_reference)
+    
+    Returns
+    -------
+    result : dict
+        patient, side, contour, observer, reference and comparison names, vertex counts, load/BLD/total times in seconds, CPU time, peak memory (see run_metrics), the hash of the reference vertices and the error traceback (None if the job succeeded)
+    """
+    result = _new_job_result(job)
+    t_start = time.perf_counter()
+    timer = run_metrics.JobTimer()
+    try:
+        if not isinstance(reference, ReferenceIndex):
+            reference = _attach_shared_reference(reference, job.tree_settings, job.precision)
+        contour_b = Contour(_read_mesh_vertices(job.comparison_mesh_path), job.comparison_name)
+        t_loaded = time.perf_counter()
+        contour_a = Contour(MeshArrays(reference.vertices, reference.triangles), reference.name)
+        result['reference_hash'] = bidir_distances(job.output_dir, contour_a = contour_a, contour_b = contour_b, reference_index = reference, 
+                                                   output_format = job.output_format, write_full_csv = job.write_full_csv, distance_mode = job.distance_mode)
+        t_end = time.perf_counter()
+
+        result['n_reference_vertices'] = len(reference.vertices)
+        result['n_comparison_vertices'] = len(contour_b.mesh.vertices)
+        result['load_time_s'] = t_loaded - t_start
+        result['bld_time_s'] = t_end - t_loaded
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['total_time_s'] = time.perf_counter() - t_start
+    metrics = timer.metrics()
+    result['cpu_time_s'] = metrics['cpu_time_s']
+    result['peak_rss_mb'] = metrics['peak_rss_mb']
+    return result
 
-def s4_main(mesh_base_dir, bld_dfs_dir, patient_IDs, observers, sides, contours, organ_name = "breast"):
+def _job_cache_name(job):
+    return f"{job.patient}/{job.ref_name}_to_{job.comparison_name}"
+
+def _job_outputs(job, summary_at_pts_dir = None):
+    # files written by bidir_distances for this job (and the point summary accumulator the job's BLDs are added to, if step 4 keeps one)
+    a_to_b_fname = f"{job.ref_name}_to_{job.comparison_name}"
+    outputs = [bld_store.bld_path(os.path.join(job.output_dir, "just_BLD_DFs"), a_to_b_fname, job.output_format), 
+               bld_store.bld_path(os.path.join(job.output_dir, "reverse_BLD_DFs"), a_to_b_fname, job.output_format)]
+    if job.write_full_csv:
+        outputs.append(os.path.join(job.output_dir, "full_BLD_dataframes", f"{a_to_b_fname}.csv"))
+        outputs.append(os.path.join(job.output_dir, "full_BLD_dataframes", f"{job.comparison_name}_to_{job.ref_name}.csv"))
+    if summary_at_pts_dir is not None:
+        outputs.append(s5_calc_SDs.accumulator_path(os.path.join(summary_at_pts_dir, job.patient), job.contour, job.side))
+    return outputs
+
+def _discard_stale_summary(summary_at_pts_dir, patient, side, contour, cache, pending):
+    # a comparison of the reference is not up to date, so its saved accumulator is deleted and rebuilt from the tables of this run (the cached comparisons are added back as they are finished)
+    if summary_at_pts_dir is not None and cache is not None and len(pending) > 0:
+        s5_calc_SDs.discard_accumulator(os.path.join(summary_at_pts_dir, patient), contour, side)
+
+def _index_entry(result, output_format):
+    # the index entry of a finished comparison's table (see bld_store.read_bld_index)
+    entry = {'name': f"{result['reference']}_to_{result['comparison']}", 'format': output_format, 
+             'patient': result['patient'], 'side': result['side'], 'contour': result['contour'], 
+             'observer': result['observer'], 'reference': result['reference'], 'comparison': result['comparison']}
+    # cached jobs keep the reference hash recorded when they were run
+    if result['reference_hash'] is not None:
+        entry['reference_hash'] = result['reference_hash']
+    return entry
+
+def _update_point_summary(summaries, result, bld_dfs_dir, summary_at_pts_dir, output_format, precision = "float64"):
+    """
+    Adds the BLDs of a finished comparison to the PointSummaryAccumulator of its (patient, side, contour set), creating it (or loading it from a previous run) the first time the reference is seen. 
+    If the comparison was added by a previous run with different BLDs, the accumulator is rebuilt from the tables (see s5_calc_SDs.rebuild_accumulator). 
+    A table written by this run is indexed first, so that it is checked against the reference mesh it was written on.
+    """
+    key = (result['patient'], result['side'], result['contour'])
+    slimmed_path = os.path.join(bld_dfs_dir, result['patient'], "just_BLD_DFs")
+    table_name = f"{result['reference']}_to_{result['comparison']}"
+    # the table was just written, so its index entry is updated now (not only at the end of the step): the index would still hold the hash of the previous reference mesh if it changed
+    if not result['cached']:
+        bld_store.update_bld_index(slimmed_path, [_index_entry(result, output_format)])
+    if key not in summaries:
+        output_dir = os.path.join(summary_at_pts_dir, result['patient'])
+        os.makedirs(output_dir, exist_ok=True)
+        vertices, vertex_hash = bld_store.read_table_reference(slimmed_path, table_name, output_format)
+        accumulator = s5_calc_SDs.open_accumulator(output_dir, result['contour'], result['side'], len(vertices), vertex_hash)
+        summaries[key] = (accumulator, s5_calc_SDs.reference_frame(vertices, precision), output_dir)
+    accumulator = summaries[key][0]
+    if result['reference_hash'] is not None and result['reference_hash'] != accumulator.reference_hash:
+        raise ValueError(f"{table_name} is on a different {result['reference']} mesh than the other comparisons (hash {result['reference_hash']}, not {accumulator.reference_hash})")
+    bld = bld_store.read_bld_column(slimmed_path, table_name, "bidir_distance_on_reference", output_format)
+    # a comparison whose table was rewritten since it was added (i.e. a re-contoured observer) replaces its old values, by rebuilding the accumulator from the tables
+    if accumulator.changed(result['comparison'], bld):
+        print(f"{result['comparison']} changed since it was added to the {result['contour']} {result['side']} accumulator, rebuilding it from the tables")
+        accumulator = s5_calc_SDs.rebuild_accumulator(accumulator, slimmed_path, result['reference'], output_format)
+        summaries[key] = (accumulator,) + summaries[key][1:]
+    accumulator.update(result['comparison'], bld)
+
+def _finish_step(results, summaries, bld_dfs_dir, output_format, run_log = None, stage_timer = None, workers = 1, precision = "float64"):
+    # write the accumulated point summaries, index the BLD tables, report the failed comparisons and log the metrics of the whole step
+    for (patient, side, contour), (accumulator, reference_df, output_dir) in summaries.items():
+        s5_calc_SDs.write_accumulated_summary(accumulator, reference_df, output_dir, contour, side, precision = precision)
+
+    # record what each table compares, so step 6 does not need to parse the table names
+    index_entries = {}
+    for result in results:
+        if result['error'] is None:
+            index_entries.setdefault(result['patient'], []).append(_index_entry(result, output_format))
+    for patient, entries in index_entries.items():
+        bld_store.update_bld_index(os.path.join(bld_dfs_dir, patient, "just_BLD_DFs"), entries)
+
+    failures = [result for result in results if result['error'] is not None]
+    if run_log is not None:
+        run_log.record("s4", "all", n_jobs = len(results), n_failed = len(failures), n_cached = sum(result['cached'] for result in results), 
+                       workers = workers, **stage_timer.metrics())
+    for result in failures:
+        print(f"Failed: {result['reference']} vs {result['comparison']}\n{result['error']}")
+    print(f"Completed step 4: calculate BLDs. ({len(results) - len(failures)} of {len(results)} comparisons succeeded)")
+
+def run_fused_group(jobs, ref_nifti_path, comparison_nifti_paths, level = 0.5, crop = True, write_meshes = False, simplify = None):
+    """
+    run_fused_group : Runs the BLD jobs of one reference contour straight from the nifti masks, passing the marching cubes vertex arrays to the BLD calculation in memory instead of writing .ply files in step 3 and reading them back here. 
+    If write_meshes is True, the meshes are also written to the jobs' mesh paths (as step 3 would), in a background thread so that the writes overlap the BLD calculations.
+
+
+    Parameters
+    ----------
+    jobs : array of BLDJob objects
+        The comparisons against one reference contour. Their mesh paths are only used if write_meshes is True
+    ref_nifti_path : filepath
+        The nifti file of the reference (STAPLE) contour
+    comparison_nifti_paths : array of filepath
+        The nifti file of each job's comparison contour
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of each mask (see s3_nii_to_meshes.mesh_arrays_from_mask)
+    write_meshes : bool
+        If True, also writes the .ply meshes
+    simplify : s3_nii_to_meshes.SimplifySettings object, optional
+        If given, the meshes are smoothed and simplified (as step 3 would) before the BLDs are calculated and the meshes written
+    
+    Returns
+    -------
+    results : list of dict
+        One entry per job (see run_bld_job). If a mesh could not be written, the traceback is stored as the job's error
+    """
+    results = [_new_job_result(job) for job in jobs]
+    writer = ThreadPoolExecutor(max_workers=1) if write_meshes else None
+    # (job numbers, future) of the background mesh writes; a failed reference write fails every job
+    writes = []
+    try:
+        t_start = time.perf_counter()
+        try:
+            verts, faces, normals, _ = s3_nii_to_meshes.mesh_arrays_from_image(sitk.ReadImage(ref_nifti_path), level, crop, jobs[0].precision)
+            if len(verts) == 0:
+                raise ValueError(f"no surface found in {ref_nifti_path}")
+            verts, faces, normals = s3_nii_to_meshes.simplify_mesh_arrays(verts, faces, normals, simplify, jobs[0].precision)
+            if writer is not None:
+                writes.append((range(len(jobs)), writer.submit(s3_nii_to_meshes.write_mesh_arrays, jobs[0].ref_mesh_path, verts, faces, normals)))
+            # build the reference lookup tree once, and share it across all observers compared to this reference contour
+            # (the meshes written are the compact ones for the "float32" precision, so the hash matches the mesh files)
+            reference = ReferenceIndex(Contour(MeshArrays(verts, faces), jobs[0].ref_name), tree_settings = jobs[0].tree_settings, precision = jobs[0].precision)
+        except Exception:
+            error = traceback.format_exc()
+            for result in results:
+                result['error'] = error
+            return results
+        ref_load_time = time.perf_counter() - t_start
+
+        for job_no, (job, nifti_path) in enumerate(zip(jobs, comparison_nifti_paths)):
+            result = results[job_no]
+            print(job.ref_name, ' vs ', job.comparison_name)
+            t_start = time.perf_counter()
+            timer = run_metrics.JobTimer()
+            try:
+                verts, faces, normals, _ = s3_nii_to_meshes.mesh_arrays_from_image(sitk.ReadImage(nifti_path), level, crop, job.precision)
+                if len(verts) == 0:
+                    raise ValueError(f"no surface found in {nifti_path}")
+                verts, faces, normals = s3_nii_to_meshes.simplify_mesh_arrays(verts, faces, normals, simplify, job.precision)
+                if writer is not None:
+                    writes.append(([job_no], writer.submit(s3_nii_to_meshes.write_mesh_arrays, job.comparison_mesh_path, verts, faces, normals)))
+                contour_b = Contour(MeshArrays(verts, faces), job.comparison_name)
+                t_loaded = time.perf_counter()
+                contour_a = Contour(MeshArrays(reference.vertices, reference.triangles), reference.name)
+                result['reference_hash'] = bidir_distances(job.output_dir, contour_a = contour_a, contour_b = contour_b, reference_index = reference, 
+                                                           output_format = job.output_format, write_full_csv = job.write_full_csv, distance_mode = job.distance_mode)
+                t_end = time.perf_counter()
+
+                result['n_reference_vertices'] = len(reference.vertices)
+                result['n_comparison_vertices'] = len(verts)
+                # the reference meshing time is counted against the first job
+                result['load_time_s'] = t_loaded - t_start + (ref_load_time if job_no == 0 else 0.0)
+                result['bld_time_s'] = t_end - t_loaded
+            except Exception:
+                result['error'] = traceback.format_exc()
+            result['total_time_s'] = time.perf_counter() - t_start
+            metrics = timer.metrics()
+            result['cpu_time_s'] = metrics['cpu_time_s']
+            result['peak_rss_mb'] = metrics['peak_rss_mb']
+    finally:
+        if writer is not None:
+            writer.shutdown(wait=True)
+            for job_nos, future in writes:
+                if future.exception() is not None:
+                    error = "".join(traceback.format_exception(future.exception()))
+                    for job_no in job_nos:
+                        if results[job_no]['error'] is None:
+                            results[job_no]['error'] = error
+    return results
+
+def surface_voxels(mask):
+    # voxels of the mask with at least one face neighbour outside it (voxels on the edge of the array count as surface)
+    return mask & ~ndimage.binary_erosion(mask, border_value = 0)
+
+def _union_box(slices_a, slices_b):
+    # smallest box containing both boxes, and the index of its first voxel
+    box = tuple(slice(min(a.start, b.start), max(a.stop, b.stop)) for a, b in zip(slices_a, slices_b))
+    return box, np.array([s.start for s in box])
+
+def run_voxel_group(jobs, ref_nifti_path, comparison_nifti_paths, level = 0.5, crop = True, write_meshes = False, simplify = None):
+    """
+    run_voxel_group : Runs the BLD jobs of one reference contour in the voxel domain, without meshing the comparison contours. 
+    1) The surface voxels of the reference mask are found once, with a lookup tree on their coordinates. The reference mesh (marching cubes, as in step 3) is made once, and each of its vertices is assigned to its nearest reference surface voxel. 
+    2) For each comparison mask, a single Euclidean distance transform (scipy.ndimage.distance_transform_edt, with the voxel spacing) of its surface, on the union bounding box of the two masks, gives the distance from every reference surface voxel to the comparison surface. 
+       The distance from every comparison surface voxel to the reference surface (and the reference surface voxel it lands on) comes from the reference lookup tree, and the bidirectional local distance is the scatter-max as in compute_bidir_distances. 
+    3) The BLD of each reference mesh vertex is that of its reference surface voxel, written in the same table as bidir_distances so steps 5 to 7 are unchanged. 
+    Distances are measured between voxel centres, so they are quantised to the voxel grid; this is a fast screening path, not a replacement for the mesh distances.
+
+
+    Parameters
+    ----------
+    jobs : array of BLDJob objects
+        The comparisons against one reference contour. Only the reference mesh path is used, if write_meshes is True
+    ref_nifti_path : filepath
+        The nifti file of the reference (STAPLE) contour
+    comparison_nifti_paths : array of filepath
+        The nifti file of each job's comparison contour (on the same voxel grid as the reference)
+    level : float
+        The iso-level: voxels at or above it are inside the contour
+    crop : bool
+        If True, the distance transforms only cover the bounding box of the two masks
+    write_meshes : bool
+        If True, writes the reference mesh (the comparison contours are not meshed)
+    simplify : s3_nii_to_meshes.SimplifySettings object, optional
+        If given, the reference mesh is smoothed and simplified (as step 3 would), so the BLDs are written on its simplified vertices
+    
+    Returns
+    -------
+    results : list of dict
+        One entry per job (see run_bld_job), with the number of comparison surface voxels as n_comparison_vertices
+    """
+    results = [_new_job_result(job) for job in jobs]
+    t_start = time.perf_counter()
+    tree_settings = jobs[0].tree_settings if jobs[0].tree_settings is not None else TreeSettings()
+    precision = jobs[0].precision
+    try:
+        ref_nii = sitk.ReadImage(ref_nifti_path)
+        verts, faces, normals, ref_view = s3_nii_to_meshes.mesh_arrays_from_image(ref_nii, level, crop, precision)
+        if len(verts) == 0:
+            raise ValueError(f"no surface found in {ref_nifti_path}")
+        verts, faces, normals = s3_nii_to_meshes.simplify_mesh_arrays(verts, faces, normals, simplify, precision)
+        if write_meshes:
+            s3_nii_to_meshes.write_mesh_arrays(jobs[0].ref_mesh_path, verts, faces, normals)
+        _, spacing = s3_nii_to_meshes.mask_view_from_image(ref_nii)
+        full_volume = tuple(slice(0, n) for n in ref_view.shape)
+        ref_box, ref_offset = s3_nii_to_meshes.crop_to_mask(ref_view, level) if crop else (full_volume, np.zeros(3, dtype=int))
+        # reference surface voxels (indices in the whole volume), their lookup tree, and the surface voxel of each mesh vertex
+        ref_surface = np.argwhere(surface_voxels(ref_view[ref_box] >= level)) + ref_offset
+        ref_tree = tree_settings.build(ref_surface * spacing)
+        _, vertex_voxels = tree_settings.query(ref_tree, verts)
+        vertex_voxels = numeric_precision.compact_indices(vertex_voxels, precision)
+        vertex_hash = bld_store.reference_hash(verts)
+    except Exception:
+        error = traceback.format_exc()
+        for result in results:
+            result['error'] = error
+        return results
+    ref_load_time = time.perf_counter() - t_start
+
+    for job_no, (job, nifti_path) in enumerate(zip(jobs, comparison_nifti_paths)):
+        result = results[job_no]
+        print(job.ref_name, ' vs ', job.comparison_name, '(voxels)')
+        t_start = time.perf_counter()
+        timer = run_metrics.JobTimer()
+        try:
+            nii = sitk.ReadImage(nifti_path)
+            mask, _ = s3_nii_to_meshes.mask_view_from_image(nii)
+            if mask.shape != ref_view.shape:
+                raise ValueError(f"{nifti_path} is not on the voxel grid of {ref_nifti_path} ({mask.shape} vs {ref_view.shape})")
+            box, offset = _union_box(ref_box, s3_nii_to_meshes.crop_to_mask(mask, level)[0]) if crop else (full_volume, np.zeros(3, dtype=int))
+            comparison_surface = surface_voxels(mask[box] >= level)
+            if not comparison_surface.any():
+                raise ValueError(f"no surface found in {nifti_path}")
+            t_loaded = time.perf_counter()
+
+            # reference to comparison: the one distance transform of this comparison mask, sampled at the reference surface voxels
+            edt = ndimage.distance_transform_edt(~comparison_surface, sampling = spacing)
+            dists_a = numeric_precision.compact_floats(edt[tuple((ref_surface - offset).T)], precision)
+            # comparison to reference: nearest reference surface voxel of each comparison surface voxel
+            comparison_voxels = np.argwhere(comparison_surface) + offset
+            dists_b, targets_on_a_index = tree_settings.query(ref_tree, comparison_voxels * spacing)
+            dists_b, targets_on_a_index = numeric_precision.compact_floats(dists_b, precision), numeric_precision.compact_indices(targets_on_a_index, precision)
+            bidir = np.array(dists_a, copy=True)
+            np.maximum.at(bidir, targets_on_a_index, dists_b)
+
+            # slimmed down output on the reference mesh vertices, as written by bidir_distances
+            slimmed_path = os.path.join(job.output_dir, "just_BLD_DFs")
+            result['reference_hash'] = bld_store.write_reference(slimmed_path, job.ref_name, verts, vertex_hash)
+            temp = pd.DataFrame({'bidir_distance_on_reference': bidir[vertex_voxels].astype(np.float32), 
+                                 'distance from reference': dists_a[vertex_voxels].astype(np.float32)})
+            print("Writing BLDs to file; " + f"{job.ref_name}_to_{job.comparison_name}")
+            bld_store.write_bld_table(slimmed_path, f"{job.ref_name}_to_{job.comparison_name}", temp, job.output_format, 
+                                      metadata = {'reference': job.ref_name, 'comparison': job.comparison_name, 'backend': 'voxel', 'reference_hash': vertex_hash})
+            # the distances from the comparison surface voxels, for the symmetric surface metrics of step 6
+            bld_store.write_bld_table(os.path.join(job.output_dir, "reverse_BLD_DFs"), f"{job.ref_name}_to_{job.comparison_name}", pd.DataFrame({'distance from comparison': dists_b.astype(np.float32)}), job.output_format, 
+                                      metadata = {'reference': job.ref_name, 'comparison': job.comparison_name, 'backend': 'voxel'})
+            t_end = time.perf_counter()
+
+            result['n_reference_vertices'] = len(verts)
+            result['n_comparison_vertices'] = len(comparison_voxels)
+            # the reference meshing time is counted against the first job
+            result['load_time_s'] = t_loaded - t_start + (ref_load_time if job_no == 0 else 0.0)
+            result['bld_time_s'] = t_end - t_loaded
+        except Exception:
+            result['error'] = traceback.format_exc()
+        result['total_time_s'] = time.perf_counter() - t_start
+        metrics = timer.metrics()
+        result['cpu_time_s'] = metrics['cpu_time_s']
+        result['peak_rss_mb'] = metrics['peak_rss_mb']
+    return results
+
+def s4_main(mesh_base_dir, bld_dfs_dir, patient_IDs, observers, sides, contours, organ_name = "breast", workers = 1, output_format = "pickle", write_full_csv = False, summary_at_pts_dir = None, cache = None, run_log = None, distance_mode = "vertex", tree_settings = None, precision = "float64"):
     """
     Step 4 main function: Calculates bilateral distances between reference contour and every observer contour considered. 
 
@@ -174,49 +940,283 @@ def s4_main(mesh_base_dir, bld_dfs_dir, patient_IDs, observers, sides, contours,
         The type of the organ contour. Example used here is "manual" contours and "altas-edited" contours, as we are do inter observer and inter-method analysis simultaneously. Used to select the contours to be included in the STAPLE algorithm, i.e. only uses "manual" contours to create the "manual breast STAPLE contour").
     organ_name : str
         The organ name which is featured in the name of the region of interest's nifti file.
+    workers : int
+        Number of worker processes to run the (patient, side, contour set, observer) comparisons on. With workers > 1, each reference mesh is read once and its vertices are shared with the workers through shared memory. 
+    output_format : str
+        Format of the BLD files read by steps 5 and 6, one of bld_store.BLD_FORMATS ("pickle", "csv", "npy" or "parquet")
+    write_full_csv : bool
+        If True, also writes the full nearest neighbour tables of every pair as CSV files for checking the outputs
+    summary_at_pts_dir : filepath, optional
+        If given, the per-point mean and standard deviation (step 5) are accumulated as each comparison finishes (see s5_calc_SDs.PointSummaryAccumulator) and written to this base directory at the end of this step. The accumulator is one of each comparison's cached outputs, and is rebuilt from the tables if any comparison of its reference is not up to date
+    cache : pipeline_cache.PipelineCache, optional
+        If given, comparisons whose meshes and output settings are unchanged since their BLD files were written are skipped (returned with 'cached' set to True)
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every comparison (and of the whole step) are appended to this run log
+    distance_mode : str
+        "vertex" (nearest vertex) or "surface" (closest point on the other mesh's triangles, see bidir_distances). Surface distances do not depend on the mesh resolution, so coarser meshes can be used
+    tree_settings : TreeSettings object, optional
+        Build and query settings of the lookup trees (i.e. TreeSettings(workers = -1, distance_upper_bound = 20) to query on every core, searching within 20 mm first). 
+        workers and distance_upper_bound do not change the outputs. leafsize and balanced_tree can change which of several equidistant vertices is the nearest neighbour, so they are part of the cache key
+    precision : str
+        One of numeric_precision.PRECISIONS. "float32" holds the vertices (also in the shared memory of the workers) and distances as float32 and the indices as int32, for half the memory (see precision_report.precision_report for the change in the results)
     
  
     Returns
     -------
-    None
+    results : list of dict
+        One entry per comparison, in the order the jobs were created, with the timings, cache status and error (if any) of that job (see run_bld_job)
     """
-    # loop over patients' mesh files 
+    stage_timer = run_metrics.JobTimer()
+    ###### CREATE JOBS 
+    # one group of jobs per reference (STAPLE) mesh, all paths absolute so no change of working directory is needed
+    all_jobs = []
+    results = []
+    references = []
+    tree_settings = tree_settings if tree_settings is not None else TreeSettings()
+    numeric_precision.check_precision(precision)
+    cache_params = {'output_format': output_format, 'write_full_csv': write_full_csv, 'distance_mode': distance_mode, 
+                    'leafsize': tree_settings.leafsize, 'balanced_tree': tree_settings.balanced_tree, 'precision': precision}
     for patient in patient_IDs: 
-        print("           Working with patient " + str(patient))
         mesh_pt_dir = os.path.join(mesh_base_dir, patient)
-        if not os.path.exists(mesh_pt_dir):
-            os.mkdir(mesh_pt_dir)
-        os.chdir(mesh_pt_dir)
-        
-        # arrays to stores meshes in "pairs" (see zip in line 215), ready for looping
-        comparison_contour_array = []
-        ref_contour_array = []    
         
-        ###### LOAD IN MESHES 
+        # make folder to store BLD df for this patient 
+        pt_bidir_df_dir = os.path.join(bld_dfs_dir, patient)
+        os.makedirs(pt_bidir_df_dir, exist_ok=True)
+
         for side in sides:
             for contour in contours:
-                #staple mesh
-                staple_mesh = Contour(o3d.io.read_triangle_mesh(f"{side}_{organ_name}_{contour}_staple.ply")  , f"{side}_{contour}_staple")
-                ref_contour_array.append(staple_mesh)
-
-                #comparison contours
-                comparison_contours = []
+                ref_path = os.path.join(mesh_pt_dir, f"{side}_{organ_name}_{contour}_staple.ply")
+                ref_name = f"{side}_{contour}_staple"
+                pending = []
                 for n in range(0,len(observers)):
-                    comparison_contours.append(Contour(o3d.io.read_triangle_mesh(f"{side}_{contour}_{n+1}.ply"), f"{side}_{contour}_{n+1}"))
-                comparison_contour_array.append(comparison_contours)
-        
-        # make folder to store BLD df for this patient 
-        pt_bidir_df_dir = os.path.join(bld_dfs_dir, patient)
-        if not os.path.exists(pt_bidir_df_dir):
-            os.makedirs(pt_bidir_df_dir)
-        os.chdir(pt_bidir_df_dir)
-
-        # call function which calculates bidirectional distances     
-        for comparison_contours, ref_contour in zip(comparison_contour_array, ref_contour_array):
-            # loop over the multiple observer contours stored in comparison_contours ( the comparision contours to the 1 reference contour (here, the STAPLE contour))
-            for mesh_test in comparison_contours:
-                print(ref_contour.name, ' vs ', mesh_test.name )
-                #call function which generates bidir distance files
-                bidir_distances(pt_bidir_df_dir, contour_a = ref_contour, contour_b = mesh_test)
+                    job = BLDJob(patient, side, contour, n+1, ref_path, ref_name, 
+                                 os.path.join(mesh_pt_dir, f"{side}_{contour}_{n+1}.ply"), f"{side}_{contour}_{n+1}", pt_bidir_df_dir, 
+                                 output_format, write_full_csv, distance_mode, tree_settings, precision)
+                    all_jobs.append(job)
+                    results.append(None)
+                    if cache is not None and cache.is_fresh("s4", _job_cache_name(job), [job.ref_mesh_path, job.comparison_mesh_path], cache_params, _job_outputs(job, summary_at_pts_dir)):
+                        print(f"Skipping {ref_name} vs {job.comparison_name}: BLDs are up to date")
+                        results[-1] = _new_job_result(job)
+                        results[-1]['cached'] = True
+                    else:
+                        pending.append(len(all_jobs) - 1)
+                _discard_stale_summary(summary_at_pts_dir, patient, side, contour, cache, pending)
+                references.append((ref_path, ref_name, pending))
+
+    ###### RUN JOBS 
+    summaries = {}
+    def finish_job(job_no):
+        # record the outputs in the cache and add the BLDs to the running point summaries
+        result = results[job_no]
+        if run_log is not None:
+            run_log.record("s4", _job_cache_name(all_jobs[job_no]), wall_time_s = result['total_time_s'], **result)
+        if result['error'] is not None:
+            return
+        job = all_jobs[job_no]
+        if cache is not None and not result['cached']:
+            cache.record("s4", _job_cache_name(job), [job.ref_mesh_path, job.comparison_mesh_path], cache_params, _job_outputs(job, summary_at_pts_dir), intermediate = True)
+        if summary_at_pts_dir is not None:
+            _update_point_summary(summaries, result, bld_dfs_dir, summary_at_pts_dir, output_format, precision)
+
+    for job_no, result in enumerate(results):
+        if result is not None:
+            finish_job(job_no)
+
+    def fail_reference(pending):
+        error = traceback.format_exc()
+        for job_no in pending:
+            results[job_no] = _new_job_result(all_jobs[job_no])
+            results[job_no]['error'] = error
+            finish_job(job_no)
+
+    if workers <= 1:
+        for ref_path, ref_name, pending in references:
+            if len(pending) == 0:
+                continue
+            try:
+                # build the reference lookup tree once, and share it across all observers compared to this reference contour
+                ref_index = ReferenceIndex(Contour(_read_mesh_vertices(ref_path), ref_name), tree_settings = tree_settings, precision = precision)
+            except Exception:
+                fail_reference(pending)
+                continue
+            for job_no in pending:
+                print(ref_name, ' vs ', all_jobs[job_no].comparison_name)
+                results[job_no] = run_bld_job(all_jobs[job_no], ref_index)
+                finish_job(job_no)
+    else:
+        shared_blocks = []
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {}
+                for ref_path, ref_name, pending in references:
+                    if len(pending) == 0:
+                        continue
+                    try:
+                        ref_mesh = _read_mesh_vertices(ref_path)
+                    except Exception:
+                        fail_reference(pending)
+                        continue
+                    # copy the reference vertices (and triangles, for surface distances) into shared memory once, instead of pickling them for every job
+                    shared_triangles = _share_array(numeric_precision.compact_indices(ref_mesh.triangles, precision), shared_blocks) if distance_mode == "surface" else None
+                    ref_verts = np.asarray(ref_mesh.vertices)
+                    shared_ref = (ref_name, *_share_array(numeric_precision.compact_floats(ref_verts, precision), shared_blocks), shared_triangles, bld_store.reference_hash(ref_verts))
+                    for job_no in pending:
+                        futures[pool.submit(run_bld_job, all_jobs[job_no], shared_ref)] = job_no
+                
+                for future in as_completed(futures):
+                    result = future.result()
+                    print(result['reference'], ' vs ', result['comparison'])
+                    results[futures[future]] = result
+                    finish_job(futures[future])
+        finally:
+            for shm in shared_blocks:
+                shm.close()
+                shm.unlink()
+
+    _finish_step(results, summaries, bld_dfs_dir, output_format, run_log, stage_timer, workers, precision)
+    return results
+
+def s4_fused_main(nifti_base_dir, bld_dfs_dir, patient_IDs, observers, sides, contours, organ_name = "breast", mesh_base_dir = None, level = 0.5, crop = True, workers = 1, output_format = "pickle", write_full_csv = False, summary_at_pts_dir = None, cache = None, nifti_extension = ".nii", run_log = None, distance_mode = "vertex", tree_settings = None, backend = "mesh", simplify = None, precision = "float64"):
+    """
+    Steps 3 and 4 fused: Calculates bilateral distances between the reference contour and every observer contour straight from the nifti masks, passing the meshes from marching cubes to the BLD calculation in memory (see run_fused_group). 
+    Gives the same BLD files as running s3_main then s4_main, without writing and reading back the .ply meshes. The meshes are only written if mesh_base_dir is given (in a background thread). 
+    With backend = "voxel", the BLDs are instead calculated from distance transforms of the mask surfaces and mapped onto the reference mesh vertices (see run_voxel_group), a faster, mesh-free screening path whose distances are quantised to the voxel grid.
+
+
+    Parameters
+    ----------
+    nifti_base_dir : filepath
+        The filepath which is the base directory for all the patient directories which store patients' nifti files (from steps 1 and 2).
+    bld_dfs_dir : filepath
+        The filepath which is the base directory for all the patient directories which store the bilateral distance files, created in this step.
+    patient_IDs : array of str
+        The patient numbers, which are also the directory names for the directories in nifti_base_dir
+    observers : array of str
+        Array of strings which idicate the observer which generated the organ contour, as included in the nifti file names (i.e. "_breast_1_").
+    sides: array of str
+        The laterality of the organ contour (i.e. "left" and "right")
+    contours : array of str
+        The type of the organ contour (i.e. "manual" and "atlas_edited")
+    organ_name : str
+        The organ name which is featured in the name of the region of interest's nifti file.
+    mesh_base_dir : filepath, optional
+        If given, the .ply meshes are also written to the patient directories in this base directory, as step 3 would
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of each mask
+    workers : int
+        Number of worker processes to run the reference contours (each with all of its comparisons) on
+    output_format : str
+        Format of the BLD files read by steps 5 and 6, one of bld_store.BLD_FORMATS
+    write_full_csv : bool
+        If True, also writes the full nearest neighbour tables of every pair as CSV files for checking the outputs
+    summary_at_pts_dir : filepath, optional
+        If given, the per-point mean and standard deviation (step 5) are accumulated as each comparison finishes and written to this base directory at the end of this step. The accumulator is one of each comparison's cached outputs, and is rebuilt from the tables if any comparison of its reference is not up to date
+    cache : pipeline_cache.PipelineCache, optional
+        If given, comparisons whose nifti files and settings are unchanged since their BLD files were written are skipped (returned with 'cached' set to True)
+    nifti_extension : str
+        Extension of the observers' nifti files written in step 1
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every comparison (and of the whole step) are appended to this run log
+    distance_mode : str
+        "vertex" (nearest vertex) or "surface" (closest point on the other mesh's triangles, see bidir_distances)
+    tree_settings : TreeSettings object, optional
+        Build and query settings of the lookup trees (see s4_main)
+    backend : str
+        "mesh" to measure between marching cubes meshes (run_fused_group), or "voxel" to measure between mask surface voxels (run_voxel_group). The voxel backend ignores distance_mode, does not write the full CSV tables, and only writes the reference meshes to mesh_base_dir
+    simplify : s3_nii_to_meshes.SimplifySettings object, optional
+        If given, the meshes are smoothed and simplified as step 3 would (see s3_nii_to_meshes.smooth_n_simplify) before the BLDs are calculated
+    precision : str
+        One of numeric_precision.PRECISIONS. "float32" holds the mesh arrays and distances as float32 and the indices as int32 (see s4_main); the meshes written to mesh_base_dir then have the float32 vertices the BLDs were calculated on
     
-    print("Completed step 4: calculate BLDs. ")
\ No newline at end of file
+ 
+    Returns
+    -------
+    results : list of dict
+        One entry per comparison, in the order the jobs were created (see run_bld_job)
+    """
+    if backend not in FUSED_BACKENDS:
+        raise ValueError(f"backend must be one of {FUSED_BACKENDS}, not {backend!r}")
+    if backend == "voxel" and write_full_csv:
+        raise ValueError("the voxel backend does not write the full nearest neighbour tables, use write_full_csv = False")
+    stage_timer = run_metrics.JobTimer()
+    ###### CREATE JOBS 
+    all_jobs = []
+    results = []
+    # (job numbers, reference nifti, comparison niftis) of each reference contour with comparisons to run
+    groups = []
+    tree_settings = tree_settings if tree_settings is not None else TreeSettings()
+    numeric_precision.check_precision(precision)
+    cache_params = {'output_format': output_format, 'write_full_csv': write_full_csv, 'level': level, 'smooth_n_simplify': simplify.params() if simplify is not None else 'none', 'fused': True, 'distance_mode': distance_mode, 'backend': backend, 
+                    'leafsize': tree_settings.leafsize, 'balanced_tree': tree_settings.balanced_tree, 'precision': precision}
+    job_inputs = {}
+    for patient in patient_IDs: 
+        nifti_pt_dir = os.path.join(nifti_base_dir, patient)
+        mesh_pt_dir = os.path.join(mesh_base_dir if mesh_base_dir is not None else nifti_base_dir, patient)
+        if mesh_base_dir is not None:
+            os.makedirs(mesh_pt_dir, exist_ok=True)
+        pt_bidir_df_dir = os.path.join(bld_dfs_dir, patient)
+        os.makedirs(pt_bidir_df_dir, exist_ok=True)
+
+        for side in sides:
+            for contour in contours:
+                ref_nifti = os.path.join(nifti_pt_dir, f"{side}_{organ_name}_{contour}_staple.nii")
+                ref_name = f"{side}_{contour}_staple"
+                pending = []
+                for n in range(0,len(observers)):
+                    # the mesh paths are where step 3 would write the meshes
+                    job = BLDJob(patient, side, contour, n+1, os.path.join(mesh_pt_dir, f"{side}_{organ_name}_{contour}_staple.ply"), ref_name, 
+                                 os.path.join(mesh_pt_dir, f"{side}_{contour}_{n+1}.ply"), f"{side}_{contour}_{n+1}", pt_bidir_df_dir, 
+                                 output_format, write_full_csv, distance_mode, tree_settings, precision)
+                    job_no = len(all_jobs)
+                    all_jobs.append(job)
+                    results.append(None)
+                    job_inputs[job_no] = [ref_nifti, os.path.join(nifti_pt_dir, f"{side}{observers[n]}{contour}{nifti_extension}")]
+                    if cache is not None and cache.is_fresh("s4", _job_cache_name(job), job_inputs[job_no], cache_params, _job_outputs(job, summary_at_pts_dir)):
+                        print(f"Skipping {ref_name} vs {job.comparison_name}: BLDs are up to date")
+                        results[-1] = _new_job_result(job)
+                        results[-1]['cached'] = True
+                    else:
+                        pending.append(job_no)
+                _discard_stale_summary(summary_at_pts_dir, patient, side, contour, cache, pending)
+                if len(pending) > 0:
+                    groups.append((pending, ref_nifti, [job_inputs[job_no][1] for job_no in pending]))
+
+    ###### RUN JOBS 
+    summaries = {}
+    def finish_job(job_no):
+        result = results[job_no]
+        if run_log is not None:
+            run_log.record("s4", _job_cache_name(all_jobs[job_no]), wall_time_s = result['total_time_s'], **result)
+        if result['error'] is not None:
+            return
+        if cache is not None and not result['cached']:
+            cache.record("s4", _job_cache_name(all_jobs[job_no]), job_inputs[job_no], cache_params, _job_outputs(all_jobs[job_no], summary_at_pts_dir), intermediate = True)
+        if summary_at_pts_dir is not None:
+            _update_point_summary(summaries, result, bld_dfs_dir, summary_at_pts_dir, output_format, precision)
+
+    for job_no, result in enumerate(results):
+        if result is not None:
+            finish_job(job_no)
+
+    write_meshes = mesh_base_dir is not None
+    run_group = run_voxel_group if backend == "voxel" else run_fused_group
+    if workers <= 1:
+        for pending, ref_nifti, comparison_niftis in groups:
+            group_results = run_group([all_jobs[job_no] for job_no in pending], ref_nifti, comparison_niftis, level, crop, write_meshes, simplify)
+            for job_no, result in zip(pending, group_results):
+                results[job_no] = result
+                finish_job(job_no)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for pending, ref_nifti, comparison_niftis in groups:
+                futures[pool.submit(run_group, [all_jobs[job_no] for job_no in pending], ref_nifti, comparison_niftis, level, crop, write_meshes, simplify)] = pending
+            for future in as_completed(futures):
+                for job_no, result in zip(futures[future], future.result()):
+                    results[job_no] = result
+                    finish_job(job_no)
+
+    _finish_step(results, summaries, bld_dfs_dir, output_format, run_log, stage_timer, workers, precision)
+    return results
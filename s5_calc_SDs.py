@@ -1,9 +1,364 @@
 import os
+import hashlib
+import numpy as np
 import pandas as pd
+import bld_store
+import numeric_precision
+import run_metrics
 
-def compute_summary_at_points(contour, individal_BLD_dir, output_dir, side, observers):
+class PointSummaryAccumulator:
     """
-    compute_summary_at_points: Calculates mean and standard deviation at each point on reference contour from the bilateral distances of all observers.  
+    A class to accumulate per-point summary statistics of the bilateral distances on a reference contour one observer at a time, so that only O(n_vertices) memory is held however many observers there are. 
+    The mean and variance are updated with Welford's online algorithm, and optionally the min/max and a fixed-bin histogram per vertex (for approximate quantiles). 
+    ...
+
+    Attributes
+    ----------
+    n_vertices : int
+        number of vertices on the reference contour
+    observers : array of str
+        names of the observers added so far (an observer is only added once)
+    bld_hashes : dict
+        observer name -> hash of the bilateral distances it was added with (see bld_hash), so that an observer whose distances changed since is detected
+    count : int
+        number of observers added so far
+    mean : np.array (n_vertices,)
+        running mean of the bilateral distance at each vertex
+    m2 : np.array (n_vertices,)
+        running sum of squared differences from the mean at each vertex
+    minimum, maximum : np.array (n_vertices,) or None
+        running min and max at each vertex (only if track_extrema is True)
+    histogram_edges : np.array (n_bins+1,) or None
+        edges of the histogram bins in mm; distances beyond the last edge are counted in the last bin
+    histogram : np.array (n_vertices, n_bins) or None
+        count of observers in each bin at each vertex (only if histogram_edges is given)
+    reference_hash : str or None
+        hash of the reference vertices the distances are aligned to (see bld_store.reference_hash)
+
+    Methods
+    -------
+    update(observer, bld)
+        adds the bilateral distances of one observer (returns False if it was already added with the same distances, and raises a ValueError if it was added with different ones)
+    changed(observer, bld)
+        returns True if the observer was already added with different distances (see rebuild_accumulator)
+    std(ddof = 0)
+        standard deviation at each vertex (population std by default, as in compute_summary_at_points)
+    quantile(q)
+        approximate q-quantile at each vertex, interpolated within the histogram bins
+    save(path)
+        saves the state to a .npz file, see load_accumulator
+    """
+    def __init__(self, n_vertices, track_extrema = True, histogram_edges = None, reference_hash = None):
+        self.n_vertices = n_vertices
+        self.reference_hash = reference_hash
+        self.observers = []
+        self.bld_hashes = {}
+        self.count = 0
+        self.mean = np.zeros(n_vertices)
+        self.m2 = np.zeros(n_vertices)
+        self.minimum = np.full(n_vertices, np.inf) if track_extrema else None
+        self.maximum = np.full(n_vertices, -np.inf) if track_extrema else None
+        self.histogram_edges = None if histogram_edges is None else np.asarray(histogram_edges, dtype=np.float64)
+        self.histogram = None if histogram_edges is None else np.zeros((n_vertices, len(self.histogram_edges) - 1), dtype=np.int32)
+
+    def update(self, observer, bld):
+        bld = np.asarray(bld, dtype=np.float64)
+        if bld.shape != (self.n_vertices,):
+            raise ValueError(f"expected {self.n_vertices} bilateral distances for observer {observer}, got {bld.shape}")
+        values_hash = bld_hash(bld)
+        if observer in self.observers:
+            if self.bld_hashes.get(observer) == values_hash:
+                return False
+            # the old values of the observer cannot be taken out of the extrema and histogram, so the accumulator has to be rebuilt from the tables
+            raise ValueError(f"observer {observer} was added with different bilateral distances, rebuild the accumulator (see rebuild_accumulator)")
+        # Welford update
+        self.count += 1
+        delta = bld - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (bld - self.mean)
+        if self.minimum is not None:
+            np.minimum(self.minimum, bld, out=self.minimum)
+            np.maximum(self.maximum, bld, out=self.maximum)
+        if self.histogram is not None:
+            bins = np.clip(np.searchsorted(self.histogram_edges, bld, side='right') - 1, 0, self.histogram.shape[1] - 1)
+            self.histogram[np.arange(self.n_vertices), bins] += 1
+        self.observers.append(observer)
+        self.bld_hashes[observer] = values_hash
+        return True
+
+    def changed(self, observer, bld):
+        # observers added before the distances were hashed count as changed, as their distances cannot be checked
+        return observer in self.observers and self.bld_hashes.get(observer) != bld_hash(np.asarray(bld, dtype=np.float64))
+
+    def std(self, ddof = 0):
+        return np.sqrt(self.m2 / max(self.count - ddof, 1))
+
+    def quantile(self, q):
+        if self.histogram is None:
+            raise ValueError("quantiles need the accumulator to be created with histogram_edges")
+        cumulative = np.cumsum(self.histogram, axis=1)
+        target = q * self.count
+        bin_no = np.argmax(cumulative >= target, axis=1)
+        rows = np.arange(self.n_vertices)
+        below = np.where(bin_no > 0, cumulative[rows, np.maximum(bin_no - 1, 0)], 0)
+        in_bin = np.maximum(self.histogram[rows, bin_no], 1)
+        fraction = np.clip((target - below) / in_bin, 0, 1)
+        widths = np.diff(self.histogram_edges)
+        return self.histogram_edges[bin_no] + fraction * widths[bin_no]
+
+    def save(self, path):
+        state = {'n_vertices': self.n_vertices, 'observers': np.array(self.observers, dtype=str), 'count': self.count, 
+                 'bld_hashes': np.array([self.bld_hashes.get(observer, "") for observer in self.observers], dtype=str), 
+                 'mean': self.mean, 'm2': self.m2}
+        if self.minimum is not None:
+            state['minimum'] = self.minimum
+            state['maximum'] = self.maximum
+        if self.histogram is not None:
+            state['histogram_edges'] = self.histogram_edges
+            state['histogram'] = self.histogram
+        if self.reference_hash is not None:
+            state['reference_hash'] = np.array(self.reference_hash)
+        np.savez(path, **state)
+
+def load_accumulator(path):
+    """
+    load_accumulator: Loads a PointSummaryAccumulator saved with PointSummaryAccumulator.save, so that new observers can be added without adding the previous ones again. 
+
+
+    Parameters
+    ----------
+    path : filepath
+        The .npz file written by PointSummaryAccumulator.save
+
+    Returns
+    -------
+    accumulator : PointSummaryAccumulator object
+    """
+    state = np.load(path)
+    accumulator = PointSummaryAccumulator(int(state['n_vertices']), track_extrema = 'minimum' in state, 
+                                          histogram_edges = state['histogram_edges'] if 'histogram_edges' in state else None, 
+                                          reference_hash = str(state['reference_hash']) if 'reference_hash' in state else None)
+    accumulator.observers = [str(observer) for observer in state['observers']]
+    # accumulators saved before the distances were hashed have no hashes (their observers count as changed)
+    if 'bld_hashes' in state:
+        accumulator.bld_hashes = {observer: str(values_hash) for observer, values_hash in zip(accumulator.observers, state['bld_hashes']) if str(values_hash) != ""}
+    accumulator.count = int(state['count'])
+    accumulator.mean = state['mean'].copy()
+    accumulator.m2 = state['m2'].copy()
+    if accumulator.minimum is not None:
+        accumulator.minimum = state['minimum'].copy()
+        accumulator.maximum = state['maximum'].copy()
+    if accumulator.histogram is not None:
+        accumulator.histogram = state['histogram'].copy()
+    return accumulator
+
+def bld_hash(bld):
+    """
+    bld_hash : Returns a short hash of an observer's bilateral distances (of their float64 values, in order), which the accumulator stores to detect an observer whose table was rewritten.
+
+
+    Parameters
+    ----------
+    bld : np.array (n_vertices,)
+        The bilateral distances
+
+    Returns
+    -------
+    hash : str
+        16 hexadecimal characters
+    """
+    return hashlib.sha1(np.ascontiguousarray(bld, dtype=np.float64).tobytes()).hexdigest()[:16]
+
+def rebuild_accumulator(accumulator, individal_BLD_dir, reference_name, input_format = "pickle", observers = None):
+    """
+    rebuild_accumulator : Creates a new accumulator with the settings of accumulator, and adds the current bilateral distances of each of its observers (or of the given observers) read from their tables. 
+    Used when an observer's table was rewritten after it was added, as its old values cannot be taken out of the extrema and histograms.
+
+
+    Parameters
+    ----------
+    accumulator : PointSummaryAccumulator object
+        The accumulator to rebuild
+    individal_BLD_dir : filepath
+        The patients' directory which stores the bilateral distances calculated in step 4
+    reference_name : str
+        The name of the reference contour (i.e. left_manual_staple), the tables are named <reference_name>_to_<observer>
+    input_format : str
+        Format the bilateral distances were stored in by step 4, one of bld_store.BLD_FORMATS
+    observers : array of str, optional
+        The observers to add (the observers of accumulator if None)
+
+    Returns
+    -------
+    accumulator : PointSummaryAccumulator object
+    """
+    observers = list(accumulator.observers) if observers is None else observers
+    rebuilt = PointSummaryAccumulator(accumulator.n_vertices, track_extrema = accumulator.minimum is not None, histogram_edges = accumulator.histogram_edges, 
+                                      reference_hash = accumulator.reference_hash)
+    for observer in observers:
+        name = f"{reference_name}_to_{observer}"
+        if accumulator.reference_hash is not None:
+            bld_store.check_table_reference(individal_BLD_dir, name, input_format, accumulator.reference_hash)
+        rebuilt.update(observer, bld_store.read_bld_column(individal_BLD_dir, name, "bidir_distance_on_reference", input_format))
+    return rebuilt
+
+def accumulator_path(output_dir, contour, side):
+    return os.path.join(output_dir, f"bidir_accumulator_{contour}_{side}.npz")
+
+def discard_accumulator(output_dir, contour, side):
+    # deletes the saved accumulator (i.e. when the cache finds one of its tables changed), so the next run rebuilds it from the tables
+    state_path = accumulator_path(output_dir, contour, side)
+    if os.path.exists(state_path):
+        print(f"Discarding the saved {contour} {side} accumulator: its BLD tables changed")
+        os.remove(state_path)
+
+def open_accumulator(output_dir, contour, side, n_vertices, reference_hash, histogram_edges = None):
+    """
+    open_accumulator: Loads the accumulator saved by a previous run for this reference, or creates a new one if there is none or it was accumulated on a different reference mesh (a different hash, or a different number of vertices for accumulators saved without a hash). 
+
+
+    Parameters
+    ----------
+    output_dir : filepath 
+        The patients' directory the summary statistics are stored in
+    contour : str
+        The type of the organ contour (i.e. "manual")
+    side: str
+        The laterality the organ contour considered (i.e. "left")
+    n_vertices : int
+        number of vertices on the reference contour
+    reference_hash : str
+        hash of the reference vertices (see bld_store.reference_hash)
+    histogram_edges : array of float, optional
+        Bin edges in mm for the per-point histograms (only used when a new accumulator is created)
+
+    Returns
+    -------
+    accumulator : PointSummaryAccumulator object
+    """
+    state_path = accumulator_path(output_dir, contour, side)
+    if os.path.exists(state_path):
+        accumulator = load_accumulator(state_path)
+        if accumulator.n_vertices == n_vertices and accumulator.reference_hash in (None, reference_hash):
+            accumulator.reference_hash = reference_hash
+            return accumulator
+        print(f"Discarding the saved {contour} {side} accumulator: it was accumulated on a different reference mesh")
+    return PointSummaryAccumulator(n_vertices, histogram_edges = histogram_edges, reference_hash = reference_hash)
+
+def reference_frame(vertices, precision = "float64"):
+    # reference_X, reference_Y and reference_Z columns of the reference vertices, the first columns of the summary at points files
+    vertices = numeric_precision.compact_floats(vertices, precision)
+    return pd.DataFrame({column: vertices[:, axis] for axis, column in enumerate(bld_store.COORDINATE_COLUMNS)})
+
+def _summary_attrs(reference_name, reference_hash):
+    # stored with the summary (kept in the .pkl file), so step 7 can check it is drawn on the mesh it was calculated on
+    return {'reference': reference_name, 'reference_hash': reference_hash}
+
+def write_accumulated_summary(accumulator, reference_df, output_dir, contour, side, quantiles = (), precision = "float64"):
+    """
+    write_accumulated_summary: Writes the per-point summary of a PointSummaryAccumulator to the same files as compute_summary_at_points (without the per-observer columns), and saves the accumulator state next to them. 
+
+
+    Parameters
+    ----------
+    accumulator : PointSummaryAccumulator object
+    reference_df : pd.DataFrame
+        reference_X, reference_Y and reference_Z of the reference contour vertices (see reference_frame)
+    output_dir : filepath 
+        The patients' directory to store the summary statistics
+    contour : str
+        The type of the organ contour (i.e. "manual")
+    side: str
+        The laterality the organ contour considered (i.e. "left")
+    quantiles : array of float
+        Quantiles (between 0 and 1) to write as quantile_<q>_at_point columns (needs the accumulator histogram)
+    precision : str
+        One of numeric_precision.PRECISIONS, the precision of the summary columns written (the accumulator itself is kept in double precision, as it only holds O(n_vertices) values)
+
+    Returns
+    -------
+    summary_df : pd.DataFrame
+    """
+    summary_df = reference_df.reset_index(drop=True).copy()
+    summary_df['mean_at_point'] = numeric_precision.compact_floats(accumulator.mean, precision)
+    summary_df['std_at_point'] = numeric_precision.compact_floats(accumulator.std(ddof=0), precision)
+    if accumulator.minimum is not None:
+        summary_df['min_at_point'] = numeric_precision.compact_floats(accumulator.minimum, precision)
+        summary_df['max_at_point'] = numeric_precision.compact_floats(accumulator.maximum, precision)
+    for q in quantiles:
+        summary_df[f"quantile_{q:g}_at_point"] = numeric_precision.compact_floats(accumulator.quantile(q), precision)
+    summary_df.attrs = _summary_attrs(f"{side}_{contour}_staple", accumulator.reference_hash)
+
+    print(f"Writing bidir_sd_mean_at_pt_{contour}_{side} to file ({accumulator.count} observers)")
+    summary_df.to_pickle(os.path.join(output_dir, f"bidir_sd_mean_at_pt_{contour}_{side}.pkl"))
+    summary_df.to_csv(os.path.join(output_dir, f"bidir_sd_mean_at_pt_{contour}_{side}.csv"))
+    accumulator.save(accumulator_path(output_dir, contour, side))
+    return summary_df
+
+def stack_observer_blds(individal_BLD_dir, side, contour, n_observers, input_format = "pickle", reference_hash = None, precision = "float64"):
+    """
+    stack_observer_blds: Reads the bilateral distances of every observer on the reference contour into one matrix, with one row per reference vertex and one column per observer. 
+    The rows of every table are in the order of the reference vertices, so the vertex index is the key (no join on the coordinates is needed).
+
+
+    Parameters
+    ----------
+    individal_BLD_dir : filepath
+        The patients' directory which stores the bilateral distances calculated in step 4
+    side: str
+        The laterality the organ contour considered (i.e. "left")
+    contour : str
+        The type of the organ contour (i.e. "manual")
+    n_observers : int
+        The number of observers, numbered 1 to n_observers in the bilateral distance filenames
+    input_format : str
+        Format the bilateral distances were stored in by step 4, one of bld_store.BLD_FORMATS
+    reference_hash : str, optional
+        If given, every table must have been written on the reference vertices with this hash (see bld_store.check_table_reference)
+    precision : str
+        One of numeric_precision.PRECISIONS, the dtype of the matrix (float32 keeps the float32 BLD files as they are, without a float64 copy)
+
+    Returns
+    -------
+    bld_matrix : np.array (n_vertices, n_observers)
+    """
+    columns = []
+    for n in range(0,n_observers):
+        name = f"{side}_{contour}_staple_to_{side}_{contour}_{n+1}"
+        if reference_hash is not None:
+            bld_store.check_table_reference(individal_BLD_dir, name, input_format, reference_hash)
+        columns.append(bld_store.read_bld_column(individal_BLD_dir, name, "bidir_distance_on_reference", input_format))
+    lengths = set(len(column) for column in columns)
+    if len(lengths) > 1:
+        raise ValueError(f"BLD files for {side} {contour} have different numbers of reference vertices: {sorted(lengths)}")
+    if precision == "float32":
+        return numeric_precision.compact_floats(np.column_stack(columns), precision)
+    return np.column_stack(columns).astype(np.float64)
+
+def point_statistics(bld_matrix, precision = "float64"):
+    """
+    point_statistics: Calculates the mean and (population) standard deviation of the bilateral distances at each reference vertex, accumulating in double precision whatever the dtype of the matrix (so a float32 matrix is not copied to float64).
+
+
+    Parameters
+    ----------
+    bld_matrix : np.array (n_vertices, n_observers)
+        The bilateral distances of every observer (see stack_observer_blds)
+    precision : str
+        One of numeric_precision.PRECISIONS, the precision of the statistics returned
+
+    Returns
+    -------
+    mean, std : np.array (n_vertices,)
+    """
+    mean = bld_matrix.mean(axis = 1, dtype = np.float64)
+    # std population ==> ddof = 0 (if sample, then ddof = 1)
+    std = bld_matrix.std(axis = 1, ddof = 0, dtype = np.float64)
+    return numeric_precision.compact_floats(mean, precision), numeric_precision.compact_floats(std, precision)
+
+def compute_summary_at_points(contour, individal_BLD_dir, output_dir, side, observers, input_format = "pickle", precision = "float64"):
+    """
+    compute_summary_at_points: Calculates mean and standard deviation at each point on reference contour from the bilateral distances of all observers (any number of observers).  
 
 
     Parameters
@@ -18,45 +373,125 @@ def compute_summary_at_points(contour, individal_BLD_dir, output_dir, side, obse
         The laterality the organ contour considered. Example used here is "left" and "right" for the elft and right breasts. Used to select the contours from the observers to be included in the summary at points, i.e. only uses "left" contours generated by observers to calculate the mean bilateral distance at each point on the left reference contour.
     observers : array
         The names of the obsrvers as indicated in the region-of-interest name, which is included in the bilateral distance filename. Used to select the files to include in the calculation of the summary statistics. 
+    input_format : str
+        Format the bilateral distances were stored in by step 4, one of bld_store.BLD_FORMATS
+    precision : str
+        One of numeric_precision.PRECISIONS. "float32" holds the (n_vertices x n_observers) matrix and writes the summary as float32, for half the memory and file size
 
  
     Returns
     -------
-    None
+    merged_df : pd.DataFrame
+        the summary at each point written to file
     """
 
-    os.chdir(individal_BLD_dir)
-    
-    dataframes = []
-    for n in range(0,len(observers)):
-        dataframes.append(pd.read_pickle(f"{side}_{contour}_staple_to_{side}_{contour}_{n+1}.pkl"))
-    
-    merged_df = dataframes[0]
-    for i, df in enumerate(dataframes[1:]):
-        merged_df = pd.merge(merged_df, df, how='outer', on = ["reference_X", "reference_Y", "reference_Z"], suffixes=('', f"_{i+2}"))
-    # _1 isn't renamed because there aren't any columns with the same name (for all other there is beause of _3, so just rename this one at the end)
-    merged_df.rename(columns={"bidir_distance_on_reference": "bidir_distance_on_reference_1"}, inplace = True)
-
-    # calculate mean at that point
-    merged_df['mean_at_point'] = merged_df[["bidir_distance_on_reference_1","bidir_distance_on_reference_2","bidir_distance_on_reference_3",
-                                  "bidir_distance_on_reference_4","bidir_distance_on_reference_5","bidir_distance_on_reference_6",
-                                  "bidir_distance_on_reference_7","bidir_distance_on_reference_8","bidir_distance_on_reference_9",
-                                  "bidir_distance_on_reference_10"]].mean(axis = 1)
-    
-    # calculate SD at that point
-    # std population ==> ddof = 0 (if sample, then ddof = 1)
-    merged_df['std_at_point'] = merged_df[["bidir_distance_on_reference_1","bidir_distance_on_reference_2","bidir_distance_on_reference_3",
-                                 "bidir_distance_on_reference_4","bidir_distance_on_reference_5","bidir_distance_on_reference_6",
-                                 "bidir_distance_on_reference_7","bidir_distance_on_reference_8","bidir_distance_on_reference_9",
-                                 "bidir_distance_on_reference_10"]].std(axis = 1, ddof=0)
-    
-    os.chdir(output_dir)
+    # every observer's BLDs are computed on the vertices of the same reference (STAPLE) mesh, in vertex order,
+    # so the vertex index is the key: stack the BLD vectors into an (n_vertices x n_observers) matrix instead of merging on the float coordinates
+    ref_name = f"{side}_{contour}_staple_to_{side}_{contour}_1"
+    vertices, vertex_hash = bld_store.read_table_reference(individal_BLD_dir, ref_name, input_format)
+    bld_matrix = stack_observer_blds(individal_BLD_dir, side, contour, len(observers), input_format, vertex_hash, precision)
+    if bld_matrix.shape[0] != len(vertices):
+        raise ValueError(f"BLD files for {side} {contour} have {bld_matrix.shape[0]} rows but {ref_name} has {len(vertices)} reference vertices")
+
+    merged_df = summary_frame(vertices, bld_matrix, f"{side}_{contour}_staple", vertex_hash, precision = precision)
+    write_summary_frame(merged_df, output_dir, contour, side)
+    return merged_df
+
+def summary_frame(vertices, bld_matrix, reference_name, reference_hash, observers = None, precision = "float64"):
+    """
+    summary_frame: Builds the summary at points table of one reference contour from its vertices and the BLDs of every observer held in memory (the columns of the files written by compute_summary_at_points).
+
+
+    Parameters
+    ----------
+    vertices : np.array (n_vertices, 3)
+        The reference contour's vertices, in the order of the rows of bld_matrix
+    bld_matrix : np.array (n_vertices, n_observers)
+        The bilateral distances of every observer
+    reference_name : str
+        The name of the reference contour (i.e. left_manual_staple)
+    reference_hash : str
+        Hash of the reference vertices (see bld_store.reference_hash), which step 7 checks the mesh against
+    observers : array of int, optional
+        The observer number of each column of bld_matrix (1, 2, ... if None)
+    precision : str
+        One of numeric_precision.PRECISIONS, the precision of the columns written
+
+    Returns
+    -------
+    merged_df : pd.DataFrame
+        reference coordinates, the BLDs of each observer and the mean and standard deviation at each point
+    """
+    if bld_matrix.shape[0] != len(vertices):
+        raise ValueError(f"the BLDs have {bld_matrix.shape[0]} rows but {reference_name} has {len(vertices)} vertices")
+    observers = observers if observers is not None else range(1, bld_matrix.shape[1] + 1)
+    bld_columns = [f"bidir_distance_on_reference_{n}" for n in observers]
+    merged_df = pd.concat([reference_frame(vertices, precision), 
+                           pd.DataFrame(numeric_precision.compact_floats(bld_matrix, precision), columns=bld_columns)], axis=1)
+
+    # calculate mean and SD at that point
+    merged_df['mean_at_point'], merged_df['std_at_point'] = point_statistics(bld_matrix, precision)
+    merged_df.attrs = _summary_attrs(reference_name, reference_hash)
+    return merged_df
+
+def write_summary_frame(merged_df, output_dir, contour, side):
+    # writes the summary at points table to the .pkl (read by step 7) and .csv files of the contour set and side
     print(f"Writing bidir_sd_mean_at_pt_{contour}_{side} to file")
-    # save to new file
-    merged_df.to_pickle(f"bidir_sd_mean_at_pt_{contour}_{side}.pkl")
-    merged_df.to_csv(f"bidir_sd_mean_at_pt_{contour}_{side}.csv")
+    merged_df.to_pickle(os.path.join(output_dir, f"bidir_sd_mean_at_pt_{contour}_{side}.pkl"))
+    merged_df.to_csv(os.path.join(output_dir, f"bidir_sd_mean_at_pt_{contour}_{side}.csv"))
+
+def compute_summary_at_points_streaming(contour, individal_BLD_dir, output_dir, side, observers, input_format = "pickle", histogram_edges = None, quantiles = (), precision = "float64"):
+    """
+    compute_summary_at_points_streaming: Calculates the mean and standard deviation at each point on the reference contour like compute_summary_at_points, but reads the observers' bilateral distances one at a time into a PointSummaryAccumulator, so peak memory stays at O(n_vertices). 
+    If an accumulator was saved by a previous run, it is loaded and only observers not yet included are added; the table of every observer is read and compared with the hash of the distances it was added with, and the accumulator is rebuilt from the tables if any observer's distances changed (or an observer is no longer compared).
 
-def s5_main(bld_base_dir, summary_at_pts_dir, patient_IDs, observers, sides, contours):
+
+    Parameters
+    ----------
+    contour : str
+        The type of the organ contour (i.e. "manual")
+    individal_BLD_dir : filepath
+        The patients' directory which stores the bilateral distances calculated in step 4
+    output_dir : filepath 
+        The patients' directory to store the summary statistics generated at each point on the reference contour
+    side: str
+        The laterality the organ contour considered (i.e. "left")
+    observers : array
+        The names of the obsrvers, numbered 1 to len(observers) in the bilateral distance filenames
+    input_format : str
+        Format the bilateral distances were stored in by step 4, one of bld_store.BLD_FORMATS
+    histogram_edges : array of float, optional
+        Bin edges in mm for the per-point histograms used for quantiles (only used when a new accumulator is created)
+    quantiles : array of float
+        Quantiles (between 0 and 1) to write to the summary
+    precision : str
+        One of numeric_precision.PRECISIONS, the precision of the summary written
+
+    Returns
+    -------
+    summary_df : pd.DataFrame
+    """
+    ref_name = f"{side}_{contour}_staple_to_{side}_{contour}_1"
+    vertices, vertex_hash = bld_store.read_table_reference(individal_BLD_dir, ref_name, input_format)
+    accumulator = open_accumulator(output_dir, contour, side, len(vertices), vertex_hash, histogram_edges)
+
+    reference_name = f"{side}_{contour}_staple"
+    names = [f"{side}_{contour}_{n+1}" for n in range(0,len(observers))]
+    # observers which are no longer compared are taken out by rebuilding from the tables of the current ones
+    if any(name not in names for name in accumulator.observers):
+        accumulator = rebuild_accumulator(accumulator, individal_BLD_dir, reference_name, input_format, [name for name in accumulator.observers if name in names])
+    for name in names:
+        bld_store.check_table_reference(individal_BLD_dir, f"{reference_name}_to_{name}", input_format, vertex_hash)
+        bld = bld_store.read_bld_column(individal_BLD_dir, f"{reference_name}_to_{name}", "bidir_distance_on_reference", input_format)
+        # a table rewritten since its observer was added (i.e. a re-contoured observer) replaces the old values
+        if accumulator.changed(name, bld):
+            print(f"{name} changed since it was added to the {contour} {side} accumulator, rebuilding it from the tables")
+            accumulator = rebuild_accumulator(accumulator, individal_BLD_dir, reference_name, input_format)
+        accumulator.update(name, bld)
+
+    return write_accumulated_summary(accumulator, reference_frame(vertices, precision), output_dir, contour, side, quantiles, precision)
+
+def s5_main(bld_base_dir, summary_at_pts_dir, patient_IDs, observers, sides, contours, input_format = "pickle", streaming = False, cache = None, run_log = None, precision = "float64"):
     """
     Step 5 main function: Calculating mean and standard deviations of the bilateral distances at each point on the reference contour. 
 
@@ -75,25 +510,59 @@ def s5_main(bld_base_dir, summary_at_pts_dir, patient_IDs, observers, sides, con
         The laterality of the organ contour (here used to loop over left and right breast nifti files). Used to select the contours to be included in the STAPLE algorithm, i.e. only uses left contours to create the left breast STAPLE contour.
     contours : array of str
         The type of the organ contour. Example used here is "manual" contours and "altas-edited" contours, as we are do inter observer and inter-method analysis simultaneously. Used to select the contours to be included in the STAPLE algorithm, i.e. only uses "manual" contours to create the "manual breast STAPLE contour").
+    input_format : str
+        Format the bilateral distances were stored in by step 4, one of bld_store.BLD_FORMATS ("pickle", "csv", "npy" or "parquet")
+    streaming : bool
+        If True, uses compute_summary_at_points_streaming (one observer in memory at a time, reusing saved accumulators) instead of compute_summary_at_points
+    cache : pipeline_cache.PipelineCache, optional
+        If given, summaries whose bilateral distance files are unchanged since they were written are skipped (a streaming summary also needs its saved accumulator, which is deleted and rebuilt from the tables when a file changed)
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every summary (and of the whole step) are appended to this run log
+    precision : str
+        One of numeric_precision.PRECISIONS ("float32" for float32 per-point matrices and summary files)
     
     Returns
     -------
     None
     """
+    stage_timer = run_metrics.JobTimer()
+    numeric_precision.check_precision(precision)
+    n_jobs = 0
     # loop over the pateints' bilateral distance folders
     for patient in patient_IDs:
         patient_BLD_dir = os.path.join(bld_base_dir, patient, "just_BLD_DFs")
 
         # location to save .pkl files of the summary at each point statistics calculated here 
         summary_at_pts_pt_dir = os.path.join(summary_at_pts_dir, patient)
-        if not os.path.exists(summary_at_pts_pt_dir):
-            os.makedirs(summary_at_pts_pt_dir)
+        os.makedirs(summary_at_pts_pt_dir, exist_ok=True)
                 
         print("           Working with patient " + str(patient))
 
         for side in sides:
             for contour in contours:
-                compute_summary_at_points(contour, patient_BLD_dir, summary_at_pts_pt_dir, side, observers) 
-
-
+                cache_inputs = [bld_store.bld_path(patient_BLD_dir, f"{side}_{contour}_staple_to_{side}_{contour}_{n+1}", input_format) for n in range(0,len(observers))]
+                cache_outputs = [os.path.join(summary_at_pts_pt_dir, f"bidir_sd_mean_at_pt_{contour}_{side}.pkl")]
+                # the streaming summary also depends on the accumulator it saves
+                if streaming:
+                    cache_outputs.append(accumulator_path(summary_at_pts_pt_dir, contour, side))
+                cache_params = {'input_format': input_format, 'streaming': streaming, 'precision': precision}
+                if cache is not None and cache.is_fresh("s5", f"{patient}/{side}_{contour}", cache_inputs, cache_params, cache_outputs):
+                    print(f"Skipping bidir_sd_mean_at_pt_{contour}_{side}: up to date")
+                    continue
+                if streaming and cache is not None:
+                    # one of its tables changed since the summary was written, so the accumulator is rebuilt from the tables rather than reopened
+                    discard_accumulator(summary_at_pts_pt_dir, contour, side)
+                timer = run_metrics.JobTimer()
+                if streaming:
+                    summary_df = compute_summary_at_points_streaming(contour, patient_BLD_dir, summary_at_pts_pt_dir, side, observers, input_format, precision = precision)
+                else:
+                    summary_df = compute_summary_at_points(contour, patient_BLD_dir, summary_at_pts_pt_dir, side, observers, input_format, precision) 
+                n_jobs += 1
+                if run_log is not None:
+                    run_log.record("s5", f"{patient}/{side}_{contour}", patient = patient, side = side, contour = contour, n_vertices = len(summary_df), 
+                                   n_observers = len(observers), input_format = input_format, streaming = streaming, **timer.metrics())
+                if cache is not None:
+                    cache.record("s5", f"{patient}/{side}_{contour}", cache_inputs, cache_params, cache_outputs)
 
+    if run_log is not None:
+        run_log.record("s5", "all", n_jobs = n_jobs, n_failed = 0, **stage_timer.metrics())
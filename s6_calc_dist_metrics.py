@@ -1,120 +1,214 @@
 import os
+import numpy as np
 import pandas as pd
-import regex as re
-
-
-##### CLASSES 
-class DataframeFile():
-    def __init__(self, filename, patient_ID):
-        self.patientID = patient_ID
-        self.filename = filename
-        self.distances = self.set_distance_array()
-        self.meanDTA = self.calc_and_set_meanDTA()
-        self.hausdorff = self.calc_and_set_HD()
-        self.side = self.define_side()
-        self.contourer_no = self.define_contourer_no()
-        self.contour_type = self.define_contour_type()
-        self.heading = self.define_df_heading()
-    
-    ##### UNSURE IF THIS WILL STILL WORK; CHECK OUTPUTS FROM S4 & S5... 
-    def set_distance_array(self):
-        dataframe = pd.read_pickle(self.filename)
-        dist_series = dataframe['bidir_distance_on_reference']
-        return dist_series
-
-    # mean DTA defined as the mean value of the bidir distances (not of the a-to-b and b-to-a values, as that would be biased by smaller values)
-    def calc_and_set_meanDTA(self):
-        val = self.distances.mean()
-        return val;
-
-    # HD defined as the maximum of the bidirecitonal distances
-    def calc_and_set_HD(self):
-        val = self.distances.max()
-        return val
-    
-    # search filename to find side of the breast referring to 
-    def define_side(self):
-        if "left" in self.filename:
-            return "left"
-        elif "right" in self.filename:
-            return "right"
-        else:
-            return "ERROR: SIDE"
-
-    # search file to find contourer_no (i.e Adam is 1, Bernard is 2, Claire is 3, etc...)
-    def define_contourer_no(self):
-        text = self.filename
-        #number = [int(n) for n in text.split("_") if n.isdigit()]
-        regex= "\d{1,2}"
-        match= re.findall(regex, text)
-        try:
-            return str(match[0])
-        except:
-            return ""
-
-    # search the file name for the type of contour (i.e. atlas, deeplearn, manual, unedited)
-    # and set contour_type as that word with the first letter alphabetised for use in the creation of headers
-    def define_contour_type(self):
-        text = self.filename
-        if "atlas" in text:
-            print("Atlas")
-            return "Atlas"
-        elif "manual" in text:
-            print("Manual")
-            return "Manual"
-        else:
-            return "ERROR: CONTOUR TYPE"
-
-    # create header for the dataframe i.e RefvsManual1 using properties of the class 
-    def define_df_heading(self):
-        heading = "staple_manual_VS_" + self.contour_type + self.contourer_no
-        return heading   
+import bld_store
+import run_metrics
+import surface_metrics
+
+
+##### FUNCTIONS
+def _entry_from_table_name(name, bld_format):
+    # index entry for a table written before step 4 kept an index, from its name (i.e. left_manual_staple_to_left_manual_1)
+    reference, comparison = name.split("_to_")
+    side = comparison.split("_")[0]
+    observer = comparison.rsplit("_", 1)[1]
+    return {'name': name, 'format': bld_format, 'side': side, 'contour': comparison[len(side) + 1:-(len(observer) + 1)],
+            'observer': int(observer) if observer.isdigit() else observer, 'reference': reference, 'comparison': comparison}
+
+def table_entries(bld_dfs_pts_dir, bld_format):
+    """
+    table_entries : Returns what each bilateral distance table of a patient compares, from the index written in step 4 (see bld_store.read_bld_index).
+    Tables missing from the index (i.e. written by an older step 4) are described from their names.
+
+
+    Parameters
+    ----------
+    bld_dfs_pts_dir : filepath
+        The patient's just_BLD_DFs directory
+    bld_format : str
+        The format the tables are stored in (one of bld_store.BLD_FORMATS)
+
+    Returns
+    -------
+    entries : list of dict
+        one entry per stored table, with its name, side, contour (set), observer, reference and comparison names
+    """
+    names = bld_store.list_bld_tables(bld_dfs_pts_dir, bld_format)
+    indexed = {entry['name']: entry for entry in bld_store.read_bld_index(bld_dfs_pts_dir, bld_format)}
+    return [indexed[name] if name in indexed else _entry_from_table_name(name, bld_format) for name in names]
+
+def distance_metrics(distances, percentiles = (95,)):
+    """
+    distance_metrics : Calculates the distance metrics of several comparisons at once, from their bidirectional local distances at the vertices of the same reference contour.
+
+
+    Parameters
+    ----------
+    distances : np.array (n_comparisons, n_vertices)
+        The bidirectional local distances of each comparison (one row per comparison)
+    percentiles : array of float
+        Percentiles of the distances to report (the 95th is reported as HD95)
+
+    Returns
+    -------
+    metrics : dict
+        metric name -> np.array (n_comparisons,). Mean DTA (mean of the bidirectional distances, not of the a-to-b and b-to-a values, as that would be biased by smaller values), Hausdorff (maximum of the bidirectional distances) and one entry per percentile
+    """
+    # the mean is accumulated in double precision, as the distances are stored as float32
+    metrics = {'Mean DTA': distances.mean(axis=1, dtype=np.float64),
+               'Hausdorff': distances.max(axis=1)}
+    if len(percentiles) > 0:
+        for q, values in zip(percentiles, np.percentile(distances, percentiles, axis=1)):
+            metrics["HD95" if q == 95 else f"P{q:g}"] = values
+    return metrics
+
+def _heading(entry):
+    # column heading of a comparison, i.e. staple_manual_VS_Manual1 (Atlas for the atlas_edited contour set)
+    return "staple_manual_VS_" + entry['contour'].split("_")[0].capitalize() + str(entry['observer'])
+
+def _reverse_dir(bld_dfs_pts_dir):
+    # the one-sided distances from the comparison vertices are written next to the just_BLD_DFs folder by step 4
+    return os.path.join(os.path.dirname(os.path.normpath(bld_dfs_pts_dir)), "reverse_BLD_DFs")
+
+def patient_metrics(patient, bld_dfs_pts_dir, bld_format = "pickle", percentiles = (95,), tolerances = surface_metrics.SURFACE_DICE_TOLERANCES):
+    """
+    patient_metrics : Calculates the distance metrics of every comparison of a patient, reading only the bidir_distance_on_reference column of each table.
+    The comparisons against the same reference contour share its vertices, so their distances are stacked and summarised in one call (see distance_metrics).
+    The surface metrics (see surface_metrics.surface_metrics) of every comparison with stored one-sided distances (written by step 4 in the reverse_BLD_DFs folder) are calculated in one further call.
+
+
+    Parameters
+    ----------
+    patient : str
+        patient number
+    bld_dfs_pts_dir : filepath
+        The patient's just_BLD_DFs directory
+    bld_format : str
+        The format the tables are stored in
+    percentiles : array of float
+        Percentiles of the distances to report
+    tolerances : array of float
+        Tolerances (in mm) of the surface Dice
+
+    Returns
+    -------
+    records : list of dict
+        one record per comparison and metric, with patient_ID, Side, Metric (mm), heading, value, contour (set) and observer
+    n_tables : int
+        the number of tables read
+    """
+    groups = {}
+    for entry in table_entries(bld_dfs_pts_dir, bld_format):
+        groups.setdefault((entry['side'], entry['reference']), []).append(entry)
+
+    records = []
+    n_tables = 0
+    # comparisons with one-sided distances in both directions, with their distances
+    surface_entries = []
+    forward = []
+    reverse = []
+    reverse_dir = _reverse_dir(bld_dfs_pts_dir)
+    for (side, reference), entries in groups.items():
+        columns = [np.asarray(bld_store.read_bld_column(bld_dfs_pts_dir, entry['name'], 'bidir_distance_on_reference', bld_format)) for entry in entries]
+        n_tables += len(columns)
+        # tables against the same reference have one row per reference vertex, so they stack into one array (stacked by length in case a reference changed between runs)
+        by_length = {}
+        for entry, column in zip(entries, columns):
+            by_length.setdefault(len(column), []).append((entry, column))
+        for stack in by_length.values():
+            metrics = distance_metrics(np.vstack([column for _, column in stack]), percentiles)
+            for metric, values in metrics.items():
+                records += [{'patient_ID': patient, 'Side': side, 'Metric (mm)': metric, 'heading': _heading(entry), 'value': value, 
+                             'contour': entry['contour'], 'observer': entry['observer']}
+                            for (entry, _), value in zip(stack, values)]
+        for entry in entries:
+            if os.path.exists(bld_store.bld_path(reverse_dir, entry['name'], bld_format)):
+                surface_entries.append(entry)
+                forward.append(bld_store.read_bld_column(bld_dfs_pts_dir, entry['name'], 'distance from reference', bld_format))
+                reverse.append(bld_store.read_bld_column(reverse_dir, entry['name'], 'distance from comparison', bld_format))
+
+    if len(surface_entries) > 0:
+        metrics = surface_metrics.surface_metrics(forward, reverse, tolerances)
+        # the Hausdorff distance is already reported (the maximum BLD is the maximum of both one-sided distances)
+        del metrics['Hausdorff']
+        for metric, values in metrics.items():
+            records += [{'patient_ID': patient, 'Side': entry['side'], 'Metric (mm)': metric, 'heading': _heading(entry), 'value': value, 
+                         'contour': entry['contour'], 'observer': entry['observer']}
+                        for entry, value in zip(surface_entries, values)]
+    return records, n_tables
 
 ##### MAIN
-def s6_main(base_dir, bld_dfs_dir, patient_IDs):
-        
-    data = []
+def s6_main(base_dir, bld_dfs_dir, patient_IDs, input_format = "pickle", cache = None, run_log = None, percentiles = (95,), tolerances = surface_metrics.SURFACE_DICE_TOLERANCES):
+    """
+    Step 6 main function: Calculates the distance metrics (mean DTA, Hausdorff and percentiles of the bidirectional local distances, and the symmetric surface metrics where step 4 stored the one-sided distances) of every comparison, and writes them as one table with a row per patient, side and metric, and a column per comparison.
+
+
+    Parameters
+    ----------
+    base_dir : filepath
+        The base directory the dist_metrics folder is written to
+    bld_dfs_dir : filepath
+        The base directory of the patient directories which store the bilateral distance files (from step 4)
+    patient_IDs : array of str
+        The patient numbers
+    input_format : str
+        Format the BLD files were written in by step 4 (one of bld_store.BLD_FORMATS)
+    cache : pipeline_cache.PipelineCache, optional
+        If given, the step is skipped if no BLD file or setting changed since the table was written
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every patient (and of the whole step) are appended to this run log
+    percentiles : array of float
+        Percentiles of the bidirectional distances to report (the 95th as HD95)
+    tolerances : array of float
+        Tolerances (in mm) of the surface Dice
+
+    Returns
+    -------
+    df : pd.DataFrame
+        The metrics table (None if the step was skipped)
+    """
+    stage_timer = run_metrics.JobTimer()
+    # the metrics table depends on every BLD file, so it is either up to date as a whole or rebuilt
+    output_path = os.path.join(base_dir, "dist_metrics", "distance_metrics_full_contours.csv")
+    cache_inputs = []
     for patient in patient_IDs:
-        print("                 Working with patient" + str(patient))
         bld_dfs_pts_dir = os.path.join(bld_dfs_dir, patient, "just_BLD_DFs")
-        os.chdir(bld_dfs_pts_dir)
-
-        #read in just the .pkl files 
-        left_mean_DTA = {'patient_ID': patient, 'Side': "left", 'Metric (mm)': 'Mean DTA'}
-        left_HD = {'patient_ID': patient, 'Side': "left", 'Metric (mm)': 'Hausdorff'}
-        right_mean_DTA = {'patient_ID': patient, 'Side': "right", 'Metric (mm)': 'Mean DTA'}
-        right_HD = {'patient_ID': patient, 'Side': "right", 'Metric (mm)': 'Hausdorff'}
-
-        # read bidir distance file
-        for file in os.listdir(bld_dfs_pts_dir):
-            if file.endswith(".pkl"): #bidir_sd_mean_at_pt_" + cntset + "_" + side + ".pkl
-                if "left" in file:
-                    print(file)
-                    # calculate the metrics needed from the file (instatiate class makes these, see class definition)
-                    temp = DataframeFile(file, patient);
-                    # add the value to the dictionary for that metric under the header made by the class
-                    left_mean_DTA[temp.heading] = temp.meanDTA
-                    left_HD[temp.heading] = temp.hausdorff
-                elif "right" in file:
-                    print(file)
-                    # calculate the metrics needed from the file (instatiate class makes these, see class definition)
-                    temp = DataframeFile(file, patient);
-                    # add the value to the dictionary for that metric under the header made by the class
-                    right_mean_DTA[temp.heading] = temp.meanDTA
-                    right_HD[temp.heading] = temp.hausdorff
-
-        # append the dictionary to list of dictionaries (each dictionary is per patient)
-        data.append(left_mean_DTA)
-        data.append(left_HD)
-        data.append(right_mean_DTA)
-        data.append(right_HD)
-
-    # convert list of dictionaries to pandas dataframe file 
-    df = pd.DataFrame(data)
-    # save df to csv 
+        cache_inputs += [bld_store.bld_path(bld_dfs_pts_dir, name, input_format) for name in bld_store.list_bld_tables(bld_dfs_pts_dir, input_format)]
+        reverse_dir = _reverse_dir(bld_dfs_pts_dir)
+        if os.path.isdir(reverse_dir):
+            cache_inputs += [bld_store.bld_path(reverse_dir, name, input_format) for name in bld_store.list_bld_tables(reverse_dir, input_format)]
+    cache_params = {'input_format': input_format, 'patient_IDs': list(patient_IDs), 'percentiles': list(percentiles), 'tolerances': list(tolerances)}
+    if cache is not None and cache.is_fresh("s6", "distance_metrics", cache_inputs, cache_params, [output_path]):
+        print("Skipping step 6: distance metrics are up to date")
+        return
+
+    records = []
+    for patient in patient_IDs:
+        print("                 Working with patient" + str(patient))
+        timer = run_metrics.JobTimer()
+        patient_records, n_tables = patient_metrics(patient, os.path.join(bld_dfs_dir, patient, "just_BLD_DFs"), input_format, percentiles, tolerances)
+        records += patient_records
+        if run_log is not None:
+            run_log.record("s6", patient, patient = patient, n_tables = n_tables, input_format = input_format, **timer.metrics())
+
+    # one row per patient, side and metric, with a column per comparison
+    long_df = pd.DataFrame(records, columns = ['patient_ID', 'Side', 'Metric (mm)', 'heading', 'value', 'contour', 'observer'])
+    # comparison columns ordered by contour set and observer number (so observer 10 comes after observer 9)
+    headings = list(dict.fromkeys(long_df.sort_values(['contour', 'observer'], kind = 'stable')['heading']))
+    metric_names = list(dict.fromkeys(long_df['Metric (mm)']))
+    long_df['patient_ID'] = pd.Categorical(long_df['patient_ID'], categories = list(dict.fromkeys(patient_IDs)))
+    long_df['Metric (mm)'] = pd.Categorical(long_df['Metric (mm)'], categories = metric_names)
+    df = long_df.pivot_table(index = ['patient_ID', 'Side', 'Metric (mm)'], columns = 'heading', values = 'value', aggfunc = 'first', observed = True).reset_index()
+    df = df[['patient_ID', 'Side', 'Metric (mm)'] + headings]
+    df.columns.name = None
+
+    # save df to csv
     dist_metrics_df = os.path.join(base_dir, "dist_metrics")
-    if not os.path.exists(dist_metrics_df):
-        os.makedirs(dist_metrics_df)
-    os.chdir(dist_metrics_df)
-    df.to_csv("distance_metrics_full_contours.csv")
-    
\ No newline at end of file
+    os.makedirs(dist_metrics_df, exist_ok=True)
+    df.to_csv(output_path)
+    if cache is not None:
+        cache.record("s6", "distance_metrics", cache_inputs, cache_params, [output_path])
+
+    if run_log is not None:
+        run_log.record("s6", "all", n_jobs = len(patient_IDs), n_failed = 0, **stage_timer.metrics())
+    return df
@@ -2,7 +2,15 @@ import numpy as np
 import open3d as o3d
 import pyvista as pv
 import os
+import traceback
+import imageio
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import run_metrics
+import bld_store
+
+# file formats of the turntable animations (see OrbitSettings)
+ANIMATION_FORMATS = ["gif", "mp4"]
 
 # class to definte the contours with mesh and name
 class Contour:
@@ -26,6 +34,57 @@ class CameraView:
         self.azimuth = azimuth
         self.elevation = elevation;
 
+class OrbitSettings:
+    """
+    A class to hold the settings of the turntable animations of the heat maps (a full orbit of the camera around the mesh), to trade their quality for render time
+    ...
+
+    Attributes
+    ----------
+    n_frames : int
+        number of frames in one orbit (the camera turns 360 / n_frames degrees between frames)
+    window_size : [int, int]
+        size of the frames in pixels
+    fps : float
+        frames per second of the animation
+    file_format : str
+        "gif", or "mp4" (needs the imageio-ffmpeg plugin)
+    elevation : float
+        elevation of the camera (in degrees) above the back view, which the orbit starts from
+
+    Methods
+    -------
+    start_view()
+        returns the camera view of the first frame
+    writer_kwargs()
+        returns the imageio writer arguments for the file format
+    params()
+        returns the settings, for the pipeline cache
+    """
+    def __init__(self, n_frames = 72, window_size = [500, 500], fps = 15, file_format = "gif", elevation = 0):
+        if file_format not in ANIMATION_FORMATS:
+            raise ValueError(f"file_format must be one of {ANIMATION_FORMATS}, not {file_format!r}")
+        if n_frames < 1:
+            raise ValueError(f"an orbit needs at least one frame, not {n_frames}")
+        self.n_frames = n_frames
+        self.window_size = list(window_size)
+        self.fps = fps
+        self.file_format = file_format
+        self.elevation = elevation
+
+    def start_view(self):
+        return CameraView('orbit', 'zx', 0, self.elevation)
+
+    def writer_kwargs(self):
+        if self.file_format == "gif":
+            # the GIF frame duration is in ms (imageio >= 2.28)
+            return {'mode': 'I', 'loop': 0, 'duration': 1000 / self.fps}
+        return {'fps': self.fps}
+
+    def params(self):
+        # the settings which change the animations, for the pipeline cache
+        return {'n_frames': self.n_frames, 'window_size': self.window_size, 'fps': self.fps, 'file_format': self.file_format, 'elevation': self.elevation}
+
 ##### FUNCTIONS 
 #function for visualising the reference contour on PyVista images
 def pyvistarise(mesh):
@@ -40,137 +99,467 @@ def camera_positions(plotter, direction):
     plotter.camera.elevation = direction.elevation
     return;
 
+# measures plotted on the reference mesh: (file name part, scalar bar title, column of the summary at points file)
+HEATMAP_MEASURES = [("means_", "mean BLD (mm)", 'mean_at_point'), 
+                    ("std_", "std of BLD (mm)", 'std_at_point')]
+
+class HeatMapRenderer:
+    """
+    A class to render heat maps of distances on reference meshes from one persistent offscreen plotter, instead of creating a plotter for every image.
+    The orientation widget is added once, each mesh is added once (with its normals computed once), and the scalars of a new measure are written into the mesh in place before the camera is moved through the views.
+    ...
+
+    Attributes
+    ----------
+    plotter : pv.Plotter
+        the offscreen plotter
+    window_size : [int, int]
+        size of the images in pixels
+    mesh : pv.PolyData
+        the mesh drawn by the plotter (None until set_mesh is called)
+    actor : pv.Actor
+        the actor of the mesh
+
+    Methods
+    -------
+    set_mesh(pyv_mesh)
+        replaces the mesh the heat maps are drawn on
+    render(values, scalar_str, directions, filename_prefix)
+        draws values on the mesh and writes one image per camera view
+    render_orbit(values, scalar_str, filename, orbit)
+        draws values on the mesh and writes an animation of the camera orbiting it
+    close()
+        closes the plotter
+    """
+    # heat map colour scale, shared by every measure
+    clim = [0, 20]
+    scalar_name = "BLD (mm)"
+
+    def __init__(self, actor_human, window_size = [500, 500]):
+        self.window_size = list(window_size)
+        self.plotter = pv.Plotter(off_screen = True, window_size = self.window_size)
+        self.plotter.set_background('white')
+        _ = self.plotter.add_orientation_widget(actor_human)
+        self.mesh = None
+        self.actor = None
+
+    def set_mesh(self, pyv_mesh):
+        """
+        set_mesh : Replaces the mesh the heat maps are drawn on, computing its normals (for the smooth shading) once.
+
+
+        Parameters
+        ----------
+        pyv_mesh : pv.PolyData
+            The reference mesh
+        """
+        if self.actor is not None:
+            self.plotter.remove_actor(self.actor)
+            self.plotter.remove_scalar_bar()
+        mesh = pyv_mesh.compute_normals(point_normals=True, cell_normals=False)
+        mesh[self.scalar_name] = np.zeros(mesh.n_points)
+        sargs = dict(title = self.scalar_name, 
+                     title_font_size=30, 
+                     label_font_size=30, 
+                     shadow=True, 
+                     n_labels=5,
+                     italic=False, 
+                     fmt="%.1f", 
+                     font_family="arial", 
+                     color='black', 
+                     position_x=0.3, 
+                     position_y=0.075)
+        self.actor = self.plotter.add_mesh(mesh,
+                                           scalars=self.scalar_name, 
+                                           smooth_shading=True, 
+                                           clim=self.clim, 
+                                           below_color='white', 
+                                           above_color='black', 
+                                           scalar_bar_args=sargs, 
+                                           cmap="viridis", 
+                                           lighting = False)
+        # add_mesh can draw a copy of the mesh, so the scalars are updated on the mesh the mapper draws
+        self.mesh = self.actor.mapper.dataset
+
+    def set_scalars(self, values, scalar_str):
+        """
+        set_scalars : Writes the values of a measure into the mesh in place, and titles the scalar bar with the measure.
+
+
+        Parameters
+        ----------
+        values : np.array (n_points,)
+            The value at each vertex of the mesh
+        scalar_str : str
+            The scalar bar title (i.e. "mean BLD (mm)")
+        """
+        if self.mesh is None:
+            raise ValueError("set_mesh must be called before the scalars are set")
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) != self.mesh.n_points:
+            raise ValueError(f"got {len(values)} values for a mesh with {self.mesh.n_points} vertices")
+        self.mesh.point_data[self.scalar_name][:] = values
+        self.mesh.Modified()
+        self.plotter.scalar_bar.SetTitle(scalar_str)
+
+    def render(self, values, scalar_str, directions, filename_prefix):
+        """
+        render : Draws the values of a measure on the mesh and writes one image per camera view, to filename_prefix + direction name + ".png".
+
+
+        Parameters
+        ----------
+        values : np.array (n_points,)
+            The value at each vertex of the mesh
+        scalar_str : str
+            The scalar bar title
+        directions : array of CameraView
+            The camera views to write images from
+        filename_prefix : filepath
+            The path of the images, without the direction name (i.e. /images/left_manual_means_)
+
+        Returns
+        -------
+        filenames : list of filepath
+            The images written
+        """
+        self.set_scalars(values, scalar_str)
+        filenames = []
+        for direction in directions:
+            camera_positions(self.plotter, direction)
+            filename = f"{filename_prefix}{direction.name}.png"
+            # the plotter is already at window_size (passing it to screenshot resizes the render window on every call, which costs more than the render), 
+            # so the scene is rendered here, as screenshot only renders when the window changes
+            self.plotter.render()
+            self.plotter.screenshot(filename = filename, return_img = False)
+            filenames.append(filename)
+        return filenames
+
+    def render_orbit(self, values, scalar_str, filename, orbit):
+        """
+        render_orbit : Draws the values of a measure on the mesh and writes a turntable animation of the camera orbiting it once. 
+        Each frame is passed to the imageio writer as it is rendered, so the frames are never written as images or held in memory together.
+
+
+        Parameters
+        ----------
+        values : np.array (n_points,)
+            The value at each vertex of the mesh
+        scalar_str : str
+            The scalar bar title
+        filename : filepath
+            The animation file (i.e. /images/left_manual_means_orbit.gif)
+        orbit : OrbitSettings
+            The number of frames, frame size, frame rate and elevation of the orbit
+
+        Returns
+        -------
+        n_frames : int
+            The number of frames written
+        """
+        self.set_scalars(values, scalar_str)
+        start = orbit.start_view()
+        # resize once for the whole orbit, and place the camera once so that each frame only turns it
+        self.plotter.window_size = orbit.window_size
+        camera_positions(self.plotter, start)
+        writer = imageio.get_writer(filename, **orbit.writer_kwargs())
+        try:
+            for frame in range(orbit.n_frames):
+                self.plotter.camera.azimuth = start.azimuth + frame * 360.0 / orbit.n_frames
+                self.plotter.render()
+                writer.append_data(self.plotter.screenshot(return_img = True))
+        finally:
+            writer.close()
+            self.plotter.window_size = self.window_size
+        return orbit.n_frames
+
+    def close(self):
+        self.plotter.close()
+
 def plot_images(direction, comparison_name, measure, measure_str, scalar_str, actor_human):
-    print("Called plot_images")
-    plotter = pv.Plotter(off_screen = True)
-    print("Called plotter")
-    sargs = dict(title_font_size=30, 
-                 label_font_size=30, 
-                 shadow=True, 
-                 n_labels=5,
-                 italic=False, 
-                 fmt="%.1f", 
-                 font_family="arial", 
-                 color='black', 
-                 position_x=0.3, 
-                 position_y=0.075)
-    print("Called sargs")
-    plotter.add_mesh(measure,
-                    scalars=scalar_str, 
-                    smooth_shading=True, 
-                    clim=[0, 20], 
-                    below_color='white', 
-                    above_color='black', 
-                    scalar_bar_args=sargs, 
-                    cmap="viridis", 
-                    lighting = False) 
-    print("Called add mesh")
-    _ = plotter.add_orientation_widget(actor_human)
-    print("Called add orientation widget")
-    #plotter.store_image = True
-    camera_positions(plotter, direction)
-    print("Called camera positions")
-    camera_pos = plotter.screenshot(filename= f"{comparison_name}_{measure_str}{direction.name}.png", window_size=[500, 500], return_img = False)
-    print("Called plotter.show")
-    plotter.close()
-    
-
-def plotHeatMapImagesOneToOne(comparison_name, plot_on_mesh, dists_to_plot_on_mesh, directions, regions_TF, actor_human):
-    # convert to pyvista for visualisation
-    if regions_TF == False:
-        pyv_plot_on_mesh = pyvistarise(plot_on_mesh.mesh)    
-    else: 
-        pyv_plot_on_mesh = pyvistarise_region(plot_on_mesh.encl_points) 
-    # assign dists
-    norms_means = pyv_plot_on_mesh.compute_normals(point_normals=True, cell_normals=False)
-    norms_means["BLD (mm)"] = dists_to_plot_on_mesh["bidir_distance_on_reference"] ##### check what the heading is for the summary at points file (might just need to copy the file across) 
-    #plot images at all angles
-    for direction in directions: 
-        plot_images(direction, comparison_name, norms_means, "bidir_", "BLD (mm)", actor_human);
-    # plot gif
-    #plot_gif(comparison_name, norms_means, "means_", "mean BLD (mm)");
-
-def plotHeatMapImagesOneToMany(comparison_name, plot_on_mesh, dists_to_plot_on_mesh, directions, regions_TF, actor_human):
+    # renders a single image, with a renderer of its own (use a HeatMapRenderer to render several)
+    renderer = HeatMapRenderer(actor_human)
+    try:
+        renderer.set_mesh(measure)
+        renderer.render(measure[scalar_str], scalar_str, [direction], f"{comparison_name}_{measure_str}")
+    finally:
+        renderer.close()
+
+def _plot_mesh(plot_on_mesh, regions_TF):
     # convert to pyvista for visualisation
     if regions_TF == False:
-        pyv_plot_on_mesh = pyvistarise(plot_on_mesh.mesh)    
-    else: 
-        pyv_plot_on_mesh = pyvistarise_region(plot_on_mesh.encl_points) 
-    # assign dists
-    norms_means = pyv_plot_on_mesh.compute_normals(point_normals=True, cell_normals=False)
-    norms_means["mean BLD (mm)"] = dists_to_plot_on_mesh['mean_at_point']
-    norms_std = pyv_plot_on_mesh.compute_normals(point_normals=True, cell_normals=False)
-    norms_std["std of BLD (mm)"] = dists_to_plot_on_mesh['std_at_point']
-    print("read in normals")
-
-    #plot images at all angles
-    for direction in directions: 
-        # means 
-        plot_images(direction, comparison_name, norms_means, "means_", "mean BLD (mm)", actor_human);
-        # stddevs
-        plot_images(direction, comparison_name, norms_std, "std_", "std of BLD (mm)", actor_human)
-    # plot gif
-    #plot_gif(comparison_name, norms_means, "means_", "mean BLD (mm)");
+        return pyvistarise(plot_on_mesh.mesh)    
+    return pyvistarise_region(plot_on_mesh.encl_points) 
+
+def plotHeatMapImagesOneToOne(comparison_name, plot_on_mesh, dists_to_plot_on_mesh, directions, regions_TF, actor_human, renderer = None):
+    # plots the BLDs of one comparison. Pass a renderer to reuse its plotter, otherwise one is created for these images
+    own_renderer = renderer is None
+    if own_renderer:
+        renderer = HeatMapRenderer(actor_human)
+    try:
+        renderer.set_mesh(_plot_mesh(plot_on_mesh, regions_TF))
+        #plot images at all angles
+        renderer.render(dists_to_plot_on_mesh["bidir_distance_on_reference"], "BLD (mm)", directions, f"{comparison_name}_bidir_")
+    finally:
+        if own_renderer:
+            renderer.close()
+
+def plotHeatMapImagesOneToMany(comparison_name, plot_on_mesh, dists_to_plot_on_mesh, directions, regions_TF, actor_human, renderer = None):
+    # plots the mean and standard deviation of the BLDs at each point. Pass a renderer to reuse its plotter, otherwise one is created for these images
+    own_renderer = renderer is None
+    if own_renderer:
+        renderer = HeatMapRenderer(actor_human)
+    try:
+        renderer.set_mesh(_plot_mesh(plot_on_mesh, regions_TF))
+        #plot images at all angles, for the means and the stddevs
+        for measure_str, scalar_str, column in HEATMAP_MEASURES:
+            renderer.render(dists_to_plot_on_mesh[column], scalar_str, directions, f"{comparison_name}_{measure_str}")
+    finally:
+        if own_renderer:
+            renderer.close()
+
+class HeatMapJob:
+    """
+    A class to describe the heat map images of one summary at points file (one patient, side and contour set)
+    ...
+
+    Attributes
+    ----------
+    patient : str
+        patient number
+    comparison_name : str
+        side and contour set, the start of the image names (i.e. left_manual)
+    summary_path : filepath
+        the summary at points file (.pkl, from step 5)
+    mesh_path : filepath
+        the STAPLE reference mesh the summary is on
+    image_dir : filepath
+        directory the images are written to
+    """
+    def __init__(self, patient, comparison_name, summary_path, mesh_path, image_dir):
+        self.patient = patient
+        self.comparison_name = comparison_name
+        self.summary_path = summary_path
+        self.mesh_path = mesh_path
+        self.image_dir = image_dir
+
+    def image_paths(self, directions, orbit = None):
+        paths = [os.path.join(self.image_dir, f"{self.comparison_name}_{measure_str}{direction.name}.png") for direction in directions for measure_str, _, _ in HEATMAP_MEASURES]
+        if orbit is not None:
+            paths += [self.orbit_path(measure_str, orbit) for measure_str, _, _ in HEATMAP_MEASURES]
+        return paths
+
+    def orbit_path(self, measure_str, orbit):
+        return os.path.join(self.image_dir, f"{self.comparison_name}_{measure_str}orbit.{orbit.file_format}")
+
+# the renderer of a pool worker process, created once by _init_render_worker and reused for every patient the worker renders
+_worker_renderer = None
+
+def check_summary_alignment(df, vertices):
+    """
+    check_summary_alignment : Checks that a summary at points (from step 5) was calculated on the mesh it is about to be drawn on, as its values are matched to the mesh vertices by index.
+    Summaries holding the hash of their reference vertices (see bld_store.reference_hash) are checked by hash, older summaries by their reference coordinates.
+
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The summary at points
+    vertices : np.array (n, 3)
+        The vertices of the mesh
+
+    Returns
+    -------
+    None (raises a ValueError if the summary is not aligned to the mesh)
+    """
+    vertices = np.asarray(vertices)
+    if len(df) != len(vertices):
+        raise ValueError(f"the summary has {len(df)} points but the mesh has {len(vertices)} vertices")
+    summary_hash = df.attrs.get('reference_hash')
+    if summary_hash is not None:
+        if summary_hash != bld_store.reference_hash(vertices):
+            raise ValueError(f"the summary was calculated on a different {df.attrs.get('reference', 'reference')} mesh (hash {summary_hash}) than the one drawn")
+    elif all(column in df.columns for column in bld_store.COORDINATE_COLUMNS):
+        if not np.allclose(df[bld_store.COORDINATE_COLUMNS].to_numpy(dtype=np.float64), vertices, atol = 1e-4):
+            raise ValueError("the summary reference coordinates do not match the vertices of the mesh drawn")
+
+def _init_render_worker(actor_path, window_size):
+    global _worker_renderer
+    _worker_renderer = HeatMapRenderer(pv.read(actor_path), window_size)
+
+def render_heat_map_jobs(jobs, directions, renderer = None, orbit = None):
+    """
+    render_heat_map_jobs : Renders the heat map images of several jobs (i.e. those of one patient) with one renderer. Jobs on the same STAPLE mesh are rendered one after another, so each mesh is read, added to the plotter and has its normals computed once.
+
+
+    Parameters
+    ----------
+    jobs : array of HeatMapJob
+        The jobs to render
+    directions : array of CameraView
+        The camera views to render
+    renderer : HeatMapRenderer, optional
+        The renderer to use (in a pool worker, the worker's renderer is used)
+    orbit : OrbitSettings, optional
+        If given, a turntable animation of each measure is also written
+
+    Returns
+    -------
+    results : list of dict
+        one result per job (in the order of jobs), with the patient, comparison name, number of vertices, images and animation frames, timings, and error (the traceback if the job failed, otherwise None)
+    """
+    if renderer is None:
+        renderer = _worker_renderer
+    results = [None] * len(jobs)
+    by_mesh = {}
+    for job_no, job in enumerate(jobs):
+        by_mesh.setdefault(job.mesh_path, []).append(job_no)
+    for mesh_path, job_nos in by_mesh.items():
+        mesh_error = None
+        try:
+            o3d_mesh = o3d.io.read_triangle_mesh(mesh_path)
+            vertices = np.asarray(o3d_mesh.vertices)
+            renderer.set_mesh(pyvistarise(o3d_mesh))
+        except Exception:
+            mesh_error = traceback.format_exc()
+        for job_no in job_nos:
+            job = jobs[job_no]
+            timer = run_metrics.JobTimer()
+            result = {'patient': job.patient, 'comparison_name': job.comparison_name, 'n_vertices': None, 'n_images': 0, 'n_frames': 0, 'error': mesh_error}
+            if mesh_error is None:
+                try:
+                    df = pd.read_pickle(job.summary_path)
+                    print(os.path.basename(job.summary_path))
+                    check_summary_alignment(df, vertices)
+                    os.makedirs(job.image_dir, exist_ok = True)
+                    for measure_str, scalar_str, column in HEATMAP_MEASURES:
+                        result['n_images'] += len(renderer.render(df[column], scalar_str, directions, os.path.join(job.image_dir, f"{job.comparison_name}_{measure_str}")))
+                        if orbit is not None:
+                            result['n_frames'] += renderer.render_orbit(df[column], scalar_str, job.orbit_path(measure_str, orbit), orbit)
+                    result['n_vertices'] = len(df)
+                except Exception:
+                    result['error'] = traceback.format_exc()
+            result.update(timer.metrics())
+            results[job_no] = result
+    return results
 
 
 ##### MAIN 
-def s7_main(base_dir, summary_at_pts_dir, mesh_base_dir, patient_IDs):
+def s7_main(base_dir, summary_at_pts_dir, mesh_base_dir, patient_IDs, cache = None, run_log = None, workers = 1, view_names = ("back",), orbit = None, organ_name = "breast"):
+    """
+    Step 7 main function: Renders heat maps of the mean and standard deviation of the BLDs at each point (from step 5) on the STAPLE reference meshes, one image per camera view.
+    Each process renders from one persistent offscreen plotter (see HeatMapRenderer), and with workers > 1 the patients are rendered across a pool of processes.
+    Turntable animations of the heat maps can also be written (see OrbitSettings).
+    Each summary is drawn on the STAPLE mesh of its own contour set, and is checked to have been calculated on that mesh (see check_summary_alignment).
+
+
+    Parameters
+    ----------
+    base_dir : filepath
+        The base directory, holding the model.vtk orientation widget mesh (from ActorCreationCode) and the full_images_viridis folder the images are written to (in a folder per patient)
+    summary_at_pts_dir : filepath
+        The base directory of the patient directories which store the summary at points files (from step 5)
+    mesh_base_dir : filepath
+        The base directory of the patient directories which store the STAPLE meshes
+    patient_IDs : array of str
+        The patient numbers
+    cache : pipeline_cache.PipelineCache, optional
+        If given, the images of a summary are skipped if the summary, the mesh and the views are unchanged since they were rendered
+    run_log : run_metrics.RunLog, optional
+        If given, the metrics of every summary rendered (and of the whole step) are appended to this run log
+    workers : int
+        Number of renderer processes to spread the patients over
+    view_names : array of str
+        Names of the camera views to render (see the views below), i.e. every view name for the full set of images
+    orbit : OrbitSettings, optional
+        If given, a turntable animation (GIF or MP4) of each measure is also written, i.e. OrbitSettings(n_frames = 36, window_size = [300, 300]) for a quicker, coarser orbit
+    organ_name : str
+        The name of the organ in the STAPLE mesh file names (i.e. left_breast_manual_staple.ply)
+    """
+    stage_timer = run_metrics.JobTimer()
     # mesh for the orientation widget
-    actor_human = pv.read(os.path.join(base_dir, "model.vtk"))
-    pv.global_theme.background = 'white'
+    actor_path = os.path.join(base_dir, "model.vtk")
     # camera views 
     front_view = CameraView('front', 'zx', 180, 0)
     back_view = CameraView('back', 'zx', 0, 0)
     front_left_up_view = CameraView('front_left_up_tilt', 'yx', -60, 15)
-    front_left_down_view = CameraView('front_left_up_tilt', 'yx', -60, -15)
-    front_right_up_view = CameraView('front_right_down_tilt', 'yx', -120, 15)
+    front_left_down_view = CameraView('front_left_down_tilt', 'yx', -60, -15)
+    front_right_up_view = CameraView('front_right_up_tilt', 'yx', -120, 15)
     front_right_down_view = CameraView('front_right_down_tilt', 'yx', -120, -15)
     back_left_up_view = CameraView('back_left_up_tilt', 'yx', 60, 15)
-    back_left_down_view = CameraView('back_left_up_tilt', 'yx', 60, -15)
-    back_right_up_view = CameraView('back_right_down_tilt', 'yx', 120, 15)
+    back_left_down_view = CameraView('back_left_down_tilt', 'yx', 60, -15)
+    back_right_up_view = CameraView('back_right_up_tilt', 'yx', 120, 15)
     back_right_down_view = CameraView('back_right_down_tilt', 'yx', 120, -15)
     directions = [front_view, back_view, front_left_up_view, front_left_down_view, front_right_up_view, front_right_down_view, back_left_up_view, back_left_down_view, back_right_up_view, back_right_down_view]
+    views_by_name = {direction.name: direction for direction in directions}
+    unknown = [name for name in view_names if name not in views_by_name]
+    if len(unknown) > 0:
+        raise ValueError(f"unknown camera views {unknown}, choose from {list(views_by_name)}")
+    plot_directions = [views_by_name[name] for name in view_names]
 
+    #location to save images to 
+    full_image_directory = os.path.join(base_dir, 'full_images_viridis')
+    os.makedirs(full_image_directory, exist_ok=True)
 
+    # the images of each patient still to render
+    patient_jobs = {}
+    cache_keys = {}
     for patient in patient_IDs:
         print("                 Working with patient " + str(patient))
-        os.chdir(os.path.join(mesh_base_dir, patient))
-        
-   
-        ##### REFERENCE MESH
-        # staple meshes 
-        left_staple_manual_mesh = Contour(o3d.io.read_triangle_mesh("left_breast_manual_staple.ply"), "left_staple_manual")
-        right_staple_manual_mesh = Contour(o3d.io.read_triangle_mesh("right_breast_manual_staple.ply"), "right_staple_manual")
-        
         full_contour_sd_directory = os.path.join(summary_at_pts_dir, patient)
-        
-        # FULL CONTOURS 
-        #location to save images to 
-        full_image_directory = os.path.join(base_dir, 'full_images_viridis')
-        if not os.path.exists(full_image_directory):
-            os.makedirs(full_image_directory)
-        
-        # read bidir distance file
         for file in os.listdir(full_contour_sd_directory):
-            if ("left" in file) and (".pkl" in file):
-                df = pd.read_pickle(os.path.join(full_contour_sd_directory, file))
-                
-                os.chdir(full_image_directory)
-                if ("atlas" in file):
-                    print(file)
-                    plotHeatMapImagesOneToMany("left_atlas", left_staple_manual_mesh, df, [back_view], False, actor_human) # replace [back_view] with directions
-                elif ("manual" in file):
-                    print(file)
-                    plotHeatMapImagesOneToMany("left_manual", left_staple_manual_mesh, df, [back_view], False, actor_human) # replace [back_view] with directions
-                 
-
-            elif ("right" in file) and (".pkl" in file):
-                df = pd.read_pickle(os.path.join(full_contour_sd_directory, file))
-
-                os.chdir(full_image_directory)
-                if ("atlas" in file):
-                    print(file)
-                    plotHeatMapImagesOneToMany("right_atlas", right_staple_manual_mesh, df, [back_view], False, actor_human)   # replace [back_view] with directions 
-                elif ("manual" in file):
-                    print(file)
-                    plotHeatMapImagesOneToMany("right_manual", right_staple_manual_mesh, df, [back_view], False, actor_human)   # replace [back_view] with directions 
\ No newline at end of file
+            if not (file.startswith("bidir_sd_mean_at_pt_") and file.endswith(".pkl")):
+                continue
+            # bidir_sd_mean_at_pt_<contour set>_<side>.pkl
+            contour_set, side = file[len("bidir_sd_mean_at_pt_"):-len(".pkl")].rsplit("_", 1)
+            contour = "atlas" if ("atlas" in contour_set) else "manual" if ("manual" in contour_set) else None
+            if side not in ("left", "right") or contour is None:
+                continue
+            # the summary is drawn on the staple mesh of its own contour set (the one its BLDs were calculated on)
+            staple_mesh_path = os.path.join(mesh_base_dir, patient, f"{side}_{organ_name}_{contour_set}_staple.ply")
+            # one folder per patient, as the image names do not hold the patient number
+            job = HeatMapJob(patient, f"{side}_{contour}", os.path.join(full_contour_sd_directory, file), staple_mesh_path, os.path.join(full_image_directory, patient))
+
+            # skip the images if the summary, the mesh and the views are unchanged since they were rendered
+            cache_inputs = [job.summary_path, job.mesh_path]
+            cache_params = {'directions': [[d.name, d.camera_pos, d.azimuth, d.elevation] for d in plot_directions], 
+                            'orbit': orbit.params() if orbit is not None else None}
+            if cache is not None and cache.is_fresh("s7", f"{patient}/{job.comparison_name}", cache_inputs, cache_params, job.image_paths(plot_directions, orbit)):
+                print(f"Skipping {file}: images are up to date")
+                continue
+            cache_keys[(patient, job.comparison_name)] = (cache_inputs, cache_params)
+            patient_jobs.setdefault(patient, []).append(job)
+
+    results = []
+    def finish_patient(jobs, patient_results):
+        for job, result in zip(jobs, patient_results):
+            results.append(result)
+            if result['error'] is not None:
+                continue
+            if run_log is not None:
+                run_log.record("s7", f"{job.patient}/{job.comparison_name}", patient = job.patient, n_vertices = result['n_vertices'], n_images = result['n_images'], n_frames = result['n_frames'], 
+                               wall_time_s = result['wall_time_s'], cpu_time_s = result['cpu_time_s'], peak_rss_mb = result['peak_rss_mb'])
+            if cache is not None:
+                cache_inputs, cache_params = cache_keys[(job.patient, job.comparison_name)]
+                cache.record("s7", f"{job.patient}/{job.comparison_name}", cache_inputs, cache_params, job.image_paths(plot_directions, orbit))
+
+    if len(patient_jobs) > 0:
+        if workers <= 1:
+            renderer = HeatMapRenderer(pv.read(actor_path))
+            try:
+                for patient, jobs in patient_jobs.items():
+                    finish_patient(jobs, render_heat_map_jobs(jobs, plot_directions, renderer, orbit))
+            finally:
+                renderer.close()
+        else:
+            # each worker process keeps one renderer for all the patients it is given
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(actor_path, [500, 500])) as pool:
+                futures = {pool.submit(render_heat_map_jobs, jobs, plot_directions, None, orbit): jobs for jobs in patient_jobs.values()}
+                for future in as_completed(futures):
+                    finish_patient(futures[future], future.result())
+
+    failures = [result for result in results if result['error'] is not None]
+    for result in failures:
+        print(f"Failed: {result['patient']} {result['comparison_name']}\n{result['error']}")
+    if run_log is not None:
+        run_log.record("s7", "all", n_jobs = len(results), n_failed = len(failures), workers = workers, **stage_timer.metrics())
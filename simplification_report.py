@@ -0,0 +1,109 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+import s3_nii_to_meshes
+import s4_calc_BLDs
+import s6_calc_dist_metrics
+
+# Compares the BLD statistics of simplified meshes (see s3_nii_to_meshes.SimplifySettings) with those of the full marching cubes meshes,
+# so that the cheapest mesh resolution which keeps the results within a tolerance can be chosen before running steps 3 to 7 with it.
+
+def _mesh_name(nifti_path):
+    # nifti file name without its extension (.nii or .nii.gz)
+    name = os.path.basename(nifti_path)
+    return name[:-len(".nii.gz")] if name.endswith(".nii.gz") else os.path.splitext(name)[0]
+
+def _blds(reference, comparison, distance_mode):
+    # bidirectional local distances on the reference vertices, from (vertices, triangles) of both meshes
+    if distance_mode == "surface":
+        return s4_calc_BLDs.compute_bidir_surface_distances(reference[0], reference[1], comparison[0], comparison[1])[-1]
+    return s4_calc_BLDs.compute_bidir_distances(reference[0], comparison[0])[-1]
+
+def simplification_report(ref_nifti_path, comparison_nifti_paths, candidates, level = 0.5, crop = True, distance_mode = "vertex", percentiles = (95,), tolerance_mm = 0.5, output_path = None):
+    """
+    simplification_report : Calculates the BLD statistics (see s6_calc_dist_metrics.distance_metrics) of every comparison against one reference contour with the full marching cubes meshes, and again with the meshes simplified by each candidate setting,
+    and reports the vertex counts, the simplification and BLD times, and the change in each statistic.
+
+
+    Parameters
+    ----------
+    ref_nifti_path : filepath
+        The nifti file of the reference (STAPLE) contour
+    comparison_nifti_paths : array of filepath
+        The nifti files of the comparison (observer) contours
+    candidates : dict
+        name -> s3_nii_to_meshes.SimplifySettings object, i.e. {"cluster 0.5 mm": SimplifySettings("clustering", max_error_mm = 0.5), "quadric 5000": SimplifySettings("quadric", target_vertices = 5000)}
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, meshes only the bounding box of each mask
+    distance_mode : str
+        "vertex" or "surface" (see s4_calc_BLDs.bidir_distances)
+    percentiles : array of float
+        Percentiles of the BLDs to report (the 95th as HD95)
+    tolerance_mm : float
+        Largest change of any statistic (in mm) for a candidate to be within tolerance
+    output_path : filepath, optional
+        If given, the report is also written to this .csv file
+
+    Returns
+    -------
+    report : pd.DataFrame
+        one row per candidate (the full meshes as "full") and comparison, with the vertex counts, times, statistics, the change in each statistic and whether every change is within tolerance_mm
+    summary : pd.DataFrame
+        one row per candidate, with the total vertex count (and as a fraction of the full meshes), the total simplification and BLD time, the largest absolute change of any statistic and whether it is within tolerance_mm, sorted from the fewest vertices
+    """
+    if distance_mode not in s4_calc_BLDs.DISTANCE_MODES:
+        raise ValueError(f"distance_mode must be one of {s4_calc_BLDs.DISTANCE_MODES}, not {distance_mode!r}")
+    # marching cubes once per mask, shared by every candidate
+    full_meshes = []
+    for nifti_path in [ref_nifti_path] + list(comparison_nifti_paths):
+        verts, faces, normals, _ = s3_nii_to_meshes.mesh_arrays_from_image(sitk.ReadImage(nifti_path), level, crop)
+        if len(verts) == 0:
+            raise ValueError(f"no surface found in {nifti_path}")
+        full_meshes.append((verts, faces, normals))
+    comparison_names = [_mesh_name(path) for path in comparison_nifti_paths]
+
+    records = []
+    baseline = None
+    for candidate, simplify in [("full", None)] + list(candidates.items()):
+        t_start = time.perf_counter()
+        meshes = [s3_nii_to_meshes.simplify_mesh_arrays(verts, faces, normals, simplify) for verts, faces, normals in full_meshes]
+        simplify_time = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        blds = np.vstack([_blds(meshes[0], comparison, distance_mode) for comparison in meshes[1:]])
+        bld_time = time.perf_counter() - t_start
+        metrics = s6_calc_dist_metrics.distance_metrics(blds, percentiles)
+        if baseline is None:
+            baseline = metrics
+
+        for n, name in enumerate(comparison_names):
+            record = {'candidate': candidate, 'settings': simplify.params() if simplify is not None else None, 'comparison': name,
+                      'n_reference_vertices': len(meshes[0][0]), 'n_comparison_vertices': len(meshes[n+1][0]),
+                      # the times of the whole candidate are split evenly over its comparisons
+                      'simplify_time_s': simplify_time / len(comparison_names), 'bld_time_s': bld_time / len(comparison_names)}
+            changes = []
+            for metric, values in metrics.items():
+                record[metric] = values[n]
+                record[f"{metric} change (mm)"] = values[n] - baseline[metric][n]
+                changes.append(abs(values[n] - baseline[metric][n]))
+            record['max abs change (mm)'] = max(changes)
+            record['within tolerance'] = max(changes) <= tolerance_mm
+            records.append(record)
+    report = pd.DataFrame(records)
+
+    n_full = report.loc[report['candidate'] == "full", 'n_comparison_vertices'].sum() + report.loc[report['candidate'] == "full", 'n_reference_vertices'].iloc[0]
+    summary = report.groupby('candidate', sort = False).agg(n_reference_vertices = ('n_reference_vertices', 'first'), n_comparison_vertices = ('n_comparison_vertices', 'sum'),
+                                                            simplify_time_s = ('simplify_time_s', 'sum'), bld_time_s = ('bld_time_s', 'sum'),
+                                                            max_abs_change_mm = ('max abs change (mm)', 'max')).reset_index()
+    summary['n_vertices'] = summary['n_reference_vertices'] + summary['n_comparison_vertices']
+    summary['vertex_fraction'] = summary['n_vertices'] / n_full
+    summary['within tolerance'] = summary['max_abs_change_mm'] <= tolerance_mm
+    summary = summary.sort_values('n_vertices', kind = 'stable').reset_index(drop = True)
+
+    if output_path is not None:
+        report.to_csv(output_path, index = False)
+    print(summary.to_string(index = False))
+    return report, summary
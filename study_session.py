@@ -0,0 +1,374 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+import numeric_precision
+import s2_get_staple_contours
+import s3_nii_to_meshes
+import s4_calc_BLDs
+import s5_calc_SDs
+import s6_calc_dist_metrics
+
+# Runs steps 2 to 6 on masks, meshes and BLD vectors held in memory, for use from a long-running process (i.e. a service or a thread pool worker) instead of the file based s<n>_main functions.
+# Every object is keyed by (patient, side, contour set, observer), and files are only read or written when asked for, at absolute paths. Nothing here changes the working directory or keeps global state,
+# so each worker can hold its own StudySession and keep the meshes and reference lookup trees of recent studies warm between requests.
+
+# observer of the STAPLE (reference) contour in a key, i.e. ("1", "left", "manual", STAPLE_OBSERVER)
+STAPLE_OBSERVER = "staple"
+
+def contour_name(key):
+    """
+    contour_name : Returns the name steps 3 and 4 give the contour of a key, i.e. left_manual_2 for ("1", "left", "manual", 2) and left_manual_staple for the STAPLE contour.
+
+
+    Parameters
+    ----------
+    key : tuple
+        (patient, side, contour set, observer), with observer the observer number or STAPLE_OBSERVER
+
+    Returns
+    -------
+    name : str
+    """
+    _, side, contour_set, observer = key
+    return f"{side}_{contour_set}_{observer}"
+
+def mesh_file_name(key, organ_name = "breast"):
+    """
+    mesh_file_name : Returns the name of the .ply file step 3 writes the mesh of a key to (the STAPLE contour's includes the organ name, i.e. left_breast_manual_staple.ply).
+
+
+    Parameters
+    ----------
+    key : tuple
+        (patient, side, contour set, observer)
+    organ_name : str
+        The organ name which is featured in the name of the STAPLE contour's files
+
+    Returns
+    -------
+    name : str
+    """
+    _, side, contour_set, observer = key
+    if observer == STAPLE_OBSERVER:
+        return f"{side}_{organ_name}_{contour_set}_staple.ply"
+    return f"{contour_name(key)}.ply"
+
+class StudySession:
+    """
+    A class to hold the masks, meshes, reference lookup trees and BLDs of the studies a worker is working on, calculating each the first time it is asked for and keeping it until it is forgotten.
+    The calculations are the ones steps 2 to 6 run on files (see s2_get_staple_contours.staple_from_images, s3_nii_to_meshes.mesh_arrays_from_image, s4_calc_BLDs.reference_distances, s5_calc_SDs.summary_frame and s6_calc_dist_metrics.distance_metrics).
+    A session is not locked, so it should be used by one thread at a time (give each worker its own session)
+    ...
+
+    Attributes
+    ----------
+    level : float
+        The marching cubes iso-level
+    crop : bool
+        If True, STAPLE is run on the union bounding box of the observers' masks, and only the bounding box of each mask is meshed
+    simplify : s3_nii_to_meshes.SimplifySettings object or None
+        How to smooth and simplify the meshes (none if None)
+    distance_mode : str
+        One of s4_calc_BLDs.DISTANCE_MODES
+    tree_settings : s4_calc_BLDs.TreeSettings object or None
+        Build and query settings of the reference lookup trees
+    precision : str
+        One of numeric_precision.PRECISIONS, the precision the meshes, distances and summaries are held in
+    masks : dict
+        key -> SimpleITK.Image of each mask (the STAPLE probability image for STAPLE keys)
+    staple_details : dict
+        (patient, side, contour set) -> sensitivity, specificity and iterations of each STAPLE contour made in this session (see s2_get_staple_contours.staple_from_images)
+    meshes : dict
+        key -> (vertices, triangles, normals) arrays of each mesh
+    references : dict
+        (patient, side, contour set) -> s4_calc_BLDs.ReferenceIndex of the STAPLE mesh, which also caches the distances of every observer measured against it
+
+    Methods
+    -------
+    add_mask(key, image)
+        stores a mask, forgetting anything calculated from an earlier mask of the key
+    load_mask(key, nifti_path)
+        reads a mask from a nifti file
+    load_patient(nifti_base_dir, patient, sides, contour_sets, observers, organ_name, nifti_extension, load_staple, staple_extension)
+        reads the masks of a patient from the nifti files of steps 1 and 2
+    add_mesh(key, vertices, triangles, normals)
+        stores a mesh built elsewhere (i.e. read from a .ply file of step 3)
+    observers(patient, side, contour_set)
+        returns the observer numbers of a contour set with a mask or mesh
+    staple(patient, side, contour_set)
+        returns the STAPLE image of a contour set, making it from the observers' masks if it is not held
+    mesh(key)
+        returns the mesh arrays of a key, meshing its mask if the mesh is not held
+    reference(patient, side, contour_set)
+        returns the ReferenceIndex of a contour set's STAPLE mesh
+    blds(key)
+        returns the one-sided and bidirectional local distances of an observer's contour against the STAPLE contour
+    point_summary(patient, side, contour_set)
+        returns the summary at points table of a contour set (as step 5 writes it)
+    metrics(patient, side, contour_set, percentiles)
+        returns the distance metrics of every observer of a contour set (as step 6 calculates them)
+    write_mesh(key, mesh_base_dir, organ_name)
+        writes a mesh to the .ply file step 3 would write it to
+    write_blds(key, bld_dfs_dir, output_format)
+        writes an observer's BLD tables where step 4 would write them
+    write_point_summary(patient, side, contour_set, summary_at_pts_dir)
+        writes the summary at points files where step 5 would write them
+    release_masks(patient)
+        forgets the masks (keeping the meshes warm)
+    forget(patient)
+        forgets everything held for a patient (or for every patient)
+    """
+    def __init__(self, level = 0.5, crop = True, simplify = None, distance_mode = "vertex", tree_settings = None, precision = "float64"):
+        if distance_mode not in s4_calc_BLDs.DISTANCE_MODES:
+            raise ValueError(f"distance_mode must be one of {s4_calc_BLDs.DISTANCE_MODES}, not {distance_mode!r}")
+        self.level = level
+        self.crop = crop
+        self.simplify = simplify
+        self.distance_mode = distance_mode
+        self.tree_settings = tree_settings
+        self.precision = numeric_precision.check_precision(precision)
+        self.masks = {}
+        self.staple_details = {}
+        self.meshes = {}
+        self.references = {}
+
+    def _forget_derived(self, key, mask_changed = True):
+        # drops what was calculated from the mask or mesh of key (and, if its mask changed, the STAPLE contour of its contour set if the session made it from the observers' masks)
+        group = key[:3]
+        self.meshes.pop(key, None)
+        if key[3] == STAPLE_OBSERVER:
+            self.references.pop(group, None)
+            self.staple_details.pop(group, None)
+            return
+        reference = self.references.get(group)
+        if reference is not None:
+            reference.results.pop(contour_name(key), None)
+        if mask_changed and group in self.staple_details:
+            staple_key = group + (STAPLE_OBSERVER,)
+            self.masks.pop(staple_key, None)
+            self._forget_derived(staple_key)
+
+    def add_mask(self, key, image):
+        self._forget_derived(key)
+        self.masks[key] = image
+        return key
+
+    def load_mask(self, key, nifti_path):
+        return self.add_mask(key, sitk.ReadImage(os.path.abspath(nifti_path)))
+
+    def load_patient(self, nifti_base_dir, patient, sides, contour_sets, observers, organ_name = "breast", nifti_extension = ".nii", load_staple = False, staple_extension = ".nii"):
+        """
+        load_patient : Reads the observers' masks of a patient from the nifti files written by step 1 (named as steps 2 and 3 expect them), and optionally the STAPLE contours written by step 2.
+
+
+        Parameters
+        ----------
+        nifti_base_dir : filepath
+            The base directory of the patient directories which store the nifti files
+        patient : str
+            The patient number
+        sides : array of str
+            The laterality of the organ contours, i.e. ["left", "right"]
+        contour_sets : array of str
+            The contour sets, i.e. ["manual", "atlas_edited"]
+        observers : array of str
+            The observer parts of the region of interest names (i.e. "_breast_1_"), observer n+1 is observers[n]
+        organ_name : str
+            The organ name which is featured in the name of the STAPLE contour's nifti file
+        nifti_extension : str
+            Extension of the observers' nifti files written in step 1
+        load_staple : bool
+            If True, the STAPLE contours are read from step 2's nifti files, otherwise they are made in memory when first needed (see staple)
+        staple_extension : str
+            Extension of the STAPLE contours' nifti files (step 2 writes .nii files, whatever the observers' extension)
+
+        Returns
+        -------
+        keys : list of tuple
+            the keys of the masks read
+        """
+        pt_nifti_dir = os.path.join(os.path.abspath(nifti_base_dir), patient)
+        if not os.path.isdir(pt_nifti_dir):
+            raise FileNotFoundError(f"could not find the nifti directory for patient {patient} ({pt_nifti_dir})")
+        keys = []
+        for side in sides:
+            for contour_set in contour_sets:
+                for n in range(0,len(observers)):
+                    keys.append(self.load_mask((patient, side, contour_set, n+1), os.path.join(pt_nifti_dir, f"{side}{observers[n]}{contour_set}{nifti_extension}")))
+                if load_staple:
+                    keys.append(self.load_mask((patient, side, contour_set, STAPLE_OBSERVER), os.path.join(pt_nifti_dir, f"{side}_{organ_name}_{contour_set}_staple{staple_extension}")))
+        return keys
+
+    def add_mesh(self, key, vertices, triangles, normals):
+        self._forget_derived(key, mask_changed = False)
+        self.meshes[key] = (numeric_precision.compact_floats(vertices, self.precision), numeric_precision.compact_indices(np.asarray(triangles), self.precision),
+                            numeric_precision.compact_floats(normals, self.precision))
+        return key
+
+    def observers(self, patient, side, contour_set):
+        group = (patient, side, contour_set)
+        numbers = set(key[3] for key in list(self.masks) + list(self.meshes) if key[:3] == group and key[3] != STAPLE_OBSERVER)
+        return sorted(numbers)
+
+    def staple(self, patient, side, contour_set):
+        """
+        staple : Returns the STAPLE contour of a contour set, made from the masks of its observers (in observer order) the first time it is asked for, unless one was added or loaded.
+
+
+        Parameters
+        ----------
+        patient, side, contour_set : str
+            The contour set
+
+        Returns
+        -------
+        image : SimpleITK.Image
+            the STAPLE probability image
+        """
+        group = (patient, side, contour_set)
+        key = group + (STAPLE_OBSERVER,)
+        if key not in self.masks:
+            observers = [n for n in self.observers(*group) if group + (n,) in self.masks]
+            if len(observers) == 0:
+                raise KeyError(f"no observer masks are held for {group}")
+            image, details = s2_get_staple_contours.staple_from_images([self.masks[group + (n,)] for n in observers], crop = self.crop)
+            self.masks[key] = image
+            self.staple_details[group] = dict(details, observers = observers)
+        return self.masks[key]
+
+    def mesh(self, key):
+        """
+        mesh : Returns the mesh of a contour, meshing its mask (as step 3 does, see s3_nii_to_meshes.build_mesh) the first time it is asked for.
+
+
+        Parameters
+        ----------
+        key : tuple
+            (patient, side, contour set, observer)
+
+        Returns
+        -------
+        vertices, triangles, normals : np.array
+            the mesh arrays, in the session's precision
+        """
+        if key not in self.meshes:
+            if key[3] == STAPLE_OBSERVER:
+                image = self.staple(*key[:3])
+            elif key in self.masks:
+                image = self.masks[key]
+            else:
+                raise KeyError(f"no mask or mesh is held for {key}")
+            # simplified meshes are compacted after Open3D simplifies them in double precision
+            verts, faces, normals, _ = s3_nii_to_meshes.mesh_arrays_from_image(image, self.level, self.crop, self.precision if self.simplify is None else "float64")
+            if len(verts) == 0:
+                raise ValueError(f"no surface found in the mask of {key}")
+            self.meshes[key] = s3_nii_to_meshes.simplify_mesh_arrays(verts, faces, normals, self.simplify, self.precision)
+        return self.meshes[key]
+
+    def reference(self, patient, side, contour_set):
+        group = (patient, side, contour_set)
+        if group not in self.references:
+            verts, faces, _ = self.mesh(group + (STAPLE_OBSERVER,))
+            # the distances of every observer are cached in the reference index, so they are only calculated once
+            self.references[group] = s4_calc_BLDs.ReferenceIndex(s4_calc_BLDs.Contour(s4_calc_BLDs.MeshArrays(verts, faces), contour_name(group + (STAPLE_OBSERVER,))),
+                                                                 cache_results = True, tree_settings = self.tree_settings, precision = self.precision)
+        return self.references[group]
+
+    def blds(self, key):
+        """
+        blds : Returns the distances of an observer's contour to and from the STAPLE contour of its contour set (as step 4 calculates them, see s4_calc_BLDs.bidir_distances).
+
+
+        Parameters
+        ----------
+        key : tuple
+            (patient, side, contour set, observer number)
+
+        Returns
+        -------
+        distances : dict
+            'bidir_distance_on_reference' and 'distance from reference' (at each reference vertex), 'distance from comparison' and 'nearest reference vertex' (at each comparison vertex)
+        """
+        if key[3] == STAPLE_OBSERVER:
+            raise ValueError("the BLDs are measured from the STAPLE contour to an observer's contour, not to itself")
+        reference = self.reference(*key[:3])
+        verts, faces, _ = self.mesh(key)
+        result = s4_calc_BLDs.reference_distances(reference, contour_name(key), verts, faces, self.distance_mode)
+        # the surface mode also returns the closest points, so the distances are picked by their position from each end
+        return {'bidir_distance_on_reference': result[-1], 'distance from reference': result[0], 'distance from comparison': result[2], 'nearest reference vertex': result[-2]}
+
+    def point_summary(self, patient, side, contour_set):
+        """
+        point_summary : Returns the summary at points table of a contour set, with the BLDs of every observer held and their mean and standard deviation at each STAPLE vertex (as step 5 writes it, see s5_calc_SDs.summary_frame).
+
+
+        Parameters
+        ----------
+        patient, side, contour_set : str
+            The contour set
+
+        Returns
+        -------
+        merged_df : pd.DataFrame
+            the summary at points, with the reference name and hash in its attrs (so step 7 can draw it on the STAPLE mesh)
+        """
+        group = (patient, side, contour_set)
+        observers = self.observers(*group)
+        reference = self.reference(*group)
+        bld_matrix = np.column_stack([self.blds(group + (n,))['bidir_distance_on_reference'] for n in observers])
+        return s5_calc_SDs.summary_frame(reference.vertices, bld_matrix, reference.name, reference.vertex_hash, observers = observers, precision = self.precision)
+
+    def metrics(self, patient, side, contour_set, percentiles = (95,)):
+        """
+        metrics : Returns the distance metrics (mean DTA, Hausdorff and percentiles of the BLDs, see s6_calc_dist_metrics.distance_metrics) of every observer of a contour set.
+
+
+        Parameters
+        ----------
+        patient, side, contour_set : str
+            The contour set
+        percentiles : array of float
+            Percentiles of the BLDs to report (the 95th as HD95)
+
+        Returns
+        -------
+        metrics : dict
+            observer number -> {metric name: value}
+        """
+        group = (patient, side, contour_set)
+        observers = self.observers(*group)
+        values = s6_calc_dist_metrics.distance_metrics(np.vstack([self.blds(group + (n,))['bidir_distance_on_reference'] for n in observers]), percentiles)
+        return {n: {metric: float(values[metric][i]) for metric in values} for i, n in enumerate(observers)}
+
+    def write_mesh(self, key, mesh_base_dir, organ_name = "breast"):
+        mesh_pt_dir = os.path.join(os.path.abspath(mesh_base_dir), key[0])
+        os.makedirs(mesh_pt_dir, exist_ok=True)
+        verts, faces, normals = self.mesh(key)
+        return s3_nii_to_meshes.write_mesh_arrays(os.path.join(mesh_pt_dir, mesh_file_name(key, organ_name)), verts, faces, normals)
+
+    def write_blds(self, key, bld_dfs_dir, output_format = "pickle"):
+        # the distances are taken from the reference index's cache, so writing them does not measure them again
+        self.blds(key)
+        reference = self.reference(*key[:3])
+        pt_bidir_df_dir = os.path.join(os.path.abspath(bld_dfs_dir), key[0])
+        os.makedirs(pt_bidir_df_dir, exist_ok=True)
+        verts, faces, _ = self.mesh(key)
+        return s4_calc_BLDs.bidir_distances(pt_bidir_df_dir, s4_calc_BLDs.Contour(s4_calc_BLDs.MeshArrays(reference.vertices, reference.triangles), reference.name),
+                                            s4_calc_BLDs.Contour(s4_calc_BLDs.MeshArrays(verts, faces), contour_name(key)), reference_index = reference,
+                                            output_format = output_format, distance_mode = self.distance_mode)
+
+    def write_point_summary(self, patient, side, contour_set, summary_at_pts_dir):
+        output_dir = os.path.join(os.path.abspath(summary_at_pts_dir), patient)
+        os.makedirs(output_dir, exist_ok=True)
+        merged_df = self.point_summary(patient, side, contour_set)
+        s5_calc_SDs.write_summary_frame(merged_df, output_dir, contour_set, side)
+        return merged_df
+
+    def release_masks(self, patient = None):
+        for key in [key for key in self.masks if patient is None or key[0] == patient]:
+            del self.masks[key]
+
+    def forget(self, patient = None):
+        for store in (self.masks, self.staple_details, self.meshes, self.references):
+            for key in [key for key in store if patient is None or key[0] == patient]:
+                del store[key]
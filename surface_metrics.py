@@ -0,0 +1,79 @@
+import numpy as np
+
+# tolerances (in mm) of the surface Dice reported by default
+SURFACE_DICE_TOLERANCES = (1.0, 2.0, 3.0)
+
+def _segments(arrays):
+    # concatenates arrays of different lengths, returning the values, the array each value came from and the length of each array
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    values = np.concatenate([np.asarray(a, dtype=np.float64) for a in arrays])
+    return values, np.repeat(np.arange(len(arrays)), lengths), lengths
+
+def segment_percentiles(values, segment, lengths, q):
+    """
+    segment_percentiles : Calculates a percentile of every segment of a concatenated array at once, with the linear interpolation of np.percentile.
+
+
+    Parameters
+    ----------
+    values : np.array (n,)
+        The concatenated values of all segments
+    segment : np.array (n,)
+        The segment of each value (segments numbered from 0, in order)
+    lengths : np.array (n_segments,)
+        The number of values of each segment (all greater than 0)
+    q : float
+        The percentile (between 0 and 100)
+
+    Returns
+    -------
+    percentiles : np.array (n_segments,)
+    """
+    # sort the values within each segment, keeping the segments in order
+    sorted_values = values[np.lexsort((values, segment))]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    position = (q / 100.0) * (lengths - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, lengths - 1)
+    fraction = position - lower
+    return sorted_values[starts + lower] * (1 - fraction) + sorted_values[starts + upper] * fraction
+
+def surface_metrics(forward, reverse, tolerances = SURFACE_DICE_TOLERANCES):
+    """
+    surface_metrics : Calculates the symmetric surface distance metrics of several comparisons at once, from the distances already calculated in step 4:
+    from each reference vertex to the comparison contour (forward, "distance from reference") and from each comparison vertex to the reference contour (reverse, "distance from comparison").
+    Each comparison's metrics are taken over the distances of both surfaces together, counting every vertex once (the distances are not weighted by the surface area around each vertex).
+
+
+    Parameters
+    ----------
+    forward : array of np.array
+        The reference-to-comparison distance at each reference vertex, one array per comparison
+    reverse : array of np.array
+        The comparison-to-reference distance at each comparison vertex, one array per comparison (the arrays can have different lengths)
+    tolerances : array of float
+        The tolerances (in mm) to calculate the surface Dice at
+
+    Returns
+    -------
+    metrics : dict
+        metric name -> np.array (n_comparisons,):
+        Surface HD95 (95th percentile of the distances of both surfaces), Surface median, Mean surface distance, Surface RMS (root mean square distance), Hausdorff (maximum, the same as the maximum BLD),
+        and Surface Dice (<t> mm) for each tolerance t (fraction of the vertices of both surfaces within t of the other surface)
+    """
+    if len(forward) != len(reverse) or len(forward) == 0:
+        raise ValueError(f"need the same number (at least one) of forward and reverse distance arrays, got {len(forward)} and {len(reverse)}")
+    values, segment, lengths = _segments([np.concatenate((np.asarray(f, dtype=np.float64), np.asarray(r, dtype=np.float64))) for f, r in zip(forward, reverse)])
+    if np.any(lengths == 0):
+        raise ValueError("every comparison needs at least one distance")
+    n_segments = len(lengths)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    metrics = {'Surface HD95': segment_percentiles(values, segment, lengths, 95),
+               'Surface median': segment_percentiles(values, segment, lengths, 50),
+               'Mean surface distance': np.bincount(segment, weights = values, minlength = n_segments) / lengths,
+               'Surface RMS': np.sqrt(np.bincount(segment, weights = values**2, minlength = n_segments) / lengths),
+               'Hausdorff': np.maximum.reduceat(values, starts)}
+    for tolerance in tolerances:
+        metrics[f"Surface Dice ({tolerance:g} mm)"] = np.bincount(segment, weights = (values <= tolerance).astype(np.float64), minlength = n_segments) / lengths
+    return metrics
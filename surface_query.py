@@ -0,0 +1,197 @@
+import numpy as np
+import open3d as o3d
+from scipy.spatial import cKDTree
+
+# engines which can find the closest point on a triangulated surface (see SurfaceIndex)
+SURFACE_ENGINES = ["auto", "open3d", "kdtree"]
+
+# number of query points handled at once by the kdtree engine, to bound the memory of the candidate triangle arrays
+QUERY_BATCH_SIZE = 4096
+
+def _open3d_has_raycasting():
+    # the tensor geometry module (and RaycastingScene) is only in Open3D >= 0.14
+    return hasattr(o3d, "t") and hasattr(o3d.t, "geometry") and hasattr(o3d.t.geometry, "RaycastingScene")
+
+def closest_points_on_triangles(points, a, b, c):
+    """
+    closest_points_on_triangles : Finds the closest point on each triangle (a[i], b[i], c[i]) to points[i], by checking which Voronoi region of the triangle (vertex, edge or face) the point projects into (Ericson, Real-Time Collision Detection, 5.1.5).
+
+
+    Parameters
+    ----------
+    points : np.array (n, 3)
+        The query points
+    a, b, c : np.array (n, 3)
+        The corners of the triangle paired with each query point
+
+    Returns
+    -------
+    closest : np.array (n, 3)
+        The closest point on each triangle
+    """
+    def dot(u, v):
+        return np.einsum('ij,ij->i', u, v)
+
+    ab = b - a
+    ac = c - a
+    bc = c - b
+    ap = points - a
+    bp = points - b
+    cp = points - c
+    d1 = dot(ab, ap)
+    d2 = dot(ac, ap)
+    d3 = dot(ab, bp)
+    d4 = dot(ac, bp)
+    d5 = dot(ab, cp)
+    d6 = dot(ac, cp)
+    va = d3*d6 - d5*d4
+    vb = d5*d2 - d1*d6
+    vc = d1*d4 - d3*d2
+
+    closest = np.empty_like(points)
+    done = np.zeros(len(points), dtype=bool)
+    # the denominators are only zero outside the region they are used in
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # vertex regions
+        for region, corner in [((d1 <= 0) & (d2 <= 0), a),
+                               ((d3 >= 0) & (d4 <= d3), b),
+                               ((d6 >= 0) & (d5 <= d6), c)]:
+            region &= ~done
+            closest[region] = corner[region]
+            done |= region
+        # edge regions
+        for region, start, edge, t in [((vc <= 0) & (d1 >= 0) & (d3 <= 0), a, ab, d1 / (d1 - d3)),
+                                       ((vb <= 0) & (d2 >= 0) & (d6 <= 0), a, ac, d2 / (d2 - d6)),
+                                       ((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0), b, bc, (d4 - d3) / ((d4 - d3) + (d5 - d6)))]:
+            region &= ~done
+            closest[region] = start[region] + t[region, None] * edge[region]
+            done |= region
+        # face region, from the barycentric coordinates of the projection
+        region = ~done
+        denom = va + vb + vc
+        v = vb / denom
+        w = vc / denom
+        closest[region] = a[region] + v[region, None] * ab[region] + w[region, None] * ac[region]
+    return closest
+
+class SurfaceIndex:
+    """
+    A class to find the closest point on a triangulated surface to each of a set of query points (point-to-triangle distances, as opposed to the vertex-to-vertex distances of a KDTree on the vertices)
+    ...
+
+    Attributes
+    ----------
+    vertices : np.array (n, 3)
+        vertex coordinates of the surface mesh
+    triangles : np.array (m, 3)
+        vertex indices of each triangle of the surface mesh
+    engine : str
+        "open3d" to query an Open3D RaycastingScene (a BVH over the triangles, float32), or "kdtree" to find the candidate triangles with scipy KDTrees and measure them exactly in float64
+    scene : open3d.t.geometry.RaycastingScene
+        the Open3D scene (open3d engine only)
+    vertex_tree : scipy.spatial.cKDTree
+        lookup tree on the vertices used by the triangles (kdtree engine only)
+    centroid_tree : scipy.spatial.cKDTree
+        lookup tree on the triangle centroids (kdtree engine only)
+    radius : float
+        largest distance from a triangle centroid to one of its corners (kdtree engine only)
+
+    Methods
+    -------
+    closest_points(points)
+        returns the distance to, the location of and the triangle of the closest point on the surface to each query point
+    """
+    def __init__(self, vertices, triangles, engine = "auto"):
+        if engine not in SURFACE_ENGINES:
+            raise ValueError(f"engine must be one of {SURFACE_ENGINES}, not {engine!r}")
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        if len(self.triangles) == 0:
+            raise ValueError("cannot measure distances to a surface without triangles")
+        if engine == "auto":
+            engine = "open3d" if _open3d_has_raycasting() else "kdtree"
+        self.engine = engine
+
+        if engine == "open3d":
+            self.scene = o3d.t.geometry.RaycastingScene()
+            self.scene.add_triangles(o3d.core.Tensor(self.vertices.astype(np.float32)), o3d.core.Tensor(self.triangles.astype(np.uint32)))
+        else:
+            corners = self.vertices[self.triangles]
+            centroids = corners.mean(axis=1)
+            self.radius = float(np.linalg.norm(corners - centroids[:, None, :], axis=2).max())
+            self.centroid_tree = cKDTree(centroids)
+            # only vertices used by a triangle, so that the nearest vertex always has a triangle within the search radius
+            self.vertex_tree = cKDTree(self.vertices[np.unique(self.triangles)])
+
+    def closest_points(self, points):
+        """
+        closest_points : Finds the closest point on the surface to each query point.
+
+
+        Parameters
+        ----------
+        points : np.array (n, 3)
+            The query points
+
+        Returns
+        -------
+        distances : np.array (n,)
+            distance from each query point to the surface
+        closest : np.array (n, 3)
+            closest point on the surface to each query point
+        triangle_ids : np.array (n,)
+            index of the triangle the closest point lies on
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if self.engine == "open3d":
+            answer = self.scene.compute_closest_points(o3d.core.Tensor(points.astype(np.float32)))
+            closest = answer['points'].numpy().astype(np.float64)
+            triangle_ids = answer['primitive_ids'].numpy().astype(np.int64)
+        else:
+            closest = np.empty_like(points)
+            triangle_ids = np.empty(len(points), dtype=np.int64)
+            for start in range(0, len(points), QUERY_BATCH_SIZE):
+                batch = slice(start, start + QUERY_BATCH_SIZE)
+                closest[batch], triangle_ids[batch] = self._closest_points_kdtree(points[batch])
+        distances = np.linalg.norm(points - closest, axis=1)
+        return distances, closest, triangle_ids
+
+    def _closest_points_kdtree(self, points):
+        # the nearest vertex is on the surface, so the closest point is no further away than it.
+        # A triangle holding a point that close has its centroid within (that distance + radius) of the query point, so only those triangles are measured
+        vertex_dists, _ = self.vertex_tree.query(points)
+        candidates = self.centroid_tree.query_ball_point(points, vertex_dists + self.radius + 1e-9, return_sorted = False)
+        counts = np.fromiter(map(len, candidates), dtype=np.int64, count=len(candidates))
+        triangle_ids = np.concatenate(candidates).astype(np.int64)
+        owners = np.repeat(np.arange(len(points)), counts)
+
+        corners = self.vertices[self.triangles[triangle_ids]]
+        closest = closest_points_on_triangles(points[owners], corners[:, 0], corners[:, 1], corners[:, 2])
+        offsets = points[owners] - closest
+        dist2 = np.einsum('ij,ij->i', offsets, offsets)
+
+        # the closest candidate of each query point (owners is sorted, so each point's candidates stay together, nearest first)
+        order = np.lexsort((dist2, owners))
+        best = order[np.concatenate(([0], np.cumsum(counts)[:-1]))]
+        return closest[best], triangle_ids[best]
+
+    def nearest_corner(self, closest, triangle_ids):
+        """
+        nearest_corner : Returns the index of the vertex of each triangle nearest to a point on it, i.e. the mesh vertex a closest point is assigned to.
+
+
+        Parameters
+        ----------
+        closest : np.array (n, 3)
+            Points on the surface (from closest_points)
+        triangle_ids : np.array (n,)
+            The triangle each point lies on
+
+        Returns
+        -------
+        vertex_index : np.array (n,)
+            index into vertices of the nearest corner of each point's triangle
+        """
+        corner_ids = self.triangles[triangle_ids]
+        corner_dists = np.linalg.norm(self.vertices[corner_ids] - closest[:, None, :], axis=2)
+        return corner_ids[np.arange(len(corner_ids)), np.argmin(corner_dists, axis=1)]
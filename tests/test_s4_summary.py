@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import SimpleITK as sitk
+
+pytest.importorskip("open3d")
+
+import benchmark_pipeline
+import s3_nii_to_meshes
+import s4_calc_BLDs
+import s5_calc_SDs
+
+
+OBSERVERS = ["_breast_1_", "_breast_2_"]
+
+
+def _run_step_4(tmp_path, fused):
+    # steps 3 and 4 (or the fused step), summarising the BLDs at the points of the reference as they are calculated
+    nifti_dir, mesh_dir, bld_dir = str(tmp_path / "nifti"), str(tmp_path / "mesh"), str(tmp_path / "bld")
+    summary_dir = str(tmp_path / "summary")
+    if fused:
+        return s4_calc_BLDs.s4_fused_main(nifti_dir, bld_dir, ["1"], OBSERVERS, ["left"], ["manual"], summary_at_pts_dir = summary_dir)
+    s3_nii_to_meshes.s3_main(nifti_dir, mesh_dir, ["1"], OBSERVERS, ["left"], ["manual"])
+    return s4_calc_BLDs.s4_main(mesh_dir, bld_dir, ["1"], OBSERVERS, ["left"], ["manual"], summary_at_pts_dir = summary_dir)
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_point_summary_after_staple_change(tmp_path, fused):
+    # a second run on a different STAPLE mesh rewrites every table, and its point summary must match step 5 on the new tables
+    spacing = (1.0, 1.0, 2.5)
+    paths = benchmark_pipeline.write_synthetic_patient(str(tmp_path / "nifti" / "1"), spacing, len(OBSERVERS))
+    _run_step_4(tmp_path, fused)
+
+    sitk.WriteImage(benchmark_pipeline.perturbed_ellipsoid_mask(spacing, amplitude = 0.05, rng = np.random.default_rng(1)), paths['staple'])
+    results = _run_step_4(tmp_path, fused)
+    assert all(result['error'] is None for result in results)
+
+    summary_name = os.path.join("1", "bidir_sd_mean_at_pt_manual_left.pkl")
+    s5_calc_SDs.s5_main(str(tmp_path / "bld"), str(tmp_path / "batch"), ["1"], OBSERVERS, ["left"], ["manual"])
+    summary = pd.read_pickle(str(tmp_path / "summary" / summary_name))
+    batch = pd.read_pickle(str(tmp_path / "batch" / summary_name))
+    columns = ["reference_X", "reference_Y", "reference_Z", "mean_at_point", "std_at_point"]
+    assert len(summary) == len(batch)
+    np.testing.assert_allclose(summary[columns].to_numpy(dtype = float), batch[columns].to_numpy(dtype = float), rtol = 1e-9, atol = 1e-9)